@@ -0,0 +1,224 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Streaming bulk import / export of marker_data, used by bulk.py
+
+__author__ = 'David Pescariu'
+
+import csv
+import json
+from datetime import datetime
+from time import perf_counter
+import utils.console_messages as msg
+import api.db_connector as db
+from api.storage import MARKER, ADDED, MYSQL_LOCK_QUERY, MYSQL_LOG_QUERY
+from models.types import TYPES
+
+FIELDS = ("lat", "long", "type", "date", "time")
+
+class Progress:
+    """
+    Counts rows and reports the rate every few seconds
+
+    Params:
+        label (str): Shown in the messages, ex: "import"
+        every (float, optional): Seconds between reports. Defaults to 5.
+    """
+    def __init__(self, label: str, every: float = 5) -> None:
+        self.label = label
+        self.every = every
+        self.rows = 0
+        self.skipped = 0
+        self.started = perf_counter()
+        self.__last_report = self.started
+
+    def add(self, rows: int, skipped: int = 0) -> None:
+        """
+        Count rows, reporting if it's time to
+
+        Args:
+            rows (int): Rows done
+            skipped (int, optional): Rows skipped. Defaults to 0.
+        """
+        self.rows += rows
+        self.skipped += skipped
+        now = perf_counter()
+        if now - self.__last_report >= self.every:
+            self.__last_report = now
+            self.report()
+
+    def report(self, done: bool = False) -> None:
+        """
+        Show the rows done so far and the rate
+
+        Args:
+            done (bool, optional): Final report. Defaults to False.
+        """
+        elapsed = max(perf_counter() - self.started, 1e-9)
+        message = (f"[BULK] {self.label}: {self.rows} rows, {self.skipped} skipped, "
+                   f"{self.rows / elapsed:.0f} rows/s")
+        if done:
+            msg.ok(f"{message}, done in {elapsed:.1f}s")
+        else:
+            msg.info(message)
+
+def __read_rows(stream, fmt: str):
+    """
+    Read the rows of a CSV (with a header) or NDJSON stream, one at a time
+
+    Args:
+        stream (io.TextIOBase): The input
+        fmt (str): "csv" / "ndjson"
+
+    Yields:
+        dict: The row, with the FIELDS keys that were present
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield {}
+
+def __parse_row(row: dict, date: str, time: str) -> tuple or None:
+    """
+    Check and convert an imported row
+
+    Args:
+        row (dict): The row
+        date (str): Submit date for rows without one
+        time (str): Submit time for rows without one
+
+    Returns:
+        tuple or None: The marker_data values, None if the row is invalid
+    """
+    try:
+        exact_lat, exact_long, _type = float(row["lat"]), float(row["long"]), row["type"]
+        if TYPES[_type] != "valid":
+            return None
+    except (TypeError, KeyError, ValueError):
+        return None
+
+    cell_lat, cell_long = db.cell_of(exact_lat, exact_long)
+    return (db.legacy_zone(cell_lat, cell_long), cell_lat, cell_long, exact_lat, exact_long, _type,
+        row.get("date") or date, row.get("time") or time)
+
+def __insert_chunk(cursor, query: str, chunk: list) -> None:
+    """
+        Insert a chunk of markers and their change log entries, so /sync
+    clients get them. The API's writes only wait for the log insert, the
+    chunk's markers are inserted before taking the change_lock.
+
+    Args:
+        cursor (mysql.connector.cursor): The mysql cursor
+        query (str): The marker_data insert
+        chunk (list): Rows from __parse_row
+    """
+    cursor.executemany(query, chunk)
+    cursor.execute(MYSQL_LOCK_QUERY)
+    cursor.fetchall()
+    cursor.executemany(MYSQL_LOG_QUERY, [
+        (cell_lat, cell_long, MARKER, ADDED, exact_lat, exact_long, _type, None, date, time)
+        for (_, cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in chunk
+    ])
+
+def import_markers(config, stream, fmt: str, chunk_size: int = 5000) -> Progress:
+    """
+        Import markers from a stream, chunk_size rows per insert / transaction,
+    so memory use doesn't depend on the size of the input. Cells are derived
+    like db_connector.add_marker does, rows without a date/time get the
+    current one and invalid rows are skipped.
+
+    Args:
+        config (models.Config): Config instance
+        stream (io.TextIOBase): CSV (lat,long,type[,date,time] with a header) or NDJSON
+        fmt (str): "csv" / "ndjson"
+        chunk_size (int, optional): Rows per insert. Defaults to 5000.
+
+    Returns:
+        Progress: The final counts
+    """
+    query = ("insert into marker_data (zone, celllat, celllong, exactlat, exactlong, type, submitdate, submittime) "
+             "values (%s, %s, %s, %s, %s, %s, %s, %s);")
+    date = datetime.today().strftime('%Y-%m-%d')
+    time = datetime.now().strftime("%H:%M:%S")
+    progress = Progress("import")
+
+    cnx = db.open_connection(config)
+    try:
+        cursor = cnx.cursor()
+        chunk, skipped = [], 0
+        for row in __read_rows(stream, fmt):
+            values = __parse_row(row, date, time)
+            if values is None:
+                skipped += 1
+                continue
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                __insert_chunk(cursor, query, chunk)
+                cnx.commit()
+                progress.add(len(chunk), skipped)
+                chunk, skipped = [], 0
+
+        if chunk:
+            __insert_chunk(cursor, query, chunk)
+            cnx.commit()
+        progress.add(len(chunk), skipped)
+    finally:
+        cnx.close()
+
+    progress.report(done=True)
+    return progress
+
+def export_markers(config, stream, fmt: str, chunk_size: int = 5000) -> Progress:
+    """
+        Export every marker to a stream, paging by id (keyset, not OFFSET, so
+    every page costs the same), chunk_size rows at a time
+
+    Args:
+        config (models.Config): Config instance
+        stream (io.TextIOBase): The output
+        fmt (str): "csv" / "ndjson"
+        chunk_size (int, optional): Rows per page. Defaults to 5000.
+
+    Returns:
+        Progress: The final counts
+    """
+    query = ("select id, exactlat, exactlong, type, submitdate, submittime from marker_data "
+             "where id > %s order by id limit %s;")
+    progress = Progress("export")
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+
+    cnx = db.open_connection(config)
+    try:
+        cursor = cnx.cursor()
+        last_id = 0
+        while True:
+            cursor.execute(query, (last_id, chunk_size))
+            rows = cursor.fetchall()
+            # Reads don't need to hold a snapshot between pages
+            cnx.commit()
+            for (last_id, exactlat, exactlong, type_, date_added, time_added) in rows:
+                values = (float(exactlat), float(exactlong), type_, str(date_added), str(time_added))
+                if writer is not None:
+                    writer.writerow(values)
+                else:
+                    stream.write(json.dumps(dict(zip(FIELDS, values))) + "\n")
+            progress.add(len(rows))
+            if len(rows) < chunk_size:
+                break
+    finally:
+        cnx.close()
+
+    progress.report(done=True)
+    return progress
+
+# EOF
@@ -0,0 +1,285 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+import api.events as events
+
+class CellCache:
+    """
+        LRU cache of per-cell responses with a TTL, bounded both by the number
+    of entries and by their (estimated) size in memory. Keys are tuples that
+    start with a kind and end with the cell, ex: ("markers", 46, 23), so all
+    the entries of a cell can be dropped when it is written to.
+
+    Params:
+        ttl (float): Seconds an entry stays valid
+        max_entries (int): Max number of entries
+        max_bytes (int): Max estimated size of all the entries
+    """
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.__cells = {}               # cell -> set of keys
+        self.__generations = {}         # cell -> times it was invalidated
+        self.__bytes = 0
+
+        # Metrics
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+        self.__invalidations = 0
+
+    def get_or_load(self, key: tuple, loader):
+        """
+            Get a cached value, or load and cache it. A value loaded while its
+        cell was invalidated is returned but not cached, since it may be
+        older than the write.
+
+        Args:
+            key (tuple): (kind, ..., lat, long), the last two items are the cell
+            loader (callable): Loads the value when it isn't cached
+
+        Returns:
+            The value
+        """
+        hit, value, generation = self.__lookup(key)
+        if hit:
+            return value
+        value = loader()
+        self.__store(key, value, generation)
+        return value
+
+    async def get_or_load_async(self, key: tuple, loader):
+        """
+        Same as get_or_load, for the asyncio serving mode
+
+        Args:
+            key (tuple): (kind, ..., lat, long), the last two items are the cell
+            loader (callable): Returns an awaitable that loads the value
+
+        Returns:
+            The value
+        """
+        hit, value, generation = self.__lookup(key)
+        if hit:
+            return value
+        value = await loader()
+        self.__store(key, value, generation)
+        return value
+
+    def __lookup(self, key: tuple) -> (bool, object, int):
+        """
+        Look a key up, dropping it if expired
+
+        Args:
+            key (tuple): The key
+
+        Returns:
+            (bool, object, int): Hit or not, the value if hit, generation of the cell
+        """
+        cell = key[-2:]
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[2] > monotonic():
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    return True, entry[0], None
+                self.__expirations += 1
+                self.__remove(key)
+            self.__misses += 1
+            return False, None, self.__generations.get(cell, 0)
+
+    def __store(self, key: tuple, value, generation: int) -> None:
+        """
+        Cache a loaded value, unless its cell was invalidated since the lookup
+
+        Args:
+            key (tuple): The key
+            value: The value
+            generation (int): Generation of the cell at the lookup
+        """
+        cell = key[-2:]
+        size = self.__estimate_size(value)
+
+        with self.__lock:
+            if self.__generations.get(cell, 0) != generation or size > self.max_bytes:
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (value, size, monotonic() + self.ttl)
+            self.__bytes += size
+            if cell not in self.__cells:
+                self.__cells[cell] = set()
+            self.__cells[cell].add(key)
+
+            while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.__evictions += 1
+
+    def invalidate(self, cell: tuple) -> None:
+        """
+        Drop every entry of a cell
+
+        Args:
+            cell (tuple): (lat, long) of the cell
+        """
+        with self.__lock:
+            self.__generations[cell] = self.__generations.get(cell, 0) + 1
+            for key in list(self.__cells.get(cell, ())):
+                self.__remove(key)
+            self.__invalidations += 1
+
+    def clear(self) -> None:
+        """
+        Drop every entry
+        """
+        with self.__lock:
+            for cell in self.__cells:
+                self.__generations[cell] = self.__generations.get(cell, 0) + 1
+            self.__entries.clear()
+            self.__cells.clear()
+            self.__bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Get the cache metrics
+
+        Returns:
+            dict: Sizes and hit/miss/eviction counters
+        """
+        with self.__lock:
+            return dict(
+                entries=len(self.__entries),
+                bytes=self.__bytes,
+                hits=self.__hits,
+                misses=self.__misses,
+                evictions=self.__evictions,
+                expirations=self.__expirations,
+                invalidations=self.__invalidations
+            )
+
+    def on_write(self, event: str, cell: tuple, data: dict) -> None:
+        """
+        events listener, drops the entries of the written cell
+
+        Args:
+            event (str): Event name, see api.events
+            cell (tuple): (lat, long) of the cell
+            data (dict): Event details
+        """
+        self.invalidate(cell)
+
+    def __remove(self, key: tuple) -> None:
+        """
+        Remove an entry, the lock must be held
+
+        Args:
+            key (tuple): The key
+        """
+        _, size, _ = self.__entries.pop(key)
+        self.__bytes -= size
+        keys = self.__cells[key[-2:]]
+        keys.discard(key)
+        if not keys:
+            del self.__cells[key[-2:]]
+
+    def __estimate_size(self, value) -> int:
+        """
+        Estimate the memory used by a response, lists/tuples are followed two levels deep
+
+        Args:
+            value: The value
+
+        Returns:
+            int: Size in bytes
+        """
+        size = sys.getsizeof(value)
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                size += sys.getsizeof(item)
+                if isinstance(item, (list, tuple)):
+                    size += sum(sys.getsizeof(inner) for inner in item)
+        return size
+
+__cache = None
+__cache_lock = threading.Lock()
+
+def get_cache(config) -> CellCache or None:
+    """
+    Get the response cache, creating it on first use
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        CellCache or None: The cache, None if cache_enabled is false
+    """
+    global __cache
+
+    if not config.CACHE_ENABLED:
+        return None
+    if __cache is None:
+        with __cache_lock:
+            if __cache is None:
+                __cache = CellCache(
+                    config.CACHE_TTL, config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES)
+                events.subscribe(__cache.on_write)
+    return __cache
+
+def cached(config, key: tuple, loader):
+    """
+    Get a value through the cache, or straight from the loader if it is disabled
+
+    Args:
+        config (models.Config): Config instance
+        key (tuple): (kind, ..., lat, long)
+        loader (callable): Loads the value
+
+    Returns:
+        The value
+    """
+    cache = get_cache(config)
+    if cache is None:
+        return loader()
+    return cache.get_or_load(key, loader)
+
+async def cached_async(config, key: tuple, loader):
+    """
+    Same as cached, for the asyncio serving mode
+
+    Args:
+        config (models.Config): Config instance
+        key (tuple): (kind, ..., lat, long)
+        loader (callable): Returns an awaitable that loads the value
+
+    Returns:
+        The value
+    """
+    cache = get_cache(config)
+    if cache is None:
+        return await loader()
+    return await cache.get_or_load_async(key, loader)
+
+def cache_stats() -> dict:
+    """
+    Get the cache metrics
+
+    Returns:
+        dict: See CellCache.stats(), empty if the cache wasn't used yet
+    """
+    if __cache is None:
+        return {}
+    return __cache.stats()
+
+# EOF
@@ -5,10 +5,19 @@ __author__ = 'David Pescariu'
 
 import utils.console_messages as msg
 import utils.stop_exec as stop
+import api.db_connector as db
+import api.zone_scheduler as zone_scheduler
+import api.write_behind as write_behind
+import api.public_snapshot as public_snapshot
 
 def cleanup() -> None:
     """
     Run cleanup
     """
     msg.info("Cleaning up")
+    zone_scheduler.stop()
+    public_snapshot.stop()
+    # Commits what's still queued, so it needs the database
+    write_behind.stop()
+    db.close_pool()
     stop.stop()
@@ -3,47 +3,104 @@
 
 __author__ = 'David Pescariu'
 
-import mysql.connector
+import threading
 from datetime import datetime
-from api.zone_builder import ZoneBuilder
+from api.zone_builder import get_zone_builder
+from api.storage import Storage, StorageError, MARKER, ADDED, open_storage
+from api.read_store import ReadStore
+import api.events as events
+import api.metrics as metrics
 
-def __connect(config) -> (
-    mysql.connector.cursor, 
-    mysql.connector.connection):
+# Zones written by the zone scheduler, see store_zones()
+GENERATED_ZONE_TYPE = 0
+
+__storage = None
+__storage_lock = threading.Lock()
+
+def open_connection(config):
+    """
+    Open a new connection to the MySQL database, outside of the storage backend,
+    for the tools that only work on MySQL (bulk_io, migrations)
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        mysql.connector.connection: The connection, close it when done
+    """
+    from api.storage_mysql import connect
+    return connect(config)
+
+def get_storage(config) -> Storage:
     """
-    Connect to the database and get the cursor
+    Get the storage backend, opening it on first use
 
     Args:
         config (models.Config): Config instance
 
     Returns:
-        cnx.cursor() (function <- mysql.connector.cursor): The mysql cursor
-        cnx (mysql.connector.connection): The mysql connection
+        Storage: The backend configured in storage_backend, behind the read store if it's enabled
+    """
+    global __storage
+
+    if __storage is None:
+        with __storage_lock:
+            if __storage is None:
+                storage = open_storage(config)
+                if config.READ_STORE_ENABLED:
+                    storage = ReadStore(storage, config)
+                __storage = storage
+    return __storage
+
+def pool_stats() -> dict:
     """
+    Get the storage backend metrics
 
-    db_user = config.DB_LOGIN_USER
-    db_pass = config.DB_LOGIN_PASS
+    Returns:
+        dict: See Storage.stats(), empty if the backend wasn't used yet
+    """
+    if __storage is None:
+        return {}
+    return __storage.stats()
 
-    cnx = mysql.connector.connect(
-        user=db_user, password=db_pass,
-        host='127.0.0.1', database='data')
+def close_pool() -> None:
+    """
+    Close the storage backend, if it was ever opened
+    """
+    global __storage
 
-    return cnx.cursor(), cnx
+    with __storage_lock:
+        if __storage is not None:
+            __storage.close()
+            __storage = None
 
-def __disconnect(
-    cursor: mysql.connector.cursor, 
-    cnx: mysql.connector.connection) -> None:
+def cell_of(lat: float, long: float) -> (int, int):
     """
-    Disconect from the database
+    Get the cell of a point, the lat/long rounded towards 0 like the requests
 
     Args:
-        cnx.cursor (function <- mysql.connector.cursor): The mysql cursor
-        cnx (mysql.connector.connection): The mysql connection
+        lat (float): Lat
+        long (float): Long
+
+    Returns:
+        (int, int): celllat, celllong
+    """
+    return int(lat), int(long)
+
+def legacy_zone(cell_lat: int, cell_long: int) -> str:
     """
+    Get the old string key of a cell, still written to the zone column so
+    readers that didn't migrate keep working. Don't query it, it's ambiguous:
+    (1, 23) and (12, 3) both give "123".
+
+    Args:
+        cell_lat (int): Cell lat
+        cell_long (int): Cell long
 
-    cnx.commit()
-    cursor.close()
-    cnx.close()
+    Returns:
+        str: The zone key
+    """
+    return f"{cell_lat}{cell_long}"
 
 ################################################################################
 ################################## MARKERS #####################################
@@ -61,20 +118,51 @@ def return_markers(config, req_lat: int, req_long: int) -> list:
     Returns:
         list: The list of markers
     """
-    cursor, cnx = __connect(config)
-    query_zone = f"{req_lat}{req_long}"
-    query = (f"select exactlat, exactlong, type, submitdate, submittime from marker_data where zone like \"{query_zone}\";")
-    cursor.execute(query)
-    
-    markers = []
-    for (exactlat, exactlong, type_, date_added, time_added) in cursor:
-        markers.append(f"{exactlat}&{exactlong}&{type_}&{date_added}&{time_added}")
+    rows = get_storage(config).markers(req_lat, req_long)
+    with metrics.STAGE_LATENCY.time("format"):
+        markers = __format_markers(rows)
 
     markers.append("end")
-
-    __disconnect(cursor, cnx)
     return markers
 
+def __format_markers(rows: list) -> list:
+    """
+    Format marker rows for the handlers
+
+    Args:
+        rows (list): (exact_lat, exact_long, type, date, time) rows
+
+    Returns:
+        list: Format is lat&long&type&date&time
+    """
+    return [
+        f"{exactlat}&{exactlong}&{type_}&{date_added}&{time_added}"
+        for (exactlat, exactlong, type_, date_added, time_added) in rows
+    ]
+
+def iter_markers(config, req_lat: int, req_long: int, chunk_size: int = 500):
+    """
+        Stream the markers of a cell, chunk_size rows at a time, same format as
+    return_markers without the "end". The backend's connection is held until
+    the generator is exhausted or closed, with MySQL closing it early drops
+    the connection since it still has unread rows.
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+        chunk_size (int, optional): Rows fetched at a time. Defaults to 500.
+
+    Yields:
+        list: Up to chunk_size markers
+    """
+    rows = get_storage(config).iter_markers(req_lat, req_long, chunk_size)
+    try:
+        for chunk in rows:
+            yield __format_markers(chunk)
+    finally:
+        rows.close()
+
 def add_marker(config, exact_lat: float, exact_long: float, _type: str) -> int:
     """
     Add a marker to the database
@@ -86,23 +174,58 @@ def add_marker(config, exact_lat: float, exact_long: float, _type: str) -> int:
         _type (str): The type of the marker
 
     Returns:
-        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=mysql.connector.errors.ProgrammingError
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=StorageError
     """
     status_code = -1
 
-    cursor, cnx = __connect(config)
-    query_zone = f"{int(exact_lat)}{int(exact_long)}"
+    cell_lat, cell_long = cell_of(exact_lat, exact_long)
     date = datetime.today().strftime('%Y-%m-%d')
     time = datetime.now().strftime("%H:%M:%S")
-    query = (f"insert into marker_data values (\"{query_zone}\", {exact_lat}, {exact_long}, \"{_type}\", \"{date}\", \"{time}\");")
-    
+
     try:
-        cursor.execute(query)
+        get_storage(config).add_markers([(cell_lat, cell_long, exact_lat, exact_long, _type, date, time)])
         status_code = 0
-    except mysql.connector.errors.ProgrammingError:
+    except StorageError:
         status_code = 1
 
-    __disconnect(cursor, cnx)
+    if status_code == 0:
+        events.publish(events.MARKER_ADDED, (cell_lat, cell_long),
+            lat=exact_lat, long=exact_long, type=_type, date=date, time=time)
+    return status_code
+
+def add_markers(config, markers: list) -> int:
+    """
+    Add a batch of markers to the database, with one statement in one transaction
+
+    Args:
+        config (models.Config): Config instance
+        markers (list): The markers, as (exact_lat, exact_long, _type) tuples
+
+    Returns:
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=StorageError
+    """
+    status_code = -1
+
+    date = datetime.today().strftime('%Y-%m-%d')
+    time = datetime.now().strftime("%H:%M:%S")
+    rows = [
+        cell_of(exact_lat, exact_long) + (exact_lat, exact_long, _type, date, time)
+        for (exact_lat, exact_long, _type) in markers
+    ]
+    if not rows:
+        return 0
+
+    # Nothing is committed unless every row made it in
+    try:
+        get_storage(config).add_markers(rows)
+        status_code = 0
+    except StorageError:
+        status_code = 1
+
+    if status_code == 0:
+        for (exact_lat, exact_long, _type) in markers:
+            events.publish(events.MARKER_ADDED, cell_of(exact_lat, exact_long),
+                lat=exact_lat, long=exact_long, type=_type, date=date, time=time)
     return status_code
 
 def del_markers(config, exact_lat: float, exact_long: float) -> int:
@@ -115,23 +238,73 @@ def del_markers(config, exact_lat: float, exact_long: float) -> int:
         exact_long (float): The exact long of the marker(s)
 
     Returns:
-        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=mysql.connector.errors.ProgrammingError
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=StorageError
     """
     status_code = -1
 
-    cursor, cnx = __connect(config)
-    query = (f"delete from marker_data where exactlat like {exact_lat} and exactlong like {exact_lat};")
+    cell_lat, cell_long = cell_of(exact_lat, exact_long)
 
     try:
-        cursor.execute(query)
-        cnx.commit()
+        get_storage(config).del_markers(cell_lat, cell_long, exact_lat, exact_long)
         status_code = 0
-    except mysql.connector.errors.ProgrammingError:
+    except StorageError:
         status_code = 1
 
-    __disconnect(cursor, cnx)
+    if status_code == 0:
+        events.publish(events.MARKERS_DELETED, (cell_lat, cell_long),
+            lat=exact_lat, long=exact_long)
     return status_code
 
+def return_markers_bbox(config, min_lat: float, min_long: float, 
+                        max_lat: float, max_long: float) -> list:
+    """
+    Return the markers inside a bounding box, from every cell it covers in a single query
+
+    Args:
+        config (models.Config): Config instance
+        min_lat (float): South edge
+        min_long (float): West edge
+        max_lat (float): North edge
+        max_long (float): East edge
+
+    Returns:
+        list: The list of markers, same format as return_markers
+    """
+    return __markers_in_cells(config, cell_of(min_lat, min_long), cell_of(max_lat, max_long),
+        (min_lat, min_long, max_lat, max_long))
+
+def __markers_in_cells(config, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+    """
+    Return the markers of a range of cells, with a single query
+
+    Args:
+        config (models.Config): Config instance
+        min_cell (tuple): (lat, long) of the south-west cell
+        max_cell (tuple): (lat, long) of the north-east cell
+        bbox (tuple, optional): Only keep the markers in (min_lat, min_long, max_lat, max_long). Defaults to None.
+
+    Returns:
+        list: The list of markers, same format as return_markers
+    """
+    rows = get_storage(config).markers_in_cells(min_cell, max_cell, bbox)
+    with metrics.STAGE_LATENCY.time("format"):
+        markers = __format_markers(rows)
+
+    markers.append("end")
+    return markers
+
+def return_cells(config) -> list:
+    """
+    Return every cell that has markers
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        list: The cells, as (lat, long) tuples rounded like the requests
+    """
+    return get_storage(config).cells()
+
 ################################################################################
 ################################### ZONES ######################################
 ################################################################################
@@ -148,30 +321,125 @@ def return_zones(config, req_lat: int, req_long: int) -> list:
     Returns:
         list: The list of zones
     """
+    if config.PRECOMPUTE_ZONES:
+        # Built on a schedule by api/zone_scheduler.py and stored by store_zones()
+        zones = [
+            parse_coords(coords) 
+            for coords in get_storage(config).zones(req_lat, req_long, GENERATED_ZONE_TYPE)
+        ]
+
+        zones.append("end")
+        return zones
+
     # The way this is implemented is absolutely terrible. Too bad...
     # But it works as long as there aren't too many calls or too many markers.
     #
     # To implement it right you would run zone_builder on a schedule and add the
-    # results to the database
-    #
-    # Unused code atm, but don't delete:
-    # cursor, cnx = __connect(config)
-    # query_zone = f"{req_lat}{req_long}"
-    # query = (f"select type, coords, submitdate, submittime from zone_data where zone like \"{query_zone}\";")
-    # cursor.execute(query)
-
-    # zones = []
-    # for (_type, coords, _date, _time) in cursor:
-    #     zones.append(f"{_type}&{coords}&{_date}&{_time}")
-        
-    # zones.append("end")
-
-    # __disconnect(cursor, cnx)
-    zones = ZoneBuilder(return_markers(config, req_lat, req_long)) # This is such a nasty work-around, I both hate it and love it
-    _zones = zones.get_zones()
+    # results to the database, which is what precompute_zones does
+    _zones = build_zones(config, req_lat, req_long) # This is such a nasty work-around, I both hate it and love it
+    _zones.append("end")
+    return _zones
+
+def return_zones_bbox(config, min_lat: float, min_long: float, 
+                      max_lat: float, max_long: float) -> list:
+    """
+        Return the zones touching a bounding box. The markers of every cell it
+    covers are clustered together, so zones crossing a cell border come out
+    whole instead of cut at the border like return_zones does.
+
+    Args:
+        config (models.Config): Config instance
+        min_lat (float): South edge
+        min_long (float): West edge
+        max_lat (float): North edge
+        max_long (float): East edge
+
+    Returns:
+        list: The list of zones, with at least one point in the box
+    """
+    # Whole cells, a zone inside the box can chain through markers outside it
+    markers = __markers_in_cells(config, cell_of(min_lat, min_long), cell_of(max_lat, max_long))
+
+    ZoneBuilder = get_zone_builder(config.ZONE_ENGINE)
+    _zones = [
+        zone for zone in ZoneBuilder(markers).get_zones()
+        if any(min_lat <= lat <= max_lat and min_long <= long <= max_long for (lat, long) in zone)
+    ]
     _zones.append("end")
     return _zones
 
+def build_zones(config, req_lat: int, req_long: int) -> list:
+    """
+    Build the zones of a cell from its markers
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+
+    Returns:
+        list: The zones, without the "end" marker
+    """
+    ZoneBuilder = get_zone_builder(config.ZONE_ENGINE)
+    return ZoneBuilder(return_markers(config, req_lat, req_long)).get_zones()
+
+def store_zones(config, req_lat: int, req_long: int, zones: list) -> int:
+    """
+    Replace the generated zones of a cell, in a single transaction
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+        zones (list): The zones, as lists of (lat, long)
+
+    Returns:
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=StorageError
+    """
+    status_code = -1
+
+    date = datetime.today().strftime('%Y-%m-%d')
+    time = datetime.now().strftime("%H:%M:%S")
+    coords = [__format_coords(zone) for zone in zones]
+
+    try:
+        get_storage(config).replace_zones(req_lat, req_long, GENERATED_ZONE_TYPE, coords, date, time)
+        status_code = 0
+    except StorageError:
+        status_code = 1
+
+    if status_code == 0:
+        events.publish(events.ZONES_STORED, (req_lat, req_long), count=len(zones), coords=coords)
+    return status_code
+
+def __format_coords(zone: list) -> str:
+    """
+    Format a zone's coords like add_zone expects them
+
+    Args:
+        zone (list): The zone, as a list of (lat, long)
+
+    Returns:
+        str: Format is lat1@long1,lat2@long2,...
+    """
+    return ','.join(f"{lat}@{long}" for (lat, long) in zone)
+
+def parse_coords(coords: str) -> list:
+    """
+    Parse coords stored by add_zone / store_zones
+
+    Args:
+        coords (str): Format is lat1@long1,lat2@long2,...
+
+    Returns:
+        list: The zone, as a list of (lat, long)
+    """
+    zone = []
+    for point in coords.split(','):
+        __split = point.split('@')
+        zone.append((float(__split[0]), float(__split[1])))
+    return zone
+
 def add_zone(config, _type: int, coords: str) -> int:
     """
     Add a zone to the database
@@ -179,34 +447,31 @@ def add_zone(config, _type: int, coords: str) -> int:
     Args:
         config (models.Config): Config instance
         _type (int): The type/danger level of the zone (ie. 75)
-        coords (str): Format should be lat1,long1%lat2,long2%...
+        coords (str): Format should be lat1@long1,lat2@long2,...
 
     Returns:
-        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=ValueError, 2=mysql.connector.errors.ProgrammingError
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=ValueError, 2=StorageError
     """
     status_code = -1
-    cursor, cnx = __connect(config)
 
     try:
-        first_coords = coords.split(',')[0]
-        __split = first_coords.split('@')
-        query_zone = f"{int(float(__split[0]))}{int(float(__split[1]))}"
-    except ValueError:
-        status_code == 1
-        __disconnect(cursor, cnx)
+        cell_lat, cell_long = cell_of(*parse_coords(coords)[0])
+    except (ValueError, IndexError):
+        status_code = 1
         return status_code
     
     date = datetime.today().strftime('%Y-%m-%d')
     time = datetime.now().strftime("%H:%M:%S")
 
-    query = (f"insert into zone_data values(\"{query_zone}\", {_type}, \"{coords}\", \"{date}\", \"{time}\");")
     try:
-        cursor.execute(query)
+        get_storage(config).add_zone(cell_lat, cell_long, _type, coords, date, time)
         status_code = 0
-    except mysql.connector.errors.ProgrammingError:
+    except StorageError:
         status_code = 2
 
-    __disconnect(cursor, cnx)
+    if status_code == 0:
+        events.publish(events.ZONE_ADDED, (cell_lat, cell_long),
+            type=_type, coords=coords)
     return status_code
 
 def del_zone(config, coords: str) -> int:
@@ -215,22 +480,167 @@ def del_zone(config, coords: str) -> int:
 
     Args:
         config (models.Config): Config instance
-        coords (str): Format should be lat1,long1%lat2,long2%...
+        coords (str): Format should be lat1@long1,lat2@long2,...
 
     Returns:
-        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=mysql.connector.errors.ProgrammingError
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=ValueError, 2=StorageError
     """
     status_code = -1
 
-    cursor, cnx = __connect(config)
-    query = (f"delete from zone_data where coords like {coords};")
+    try:
+        cell_lat, cell_long = cell_of(*parse_coords(coords)[0])
+    except (ValueError, IndexError):
+        status_code = 1
+        return status_code
 
     try:
-        cursor.execute(query)
-        cnx.commit()
+        get_storage(config).del_zone(cell_lat, cell_long, coords)
         status_code = 0
-    except mysql.connector.errors.ProgrammingError:
-        status_code = 1
+    except StorageError:
+        status_code = 2
 
-    __disconnect(cursor, cnx)
+    if status_code == 0:
+        events.publish(events.ZONE_DELETED, (cell_lat, cell_long), coords=coords)
     return status_code
+
+################################################################################
+#################################### SYNC ######################################
+################################################################################
+
+def return_changes(config, cells: list, since: int = None) -> dict:
+    """
+        Return what changed in some cells since a sync token, or a snapshot of
+    them if there's no token or the change log doesn't go back that far.
+    Clients apply the removed entries first, then the added ones, and send
+    the new token on their next sync.
+
+    Args:
+        config (models.Config): Config instance
+        cells (list): (lat, long) of the cells
+        since (int, optional): The sync token. Defaults to None.
+
+    Returns:
+        dict: token, snapshot (bool), more (bool, sync again right away), markers (added: same
+            format as return_markers, removed: [lat, long] of the removed markers) and zones
+            (added / removed, same format as return_zones), zones is None without precompute_zones
+    """
+    storage = get_storage(config)
+
+    first, last = storage.change_range()
+    if last - first + 1 > config.SYNC_LOG_MAX_CHANGES:
+        # Prune a bit more than needed, so it isn't pruned again on every call
+        storage.prune_changes(config.SYNC_LOG_MAX_CHANGES * 9 // 10)
+        first, last = storage.change_range()
+
+    # Tokens from before the oldest entry or from another database get a snapshot
+    if since is None or since > last or since < first - 1:
+        seq, rows, zones = storage.snapshot(cells, GENERATED_ZONE_TYPE)
+        with metrics.STAGE_LATENCY.time("format"):
+            markers = __format_markers(rows)
+        return dict(
+            token=str(seq),
+            snapshot=True,
+            more=False,
+            markers=dict(added=markers, removed=[]),
+            zones=dict(added=[parse_coords(coords) for coords in zones], removed=[])
+                if config.PRECOMPUTE_ZONES else None
+        )
+
+    changes = storage.changes(cells, since, config.SYNC_MAX_CHANGES + 1)
+    more = len(changes) > config.SYNC_MAX_CHANGES
+    changes = changes[:config.SYNC_MAX_CHANGES]
+
+    # Only the net change: a marker added then deleted isn't sent at all
+    added_markers = {}   # (lat, long) -> rows added since the last removal
+    removed_markers = set()
+    added_zones = {}     # coords -> None, ordered like the log
+    removed_zones = set()
+    for (seq, kind, op, exact_lat, exact_long, _type, coords, date, time) in changes:
+        if kind == MARKER:
+            key = (exact_lat, exact_long)
+            if op == ADDED:
+                added_markers.setdefault(key, []).append((exact_lat, exact_long, _type, date, time))
+            else:
+                added_markers.pop(key, None)
+                removed_markers.add(key)
+        elif op == ADDED:
+            # Zones added by add_zone aren't served by return_zones either
+            if str(_type) == str(GENERATED_ZONE_TYPE):
+                added_zones[coords] = None
+                removed_zones.discard(coords)
+        else:
+            added_zones.pop(coords, None)
+            removed_zones.add(coords)
+
+    with metrics.STAGE_LATENCY.time("format"):
+        markers = __format_markers([row for rows in added_markers.values() for row in rows])
+
+    # Every change up to last was committed before the query above, so the
+    # token can skip the ones made in other cells
+    token = changes[-1][0] if more else max(last, changes[-1][0] if changes else since)
+    return dict(
+        token=str(token),
+        snapshot=False,
+        more=more,
+        markers=dict(added=markers, removed=[[lat, long] for (lat, long) in removed_markers]),
+        zones=dict(
+            added=[parse_coords(coords) for coords in added_zones],
+            removed=[parse_coords(coords) for coords in removed_zones]
+        ) if config.PRECOMPUTE_ZONES else None
+    )
+
+def return_cell_seq(config, req_lat: int, req_long: int) -> int:
+    """
+    Return the sequence number a cell is at, see Storage.cell_seq()
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+
+    Returns:
+        int: The sequence number, changed by every write to the cell
+    """
+    return get_storage(config).cell_seq(req_lat, req_long)
+
+################################################################################
+################################### PUBLIC #####################################
+################################################################################
+
+def return_last_change(config) -> int:
+    """
+    Return the sequence number of the last change, to tell if anything was
+    written since a summary without reading it again
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        int: The sequence number
+    """
+    return get_storage(config).change_range()[1]
+
+def return_summary(config) -> tuple:
+    """
+    Return the number of markers of each type and the generated zones of every cell
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        tuple: (seq, {(lat, long): {type: count}}, {(lat, long): zones in the format of
+            return_zones} or None without precompute_zones)
+    """
+    seq, counts, zone_rows = get_storage(config).summary(GENERATED_ZONE_TYPE)
+
+    cells = {}
+    for (cell_lat, cell_long, _type, count) in counts:
+        types = cells.setdefault((int(cell_lat), int(cell_long)), {})
+        types[_type] = types.get(_type, 0) + int(count)
+
+    if not config.PRECOMPUTE_ZONES:
+        return seq, cells, None
+    zones = {}
+    for (cell_lat, cell_long, coords) in zone_rows:
+        zones.setdefault((int(cell_lat), int(cell_long)), []).append(parse_coords(coords))
+    return seq, cells, zones
@@ -0,0 +1,276 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# asyncio versions of the db_connector calls served by api/serve_asgi.py, on
+# aiomysql. Rows, status codes and events are the same as db_connector's.
+
+__author__ = 'David Pescariu'
+
+import asyncio
+import aiomysql
+from contextlib import asynccontextmanager
+from datetime import datetime
+import api.db_connector as db
+import api.events as events
+import api.metrics as metrics
+from api.storage import MARKER, ADDED, REMOVED, MYSQL_LOCK_QUERY, MYSQL_LOG_QUERY, MYSQL_CELL_SEQ_QUERY
+from api.zone_builder import get_zone_builder
+
+__pool = None
+
+async def open_pool(config) -> None:
+    """
+    Open the connection pool, called on startup of the event loop
+
+    Args:
+        config (models.Config): Config instance
+    """
+    global __pool
+
+    if __pool is None:
+        __pool = await aiomysql.create_pool(
+            user=config.DB_LOGIN_USER, password=config.DB_LOGIN_PASS,
+            host='127.0.0.1', db='data',
+            minsize=1, maxsize=config.ASYNC_POOL_SIZE,
+            pool_recycle=config.DB_POOL_RECYCLE)
+
+async def close_pool() -> None:
+    """
+    Close the connection pool, if it was opened
+    """
+    global __pool
+
+    if __pool is not None:
+        __pool.close()
+        await __pool.wait_closed()
+        __pool = None
+
+def pool_stats() -> dict:
+    """
+    Get the connection pool metrics
+
+    Returns:
+        dict: Sizes of the pool, empty if it wasn't opened
+    """
+    if __pool is None:
+        return {}
+    return dict(
+        size=__pool.maxsize,
+        open=__pool.size,
+        idle=__pool.freesize,
+        in_use=__pool.size - __pool.freesize
+    )
+
+@asynccontextmanager
+async def __session(cursor_class=aiomysql.Cursor):
+    """
+        Borrow a pooled connection for the duration of an async with block,
+    committed at the end. If the block raises, the connection is closed
+    instead of given back, which also rolls back its transaction.
+
+    Args:
+        cursor_class (type, optional): aiomysql.SSCursor to stream rows. Defaults to aiomysql.Cursor.
+
+    Yields:
+        aiomysql.Cursor: The cursor
+    """
+    with metrics.STAGE_LATENCY.time("connect"):
+        cnx = await __pool.acquire()
+    try:
+        cursor = await cnx.cursor(cursor_class)
+        yield cursor
+        await cursor.close()
+        await cnx.commit()
+    except BaseException:
+        cnx.close()
+        raise
+    finally:
+        __pool.release(cnx)
+
+################################################################################
+################################## MARKERS #####################################
+################################################################################
+
+async def return_markers(config, req_lat: int, req_long: int) -> list:
+    """
+    Return the markers
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+
+    Returns:
+        list: The list of markers
+    """
+    query = ("select exactlat, exactlong, type, submitdate, submittime from marker_data "
+             "where celllat = %s and celllong = %s;")
+
+    async with __session() as cursor:
+        with metrics.STAGE_LATENCY.time("query"):
+            await cursor.execute(query, (req_lat, req_long))
+            rows = await cursor.fetchall()
+
+    with metrics.STAGE_LATENCY.time("format"):
+        markers = [
+            f"{exactlat}&{exactlong}&{type_}&{date_added}&{time_added}"
+            for (exactlat, exactlong, type_, date_added, time_added) in rows
+        ]
+    markers.append("end")
+    return markers
+
+async def iter_markers(config, req_lat: int, req_long: int, chunk_size: int = 500):
+    """
+    Stream the markers of a cell, chunk_size rows at a time, see db_connector.iter_markers
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+        chunk_size (int, optional): Rows fetched at a time. Defaults to 500.
+
+    Yields:
+        list: Up to chunk_size markers
+    """
+    query = ("select exactlat, exactlong, type, submitdate, submittime from marker_data "
+             "where celllat = %s and celllong = %s;")
+
+    async with __session(aiomysql.SSCursor) as cursor:
+        await cursor.execute(query, (req_lat, req_long))
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [
+                f"{exactlat}&{exactlong}&{type_}&{date_added}&{time_added}"
+                for (exactlat, exactlong, type_, date_added, time_added) in rows
+            ]
+
+async def add_marker(config, exact_lat: float, exact_long: float, _type: str) -> int:
+    """
+    Add a marker to the database
+
+    Args:
+        config (models.Config): Config instance
+        exact_lat (float): The exact lat of the marker
+        exact_long (float): The exact long of the marker
+        _type (str): The type of the marker
+
+    Returns:
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=aiomysql.ProgrammingError
+    """
+    status_code = -1
+
+    cell_lat, cell_long = db.cell_of(exact_lat, exact_long)
+    date = datetime.today().strftime('%Y-%m-%d')
+    time = datetime.now().strftime("%H:%M:%S")
+    query = ("insert into marker_data (zone, celllat, celllong, exactlat, exactlong, type, submitdate, submittime) "
+             "values (%s, %s, %s, %s, %s, %s, %s, %s);")
+
+    # Caught outside the session, so a failed log insert rolls the marker back too
+    try:
+        async with __session() as cursor:
+            await cursor.execute(query, (db.legacy_zone(cell_lat, cell_long), cell_lat, cell_long,
+                exact_lat, exact_long, _type, date, time))
+            await cursor.execute(MYSQL_LOCK_QUERY)
+            await cursor.fetchall()
+            await cursor.execute(MYSQL_LOG_QUERY,
+                (cell_lat, cell_long, MARKER, ADDED, exact_lat, exact_long, _type, None, date, time))
+        status_code = 0
+    except aiomysql.ProgrammingError:
+        status_code = 1
+
+    if status_code == 0:
+        events.publish(events.MARKER_ADDED, (cell_lat, cell_long),
+            lat=exact_lat, long=exact_long, type=_type, date=date, time=time)
+    return status_code
+
+async def del_markers(config, exact_lat: float, exact_long: float) -> int:
+    """
+    Delete markers from exact coords from the database
+
+    Args:
+        config (models.Config): Config instance
+        exact_lat (float): The exact lat of the marker(s)
+        exact_long (float): The exact long of the marker(s)
+
+    Returns:
+        int: Status code -> -1=Unknown fail, check log, 0=OK, 1=aiomysql.ProgrammingError
+    """
+    status_code = -1
+
+    cell_lat, cell_long = db.cell_of(exact_lat, exact_long)
+    query = ("delete from marker_data "
+             "where celllat = %s and celllong = %s and exactlat = %s and exactlong = %s;")
+
+    # See add_marker
+    try:
+        async with __session() as cursor:
+            await cursor.execute(query, (cell_lat, cell_long, exact_lat, exact_long))
+            if cursor.rowcount > 0:
+                await cursor.execute(MYSQL_LOCK_QUERY)
+                await cursor.fetchall()
+                await cursor.execute(MYSQL_LOG_QUERY,
+                    (cell_lat, cell_long, MARKER, REMOVED, exact_lat, exact_long, None, None, None, None))
+        status_code = 0
+    except aiomysql.ProgrammingError:
+        status_code = 1
+
+    if status_code == 0:
+        events.publish(events.MARKERS_DELETED, (cell_lat, cell_long),
+            lat=exact_lat, long=exact_long)
+    return status_code
+
+async def return_cell_seq(config, req_lat: int, req_long: int) -> int:
+    """
+    Return the sequence number a cell is at, see db_connector.return_cell_seq
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+
+    Returns:
+        int: The sequence number, changed by every write to the cell
+    """
+    async with __session() as cursor:
+        await cursor.execute(MYSQL_CELL_SEQ_QUERY, (req_lat, req_long))
+        (seq, ) = await cursor.fetchone()
+    return int(seq)
+
+################################################################################
+################################### ZONES ######################################
+################################################################################
+
+async def return_zones(config, req_lat: int, req_long: int) -> list:
+    """
+    Return the zones, see db_connector.return_zones. Zones built on request
+    are built in a worker thread, so they don't block the event loop.
+
+    Args:
+        config (models.Config): Config instance
+        req_lat (int): Zone lat
+        req_long (int): Zone long
+
+    Returns:
+        list: The list of zones
+    """
+    if config.PRECOMPUTE_ZONES:
+        query = ("select coords from zone_data where celllat = %s and celllong = %s and type = %s;")
+
+        async with __session() as cursor:
+            await cursor.execute(query, (req_lat, req_long, db.GENERATED_ZONE_TYPE))
+            rows = await cursor.fetchall()
+
+        zones = [db.parse_coords(coords) for (coords, ) in rows]
+        zones.append("end")
+        return zones
+
+    markers = await return_markers(config, req_lat, req_long)
+    ZoneBuilder = get_zone_builder(config.ZONE_ENGINE)
+    _zones = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: ZoneBuilder(markers).get_zones())
+    _zones.append("end")
+    return _zones
+
+# EOF
@@ -0,0 +1,208 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+import threading
+from time import monotonic, perf_counter
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection became available within the pool timeout
+    """
+
+class PoolClosedError(Exception):
+    """
+    Raised when acquiring from a pool that was already closed
+    """
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections
+
+    Idle connections are handed out LIFO so the warmest ones get reused, the
+    ones that sat idle for longer than `ping_after` are health-checked before
+    being returned and the ones older than `recycle` are replaced.
+
+    Params:
+        connect (callable): Opens a new connection, ex: lambda: mysql.connector.connect(...)
+        size (int): Maximum number of open connections
+        timeout (float, optional): Seconds to wait for a free connection. Defaults to 10.
+        recycle (float, optional): Max lifetime of a connection in seconds. Defaults to 3600.
+        ping_after (float, optional): Health-check connections idle for longer than this. Defaults to 30.
+    """
+    def __init__(self, connect, size: int, timeout: float = 10,
+                 recycle: float = 3600, ping_after: float = 30) -> None:
+        self.connect = connect
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+
+        self.__cond = threading.Condition(threading.Lock())
+        self.__idle = []        # [(cnx, created_at, released_at)]
+        self.__created_at = {}  # id(cnx) -> created_at, for the checked out ones
+        self.__open = 0
+        self.__closed = False
+
+        # Metrics
+        self.__acquired = 0
+        self.__waited = 0
+        self.__wait_total = 0.0
+        self.__wait_max = 0.0
+        self.__timeouts = 0
+        self.__recycled = 0
+        self.__failed_checks = 0
+
+    def acquire(self):
+        """
+        Get a connection from the pool, opening a new one if under the limit
+
+        Raises:
+            PoolTimeoutError: No connection became free within the timeout
+            PoolClosedError: The pool was closed
+
+        Returns:
+            The connection, give it back with release()
+        """
+        start = perf_counter()
+        deadline = monotonic() + self.timeout
+        entry = None
+        had_to_wait = False
+
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise PoolClosedError("Connection pool is closed")
+                if self.__idle:
+                    entry = self.__idle.pop()
+                    break
+                if self.__open < self.size:
+                    self.__open += 1
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.__timeouts += 1
+                    raise PoolTimeoutError(f"No free connection after {self.timeout}s")
+                had_to_wait = True
+                self.__cond.wait(remaining)
+
+            waited = perf_counter() - start
+            self.__acquired += 1
+            if had_to_wait:
+                self.__waited += 1
+            self.__wait_total += waited
+            self.__wait_max = max(self.__wait_max, waited)
+
+        if entry is not None:
+            cnx, created_at, released_at = entry
+            now = monotonic()
+            if now - created_at > self.recycle:
+                self.__close_quietly(cnx)
+                with self.__cond:
+                    self.__recycled += 1
+                entry = None
+            elif now - released_at > self.ping_after and not self.__is_healthy(cnx):
+                self.__close_quietly(cnx)
+                with self.__cond:
+                    self.__failed_checks += 1
+                entry = None
+
+        if entry is None:
+            try:
+                cnx, created_at = self.connect(), monotonic()
+            except Exception:
+                with self.__cond:
+                    self.__open -= 1
+                    self.__cond.notify()
+                raise
+
+        with self.__cond:
+            self.__created_at[id(cnx)] = created_at
+        return cnx
+
+    def release(self, cnx, discard: bool = False) -> None:
+        """
+        Give a connection back to the pool
+
+        Args:
+            cnx: Connection obtained from acquire()
+            discard (bool, optional): Close it instead of reusing it, for broken connections. Defaults to False.
+        """
+        with self.__cond:
+            created_at = self.__created_at.pop(id(cnx), None)
+            if created_at is None:
+                return
+            close_it = discard or self.__closed
+            if close_it:
+                self.__open -= 1
+            else:
+                self.__idle.append((cnx, created_at, monotonic()))
+            self.__cond.notify()
+
+        if close_it:
+            self.__close_quietly(cnx)
+
+    def close(self) -> None:
+        """
+        Close all the idle connections, checked out ones get closed on release
+        """
+        with self.__cond:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__open -= len(idle)
+            self.__cond.notify_all()
+
+        for cnx, _, _ in idle:
+            self.__close_quietly(cnx)
+
+    def stats(self) -> dict:
+        """
+        Get the pool metrics
+
+        Returns:
+            dict: Sizes, acquire/wait counters and wait times (seconds)
+        """
+        with self.__cond:
+            return dict(
+                size=self.size,
+                open=self.__open,
+                idle=len(self.__idle),
+                in_use=self.__open - len(self.__idle),
+                acquired=self.__acquired,
+                waited=self.__waited,
+                wait_total=self.__wait_total,
+                wait_max=self.__wait_max,
+                timeouts=self.__timeouts,
+                recycled=self.__recycled,
+                failed_checks=self.__failed_checks
+            )
+
+    def __is_healthy(self, cnx) -> bool:
+        """
+        Check if an idle connection is still usable
+
+        Args:
+            cnx: The connection
+
+        Returns:
+            bool: True / False
+        """
+        try:
+            return cnx.is_connected()
+        except Exception:
+            return False
+
+    def __close_quietly(self, cnx) -> None:
+        """
+        Close a connection, ignoring errors from already dead ones
+
+        Args:
+            cnx: The connection
+        """
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+# EOF
@@ -0,0 +1,105 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Lets other modules react to writes made through db_connector
+
+__author__ = 'David Pescariu'
+
+import threading
+import utils.console_messages as msg
+
+MARKER_ADDED    = "marker_added"
+MARKERS_DELETED = "markers_deleted"
+ZONE_ADDED      = "zone_added"
+ZONE_DELETED    = "zone_deleted"
+ZONES_STORED    = "zones_stored"
+
+__listeners = []         # [(listener, remote, local)]
+__listeners_lock = threading.Lock()
+__forwarder = None
+
+def subscribe(listener, remote: bool = True, local: bool = True) -> None:
+    """
+    Register a listener for write events
+
+    Args:
+        listener (callable): Called as listener(event, cell, data) from the writing thread
+        remote (bool, optional): Call it for the events of other processes, see receive(). Defaults to True.
+        local (bool, optional): Call it for the events of this process. Defaults to True.
+    """
+    with __listeners_lock:
+        __listeners.append((listener, remote, local))
+
+def unsubscribe(listener) -> None:
+    """
+    Remove a listener registered with subscribe()
+
+    Args:
+        listener (callable): The listener
+    """
+    with __listeners_lock:
+        __listeners[:] = [entry for entry in __listeners if entry[0] != listener]
+
+def set_forwarder(forwarder) -> None:
+    """
+    Also send every event published in this process to forwarder, ex: to the
+    other worker processes of api/prefork.py
+
+    Args:
+        forwarder (callable): Called as forwarder(event, cell, data), None to stop forwarding
+    """
+    global __forwarder
+
+    __forwarder = forwarder
+
+def publish(event: str, cell: tuple, **data) -> None:
+    """
+    Notify every listener of a write, a failing listener doesn't stop the others
+
+    Args:
+        event (str): One of the event constants, ex: MARKER_ADDED
+        cell (tuple): (lat, long) of the cell that was written, rounded to int
+        **data: Event details, ex: lat, long, type
+    """
+    __notify(event, cell, data, remote=False)
+
+    forwarder = __forwarder
+    if forwarder is not None:
+        try:
+            forwarder(event, cell, data)
+        except Exception as e:
+            msg.exception(e)
+
+def receive(event: str, cell: tuple, data: dict) -> None:
+    """
+    Notify every listener of a write published by another process, it isn't
+    forwarded again
+
+    Args:
+        event (str): One of the event constants
+        cell (tuple): (lat, long) of the cell that was written
+        data (dict): Event details
+    """
+    __notify(event, tuple(cell), data, remote=True)
+
+def __notify(event: str, cell: tuple, data: dict, remote: bool) -> None:
+    """
+    Call every listener, a failing listener doesn't stop the others
+
+    Args:
+        event (str): One of the event constants
+        cell (tuple): (lat, long) of the cell that was written
+        data (dict): Event details
+        remote (bool): The event was published by another process
+    """
+    with __listeners_lock:
+        listeners = [
+            listener for (listener, wants_remote, wants_local) in __listeners 
+            if (wants_remote if remote else wants_local)
+        ]
+
+    for listener in listeners:
+        try:
+            listener(event, cell, data)
+        except Exception as e:
+            msg.exception(e)
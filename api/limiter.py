@@ -0,0 +1,285 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Banned IPs and rate limiting, checked by every request_handler call before
+# the key and the database. Limits are token buckets per API key and per IP,
+# set per endpoint in rate_limits. With serve_workers > 1 every worker has its
+# own buckets, so a client gets up to serve_workers times the limit.
+
+__author__ = 'David Pescariu'
+
+import ipaddress
+import socket
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from time import monotonic
+import utils.console_messages as msg
+
+class IPBans:
+    """
+        Banned IPs / networks, ex: "10.0.0.1", "192.168.0.0/16", "2001:db8::/32".
+    The networks are merged into sorted, non-overlapping ranges, so a lookup
+    is a binary search.
+
+    Params:
+        entries (list): IPs / networks in CIDR notation
+    """
+    def __init__(self, entries: list) -> None:
+        ranges = {4: [], 6: []}
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(str(entry).strip(), strict=False)
+            except ValueError:
+                msg.fail(f"Ignoring invalid banned_ips entry: {entry}", "limiter")
+                continue
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address)))
+
+        # version -> (range starts, range ends)
+        self.__ranges = {}
+        for version, spans in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(spans):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.__ranges[version] = (starts, ends)
+        self.size = sum(len(starts) for starts, _ in self.__ranges.values())
+
+    def is_banned(self, ip: str) -> bool:
+        """
+        Check if an IP is banned
+
+        Args:
+            ip (str): The IP, IPv4-mapped IPv6 addresses are checked as IPv4
+
+        Returns:
+            bool: True if it is in one of the banned networks, False if not or not an IP
+        """
+        if not self.size or not ip:
+            return False
+        # inet_pton is several times faster than ipaddress.ip_address
+        try:
+            version, address = 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+        except OSError:
+            try:
+                version, address = 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+            except OSError:
+                return False
+            if address >> 32 == 0xffff:
+                version, address = 4, address & 0xffffffff
+
+        starts, ends = self.__ranges[version]
+        index = bisect_right(starts, address) - 1
+        return index >= 0 and address <= ends[index]
+
+class RateLimiter:
+    """
+        Token buckets per (endpoint, API key) and (endpoint, IP). A bucket
+    holds up to `burst` tokens and refills at `rate` tokens per second, a
+    request takes one from both of its buckets. The least recently used
+    buckets are dropped past max_buckets, which only lets their clients
+    start again with a full bucket.
+
+    Params:
+        limits (dict): Endpoint -> {"key": [rate, burst], "ip": [rate, burst]}, "default" for the rest
+        max_buckets (int): Max number of buckets kept
+    """
+    def __init__(self, limits: dict, max_buckets: int) -> None:
+        self.max_buckets = max_buckets
+        self.__default = limits.get("default", {})
+        self.__limits = {}
+        for endpoint, limit in limits.items():
+            self.__limits[endpoint] = {**self.__default, **limit}
+
+        self.__lock = threading.Lock()
+        self.__buckets = OrderedDict()  # (endpoint, kind, client) -> [tokens, last refill]
+
+        # Metrics
+        self.__allowed = 0
+        self.__rejected = {}  # (endpoint, kind) -> rejected requests
+
+    def allow(self, endpoint: str, key: str or None, ip: str or None) -> str or None:
+        """
+        Take a token from the key's and the IP's bucket
+
+        Args:
+            endpoint (str): ex: "get_markers"
+            key (str or None): API key, None to only limit by IP
+            ip (str or None): IP of the client, None to only limit by key
+
+        Returns:
+            str or None: "key" / "ip" if that bucket is empty, None if allowed
+        """
+        limit = self.__limits.get(endpoint, self.__default)
+        now = monotonic()
+        with self.__lock:
+            # Check both before taking from either, a rejected request costs nothing
+            buckets = []
+            for kind, client in (("key", key), ("ip", ip)):
+                if client is None or kind not in limit:
+                    continue
+                rate, burst = limit[kind]
+                bucket = self.__refill((endpoint, kind, client), rate, burst, now)
+                if bucket[0] < 1:
+                    rejected = (endpoint, kind)
+                    self.__rejected[rejected] = self.__rejected.get(rejected, 0) + 1
+                    return kind
+                buckets.append(bucket)
+
+            for bucket in buckets:
+                bucket[0] -= 1
+            self.__allowed += 1
+        return None
+
+    def stats(self) -> dict:
+        """
+        Get the limiter metrics
+
+        Returns:
+            dict: Number of buckets, allowed requests and rejections per "endpoint.kind"
+        """
+        with self.__lock:
+            return dict(
+                buckets=len(self.__buckets),
+                allowed=self.__allowed,
+                rejected={f"{endpoint}.{kind}": count for (endpoint, kind), count in self.__rejected.items()}
+            )
+
+    def __refill(self, name: tuple, rate: float, burst: float, now: float) -> list:
+        """
+        Get a bucket with the tokens gained since its last refill, the lock must be held
+
+        Args:
+            name (tuple): (endpoint, kind, client)
+            rate (float): Tokens per second
+            burst (float): Max tokens
+            now (float): Current monotonic time
+
+        Returns:
+            list: [tokens, last refill]
+        """
+        bucket = self.__buckets.get(name)
+        if bucket is None:
+            bucket = self.__buckets[name] = [burst, now]
+            if len(self.__buckets) > self.max_buckets:
+                self.__buckets.popitem(last=False)
+            return bucket
+
+        self.__buckets.move_to_end(name)
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket
+
+__bans = None
+__limiter = None
+__banned = 0
+__lock = threading.Lock()
+
+def get_bans(config) -> IPBans:
+    """
+    Get the banned IPs, loading them on first use
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        IPBans: The banned IPs
+    """
+    global __bans
+
+    if __bans is None:
+        with __lock:
+            if __bans is None:
+                __bans = IPBans(config.BANNED_IPS)
+    return __bans
+
+def get_limiter(config) -> RateLimiter or None:
+    """
+    Get the rate limiter, creating it on first use
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        RateLimiter or None: The limiter, None if rate_limit_enabled is false
+    """
+    global __limiter
+
+    if not config.RATE_LIMIT_ENABLED:
+        return None
+    if __limiter is None:
+        with __lock:
+            if __limiter is None:
+                __limiter = RateLimiter(config.RATE_LIMITS, config.RATE_LIMIT_MAX_BUCKETS)
+    return __limiter
+
+def is_banned(req, config) -> bool:
+    """
+    Check if the client of a request is banned, without taking a token
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        bool: True if banned
+    """
+    return get_bans(config).is_banned(req.remote_addr)
+
+def check(req, config, endpoint: str) -> dict or None:
+    """
+    Check a request against the bans and the rate limits of its endpoint
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+        endpoint (str): ex: "get_markers"
+
+    Returns:
+        dict or None: Response to reject the request with, None if allowed
+    """
+    global __banned
+
+    if get_bans(config).is_banned(req.remote_addr):
+        with __lock:
+            __banned += 1
+        msg.fail(f"Banned IP: {req.remote_addr}", "limiter")
+        return dict(FAIL="BANNED")
+
+    limiter = get_limiter(config)
+    if limiter is None:
+        return None
+
+    # Only real keys get a bucket, made up ones are limited by IP alone
+    key = req.args.get('key')
+    if config.PRIVATE_KEYS.get(key) != "valid" and config.PUBLIC_KEYS.get(key) != "valid":
+        key = None
+
+    kind = limiter.allow(endpoint, key, req.remote_addr)
+    if kind is not None:
+        msg.fail(f"Rate limited ({kind}) on {endpoint}: {req.remote_addr}", "limiter")
+        return dict(FAIL="RATE_LIMITED")
+    return None
+
+def stats(config) -> dict:
+    """
+    Get the ban / rate limit metrics
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Banned networks, rejected banned requests and the limiter stats
+    """
+    limiter = get_limiter(config)
+    return dict(
+        banned_networks=get_bans(config).size,
+        banned_requests=__banned,
+        **(limiter.stats() if limiter is not None else {})
+    )
+
+# EOF
@@ -0,0 +1,359 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Metrics registry, served at /metrics in the Prometheus text format. Counters
+# and histograms are updated in per-thread shards (no lock, a few list
+# operations per observation), the pool / cache / limiter stats are read when
+# scraped. With serve_workers > 1 every worker process has its own registry.
+
+__author__ = 'David Pescariu'
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+MIME_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached response to a big zone build
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def __escape(value) -> str:
+    """
+    Escape a label value
+
+    Args:
+        value: The label value
+
+    Returns:
+        str: The escaped value
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def __labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """
+    Render the labels of a sample, ex: {endpoint="get_zones",le="0.5"}
+
+    Args:
+        names (tuple): Label names
+        values (tuple): Label values
+        extra (str, optional): Rendered label to add, ex: le="0.5". Defaults to "".
+
+    Returns:
+        str: The labels, "" if there are none
+    """
+    pairs = [f'{name}="{__escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def __number(value: float) -> str:
+    """
+    Render a sample value
+
+    Args:
+        value (float): The value
+
+    Returns:
+        str: The value, without a trailing .0 for whole numbers
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    """
+        A counter per set of label values. Every thread counts in its own
+    shard, summed when collected, so counting takes no lock.
+
+    Params:
+        name (str): Metric name
+        help_ (str): Description
+        labelnames (tuple, optional): Label names. Defaults to ().
+    """
+    def __init__(self, name: str, help_: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__shards = []  # label values -> count, one dict per thread
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        """
+        Increment the counter
+
+        Args:
+            *labels: Label values, in the order of labelnames
+            amount (float, optional): Defaults to 1.
+        """
+        try:
+            shard = self.__local.shard
+        except AttributeError:
+            shard = self.__new_shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        """
+        Get the current values
+
+        Returns:
+            list: (label values, count), sorted
+        """
+        with self.__lock:
+            shards = list(self.__shards)
+        values = {}
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                values[labels] = values.get(labels, 0) + value
+        return sorted(values.items())
+
+    def __new_shard(self) -> dict:
+        """
+        Create the shard of the current thread
+
+        Returns:
+            dict: The shard
+        """
+        shard = self.__local.shard = {}
+        with self.__lock:
+            self.__shards.append(shard)
+        return shard
+
+class Histogram:
+    """
+        A histogram per set of label values. Counts are kept per bucket and
+    only made cumulative when collected, every thread observes in its own
+    shard, so an observation is a binary search and two additions, no lock.
+
+    Params:
+        name (str): Metric name
+        help_ (str): Description
+        labelnames (tuple, optional): Label names. Defaults to ().
+        buckets (tuple, optional): Upper bounds. Defaults to LATENCY_BUCKETS.
+    """
+    def __init__(self, name: str, help_: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        # label values -> [count per bucket..., count over the last, sum], one dict per thread
+        self.__shards = []
+
+    def observe(self, value: float, *labels) -> None:
+        """
+        Record an observation
+
+        Args:
+            value (float): ex: seconds
+            *labels: Label values, in the order of labelnames
+        """
+        try:
+            shard = self.__local.shard
+        except AttributeError:
+            shard = self.__new_shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> "Timer":
+        """
+        Time a with block
+
+        Args:
+            *labels: Label values, in the order of labelnames
+
+        Returns:
+            Timer: Context manager that observes the seconds spent in the block
+        """
+        return Timer(self, labels)
+
+    def collect(self) -> list:
+        """
+        Get the current values
+
+        Returns:
+            list: (label values, [count per bucket..., count over the last, sum]), sorted
+        """
+        with self.__lock:
+            shards = list(self.__shards)
+        series = {}
+        for shard in shards:
+            for labels, values in list(shard.items()):
+                total = series.get(labels)
+                if total is None:
+                    series[labels] = list(values)
+                else:
+                    series[labels] = [a + b for a, b in zip(total, values)]
+        return sorted(series.items())
+
+    def __new_shard(self) -> dict:
+        """
+        Create the shard of the current thread
+
+        Returns:
+            dict: The shard
+        """
+        shard = self.__local.shard = {}
+        with self.__lock:
+            self.__shards.append(shard)
+        return shard
+
+class Timer:
+    """
+    Observes the seconds spent in a with block, see Histogram.time
+
+    Params:
+        histogram (Histogram): Where to observe them
+        labels (tuple): Label values
+    """
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Timer":
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+__metrics = []
+__collectors = {}  # prefix -> (stats function, keys that are counters)
+__lock = threading.Lock()
+
+def counter(name: str, help_: str, labelnames: tuple = ()) -> Counter:
+    """
+    Create and register a counter
+
+    Args:
+        name (str): Metric name
+        help_ (str): Description
+        labelnames (tuple, optional): Label names. Defaults to ().
+
+    Returns:
+        Counter: The counter
+    """
+    metric = Counter(name, help_, labelnames)
+    with __lock:
+        __metrics.append(metric)
+    return metric
+
+def histogram(name: str, help_: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    """
+    Create and register a histogram
+
+    Args:
+        name (str): Metric name
+        help_ (str): Description
+        labelnames (tuple, optional): Label names. Defaults to ().
+        buckets (tuple, optional): Upper bounds. Defaults to LATENCY_BUCKETS.
+
+    Returns:
+        Histogram: The histogram
+    """
+    metric = Histogram(name, help_, labelnames, buckets)
+    with __lock:
+        __metrics.append(metric)
+    return metric
+
+def add_collector(prefix: str, stats, counters: tuple = ()) -> None:
+    """
+        Export a stats() dict when scraped, ex: the connection pool's. Every
+    number becomes a gauge "<prefix>_<key>" (a counter "<prefix>_<key>_total"
+    if its key is in counters), a dict of numbers becomes one metric labelled
+    by its keys.
+    Adding a prefix again replaces it.
+
+    Args:
+        prefix (str): Metric name prefix, ex: "api_db_pool"
+        stats (callable): Returns the dict
+        counters (tuple, optional): Keys that only go up. Defaults to ().
+    """
+    with __lock:
+        __collectors[prefix] = (stats, counters)
+
+def __render_counter(metric: Counter) -> list:
+    """
+    Render a counter
+
+    Args:
+        metric (Counter): The counter
+
+    Returns:
+        list: Lines of the text format
+    """
+    lines = [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} counter"]
+    for labels, value in metric.collect():
+        lines.append(f"{metric.name}{__labels(metric.labelnames, labels)} {__number(value)}")
+    return lines
+
+def __render_histogram(metric: Histogram) -> list:
+    """
+    Render a histogram, with cumulative buckets
+
+    Args:
+        metric (Histogram): The histogram
+
+    Returns:
+        list: Lines of the text format
+    """
+    lines = [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} histogram"]
+    for labels, values in metric.collect():
+        total = 0
+        for bound, count in zip(metric.buckets + (float("inf"), ), values):
+            total += count
+            le = f'le="{__number(bound)}"'
+            lines.append(f"{metric.name}_bucket{__labels(metric.labelnames, labels, le)} {total}")
+        lines.append(f"{metric.name}_sum{__labels(metric.labelnames, labels)} {__number(values[-1])}")
+        lines.append(f"{metric.name}_count{__labels(metric.labelnames, labels)} {total}")
+    return lines
+
+def render() -> str:
+    """
+    Render every metric in the Prometheus text format
+
+    Returns:
+        str: The text to serve
+    """
+    with __lock:
+        metrics = list(__metrics)
+        collectors = list(__collectors.items())
+
+    lines = []
+    for metric in metrics:
+        if isinstance(metric, Histogram):
+            lines.extend(__render_histogram(metric))
+        else:
+            lines.extend(__render_counter(metric))
+    for prefix, (stats, counters) in collectors:
+        try:
+            values = stats()
+        except Exception:
+            continue
+        for key, value in sorted(values.items()):
+            kind = "counter" if key in counters else "gauge"
+            name = f"{prefix}_{key}_total" if kind == "counter" else f"{prefix}_{key}"
+            if isinstance(value, dict):
+                lines.append(f"# TYPE {name} {kind}")
+                for label, inner in sorted(value.items()):
+                    lines.append(f'{name}{{name="{__escape(label)}"}} {__number(inner)}')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {__number(value)}")
+    return "\n".join(lines) + "\n"
+
+REQUESTS = counter("api_requests_total", "Requests served", ("endpoint", "status"))
+REQUEST_LATENCY = histogram("api_request_seconds", "Time to answer a request", ("endpoint", ))
+STAGE_LATENCY = histogram("api_stage_seconds",
+    "Time spent per stage: connect (pool), query, format (fetch and format rows), "
+    "parse, cluster and hull (zone building)", ("stage", ))
+
+# EOF
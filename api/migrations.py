@@ -0,0 +1,258 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Versioned schema migrations, run them with migrate.py
+
+__author__ = 'David Pescariu'
+
+from datetime import datetime
+from time import sleep
+import utils.console_messages as msg
+import api.db_connector as db
+
+def __has_column(cursor, table: str, column: str) -> bool:
+    """
+    Check if a table has a column
+
+    Args:
+        cursor (mysql.connector.cursor): The mysql cursor
+        table (str): Table name
+        column (str): Column name
+
+    Returns:
+        bool: True / False
+    """
+    cursor.execute(
+        "select count(*) from information_schema.columns "
+        "where table_schema = database() and table_name = %s and column_name = %s;",
+        (table, column))
+    return cursor.fetchone()[0] > 0
+
+def __has_index(cursor, table: str, index: str) -> bool:
+    """
+    Check if a table has an index
+
+    Args:
+        cursor (mysql.connector.cursor): The mysql cursor
+        table (str): Table name
+        index (str): Index name
+
+    Returns:
+        bool: True / False
+    """
+    cursor.execute(
+        "select count(*) from information_schema.statistics "
+        "where table_schema = database() and table_name = %s and index_name = %s;",
+        (table, index))
+    return cursor.fetchone()[0] > 0
+
+def __column_type(cursor, table: str, column: str) -> str:
+    """
+    Get the type of a column
+
+    Args:
+        cursor (mysql.connector.cursor): The mysql cursor
+        table (str): Table name
+        column (str): Column name
+
+    Returns:
+        str: The data type, ex: "double"
+    """
+    cursor.execute(
+        "select data_type from information_schema.columns "
+        "where table_schema = database() and table_name = %s and column_name = %s;",
+        (table, column))
+    row = cursor.fetchone()
+    return str(row[0]).lower() if row else ""
+
+def __backfill(cnx, cursor, query: str, chunk_size: int, pause: float, label: str) -> int:
+    """
+        Run an update limited to chunk_size rows until it stops matching rows,
+    committing after every chunk so no lock is held for long
+
+    Args:
+        cnx (mysql.connector.connection): The mysql connection
+        cursor (mysql.connector.cursor): The mysql cursor
+        query (str): The update, must end with "limit %s" and stop matching the rows it updated
+        chunk_size (int): Rows per chunk
+        pause (float): Seconds to sleep between chunks
+        label (str): Shown in the progress messages
+
+    Returns:
+        int: Number of updated rows
+    """
+    updated = 0
+    while True:
+        cursor.execute(query, (chunk_size, ))
+        cnx.commit()
+        updated += cursor.rowcount
+        if cursor.rowcount < chunk_size:
+            break
+        msg.info(f"[MIGRATE] {label}: {updated} rows backfilled")
+        if pause > 0:
+            sleep(pause)
+    msg.info(f"[MIGRATE] {label}: done, {updated} rows backfilled")
+    return updated
+
+def __migration_1(cnx, cursor, chunk_size: int, pause: float) -> None:
+    """
+        Integer cell columns for marker_data and zone_data, replacing the
+    ambiguous zone string, plus the indexes the queries need. The columns and
+    indexes are added online, the existing rows are backfilled in chunks.
+
+    Args:
+        cnx (mysql.connector.connection): The mysql connection
+        cursor (mysql.connector.cursor): The mysql cursor
+        chunk_size (int): Rows backfilled per transaction
+        pause (float): Seconds to sleep between chunks
+    """
+    for table in ("marker_data", "zone_data"):
+        if not __has_column(cursor, table, "celllat"):
+            cursor.execute(
+                f"alter table {table} "
+                "add column celllat smallint null, add column celllong smallint null, "
+                "algorithm=inplace, lock=none;")
+
+    indexes = (
+        ("marker_data", "marker_cell_time", "celllat, celllong, submitdate, submittime"),
+        ("marker_data", "marker_coords", "exactlat, exactlong"),
+        ("zone_data", "zone_cell", "celllat, celllong, type"),
+    )
+    for table, index, columns in indexes:
+        if not __has_index(cursor, table, index):
+            cursor.execute(f"create index {index} on {table} ({columns}) algorithm=inplace lock=none;")
+
+    __backfill(cnx, cursor,
+        "update marker_data "
+        "set celllat = truncate(exactlat, 0), celllong = truncate(exactlong, 0) "
+        "where celllat is null and exactlat is not null and exactlong is not null "
+        "limit %s;",
+        chunk_size, pause, "marker_data")
+
+    # The cell of a zone is the one of its first point, like add_zone does
+    __backfill(cnx, cursor,
+        "update zone_data "
+        "set celllat = truncate(substring_index(substring_index(coords, ',', 1), '@', 1), 0), "
+        "celllong = truncate(substring_index(substring_index(coords, ',', 1), '@', -1), 0) "
+        "where celllat is null and coords like '%%@%%' "
+        "limit %s;",
+        chunk_size, pause, "zone_data")
+
+    for column in ("exactlat", "exactlong"):
+        if __column_type(cursor, "marker_data", column) == "float":
+            msg.fail(f"[MIGRATE] marker_data.{column} is a single precision float, "
+                "deleting markers by their exact coords needs double or decimal")
+
+def __migration_2(cnx, cursor, chunk_size: int, pause: float) -> None:
+    """
+        Auto increment id primary key for marker_data, so it can be paged by
+    keyset. Adding it rebuilds the table, reads keep working but writes wait
+    for the rebuild (LOCK=SHARED), run it off-peak on big tables.
+
+    Args:
+        cnx (mysql.connector.connection): The mysql connection
+        cursor (mysql.connector.cursor): The mysql cursor
+        chunk_size (int): Unused, ids are assigned by the rebuild
+        pause (float): Unused
+    """
+    if not __has_column(cursor, "marker_data", "id"):
+        msg.info("[MIGRATE] marker_data: adding the id column, this rebuilds the table")
+        cursor.execute(
+            "alter table marker_data "
+            "add column id bigint unsigned not null auto_increment primary key first, "
+            "algorithm=inplace, lock=shared;")
+
+def __migration_3(cnx, cursor, chunk_size: int, pause: float) -> None:
+    """
+        change_log table for /sync, every marker / zone write appends to it,
+    and the change_lock row that every write locks for its change_log insert,
+    so the change_log seqs grow in commit order. New tables only, nothing is backfilled: clients
+    start from a snapshot.
+
+    Args:
+        cnx (mysql.connector.connection): The mysql connection
+        cursor (mysql.connector.cursor): The mysql cursor
+        chunk_size (int): Unused
+        pause (float): Unused
+    """
+    cursor.execute(
+        "create table if not exists change_log ("
+        "seq bigint unsigned not null auto_increment primary key, "
+        "celllat smallint not null, celllong smallint not null, "
+        "kind varchar(8) not null, op varchar(8) not null, "
+        "exactlat double null, exactlong double null, type varchar(32) null, coords text null, "
+        "submitdate date null, submittime time null, "
+        "index change_cell (celllat, celllong, seq));")
+    cursor.execute("create table if not exists change_lock (id tinyint unsigned not null primary key);")
+    cursor.execute("insert ignore into change_lock (id) values (1);")
+
+# (version, description, function(cnx, cursor, chunk_size, pause)), append only
+MIGRATIONS = [
+    (1, "Integer cell columns and indexes for marker_data / zone_data", __migration_1),
+    (2, "Auto increment id primary key for marker_data", __migration_2),
+    (3, "change_log / change_lock tables for /sync", __migration_3),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(config) -> int:
+    """
+    Get the version the database schema was migrated to
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        int: The version, 0 if it was never migrated
+    """
+    cnx = db.open_connection(config)
+    try:
+        cursor = cnx.cursor()
+        cursor.execute(
+            "select count(*) from information_schema.tables "
+            "where table_schema = database() and table_name = 'schema_version';")
+        if cursor.fetchone()[0] == 0:
+            return 0
+        cursor.execute("select coalesce(max(version), 0) from schema_version;")
+        return int(cursor.fetchone()[0])
+    finally:
+        cnx.close()
+
+def migrate(config, chunk_size: int = 5000, pause: float = 0.0) -> int:
+    """
+    Apply every migration newer than the current schema version, in order
+
+    Args:
+        config (models.Config): Config instance
+        chunk_size (int, optional): Rows backfilled per transaction. Defaults to 5000.
+        pause (float, optional): Seconds to sleep between chunks. Defaults to 0.
+
+    Returns:
+        int: The schema version after migrating
+    """
+    version = current_version(config)
+    cnx = db.open_connection(config)
+    try:
+        cursor = cnx.cursor()
+        cursor.execute(
+            "create table if not exists schema_version ("
+            "version int not null primary key, "
+            "description varchar(255) not null, "
+            "applied_at datetime not null);")
+
+        for (number, description, function) in MIGRATIONS:
+            if number <= version:
+                continue
+            msg.info(f"[MIGRATE] Applying {number}: {description}")
+            function(cnx, cursor, chunk_size, pause)
+            cursor.execute(
+                "insert into schema_version (version, description, applied_at) values (%s, %s, %s);",
+                (number, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            cnx.commit()
+            version = number
+            msg.ok(f"[MIGRATE] Schema is at version {version}")
+        return version
+    finally:
+        cnx.close()
+
+# EOF
@@ -0,0 +1,336 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Pre-fork serving (serve_workers > 1): the supervisor binds the listening
+# socket and forks the workers that serve on it, so zones are built on every
+# core instead of one GIL. Every worker has its own connection pool and cache,
+# the write events are relayed between them by the supervisor so caches and
+# the zone scheduler (worker 0 only) see every write. ETags come from the
+# change log, so every worker gives the same tags.
+
+__author__ = 'David Pescariu'
+
+import json
+import os
+import selectors
+import signal
+import socket
+import threading
+from time import monotonic, sleep
+from waitress.server import create_server
+import utils.console_messages as msg
+import api.db_connector as db
+import api.events as events
+import api.push as push
+import api.zone_scheduler as zone_scheduler
+import api.write_behind as write_behind
+import api.public_snapshot as public_snapshot
+from log.logger import initialize_logging, stop_logging
+
+def worker_count(config) -> int:
+    """
+    Get the number of worker processes to serve with
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        int: serve_workers, one per core if it's 0, always 1 where fork() isn't available
+    """
+    if not hasattr(os, "fork"):
+        return 1
+    if config.SERVE_WORKERS == 0:
+        return os.cpu_count() or 1
+    return max(1, config.SERVE_WORKERS)
+
+class Worker:
+    """
+        A worker process, serves on the inherited socket until SIGTERM, then
+    stops accepting and exits once the open connections are done, or after
+    drain_timeout seconds
+
+    Params:
+        config (models.Config): Config instance
+        index (int): Number of the worker, 0 also runs the zone scheduler
+        listener (socket.socket): The listening socket
+        channel (socket.socket): Connection to the supervisor, for the events
+    """
+    def __init__(self, config, index: int, listener: socket.socket, channel: socket.socket) -> None:
+        self.config = config
+        self.index = index
+        self.listener = listener
+        self.channel = channel
+        self.__send_lock = threading.Lock()
+        self.__server = None
+
+    def run(self) -> None:
+        """
+        Serve until stopped
+        """
+        # The writer thread of the supervisor's logging didn't survive the fork
+        initialize_logging(self.config, worker=self.index)
+        signal.signal(signal.SIGTERM, self.__on_sigterm)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        events.set_forwarder(self.__forward)
+        threading.Thread(target=self.__receive, name="prefork-events", daemon=True).start()
+        if self.index == 0:
+            zone_scheduler.start(self.config)
+        write_behind.start(self.config, worker=self.index)
+        # Every worker serves /public from its own copy
+        public_snapshot.start(self.config)
+
+        try:
+            if self.config.SERVE_MODE == "asgi":
+                # uvicorn drains on SIGTERM by itself
+                import api.serve_asgi as asgi
+                asgi.start_serving(self.config, sockets=[self.listener])
+            else:
+                import api.serve_api as serve_api
+                self.__server = create_server(
+                    serve_api.create_app(self.config),
+                    sockets=[self.listener],
+                    threads=self.config.SERVE_THREADS)
+                self.__server.run()
+        finally:
+            zone_scheduler.stop()
+            public_snapshot.stop()
+            # Its events still have to reach the other workers
+            write_behind.stop()
+            events.set_forwarder(None)
+            db.close_pool()
+
+    def __on_sigterm(self, signum, frame) -> None:
+        """
+        Stop accepting connections and drain the open ones
+        """
+        if self.__server is None:
+            raise KeyboardInterrupt
+        self.__server.accepting = False
+        # Subscriptions never end by themselves
+        push.close()
+        threading.Thread(target=self.__drain, name="prefork-drain", daemon=True).start()
+
+    def __drain(self) -> None:
+        """
+        Wait for the open connections to be done, then stop the server
+        """
+        deadline = monotonic() + self.config.DRAIN_TIMEOUT
+        while self.__server.active_channels and monotonic() < deadline:
+            sleep(0.1)
+        # Breaks the server loop in the main thread, like Ctrl-C
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def __forward(self, event: str, cell: tuple, data: dict) -> None:
+        """
+        events forwarder, sends the events published in this worker to the supervisor
+
+        Args:
+            event (str): Event name, see api.events
+            cell (tuple): (lat, long) of the cell
+            data (dict): Event details
+        """
+        line = (json.dumps([event, cell, data]) + "\n").encode()
+        with self.__send_lock:
+            self.channel.sendall(line)
+
+    def __receive(self) -> None:
+        """
+        Publish the events of the other workers in this one, drain if the
+        supervisor is gone
+        """
+        for line in self.channel.makefile('rb'):
+            try:
+                event, cell, data = json.loads(line)
+                events.receive(event, cell, data)
+            except Exception as e:
+                msg.exception(e)
+
+        msg.fail(f"Worker {self.index} lost the supervisor, stopping")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+class Supervisor:
+    """
+        Forks the workers, restarts the ones that crash and relays the events
+    between them. On SIGTERM / Ctrl-C the workers are told to drain and the
+    ones still running after drain_timeout are killed.
+
+    Params:
+        config (models.Config): Config instance
+    """
+    def __init__(self, config) -> None:
+        self.config = config
+        self.workers = worker_count(config)
+        self.__listener = None
+        self.__selector = selectors.DefaultSelector()
+        self.__pids = {}      # pid -> index
+        self.__channels = {}  # index -> supervisor end of the worker's channel
+        self.__buffers = {}   # index -> partial line read from the worker
+        self.__started = {}   # index -> when it was last started
+        self.__stopping = False
+        self.__deadline = None
+
+    def run(self) -> None:
+        """
+        Serve until SIGTERM / Ctrl-C and every worker exited
+        """
+        self.__listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__listener.bind(("0.0.0.0", int(self.config.SERVE_PORT)))
+        self.__listener.listen(1024)
+        self.__listener.setblocking(False)
+
+        # DB connections must not be shared with the workers
+        db.close_pool()
+        signal.signal(signal.SIGTERM, self.__on_stop)
+        signal.signal(signal.SIGINT, self.__on_stop)
+
+        for index in range(self.workers):
+            self.__spawn(index)
+        msg.ok(f"Serving with {self.workers} worker processes")
+
+        while self.__pids:
+            for key, _ in self.__selector.select(timeout=0.5):
+                self.__relay(key.data)
+            self.__reap()
+            if self.__deadline is not None and monotonic() > self.__deadline:
+                for pid in self.__pids:
+                    self.__signal(pid, signal.SIGKILL)
+                self.__deadline = None
+
+        for index in list(self.__channels):
+            self.__close_channel(index)
+        self.__listener.close()
+
+    def __spawn(self, index: int) -> None:
+        """
+        Fork a worker
+
+        Args:
+            index (int): Number of the worker
+        """
+        parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for channel in self.__channels.values():
+                channel.close()
+            code = 0
+            try:
+                Worker(self.config, index, self.__listener, child_end).run()
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                msg.exception(e)
+                code = 1
+            finally:
+                stop_logging()
+                os._exit(code)
+
+        child_end.close()
+        self.__pids[pid] = index
+        self.__channels[index] = parent_end
+        self.__buffers[index] = b""
+        self.__started[index] = monotonic()
+        self.__selector.register(parent_end, selectors.EVENT_READ, index)
+
+    def __relay(self, index: int) -> None:
+        """
+        Send the events a worker published to every other worker
+
+        Args:
+            index (int): Number of the worker
+        """
+        try:
+            data = self.__channels[index].recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            self.__close_channel(index)
+            return
+
+        lines = (self.__buffers[index] + data).split(b"\n")
+        self.__buffers[index] = lines.pop()
+        if not lines:
+            return
+        payload = b"".join(line + b"\n" for line in lines)
+        for other, channel in list(self.__channels.items()):
+            if other == index:
+                continue
+            try:
+                channel.sendall(payload)
+            except OSError:
+                self.__close_channel(other)
+
+    def __reap(self) -> None:
+        """
+        Collect the workers that exited, restarting them unless stopping
+        """
+        while self.__pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.__pids.clear()
+                return
+            if pid == 0:
+                return
+
+            index = self.__pids.pop(pid, None)
+            if index is None:
+                continue
+            self.__close_channel(index)
+            if self.__stopping:
+                continue
+
+            msg.fail(f"Worker {index} exited with status {status}, restarting")
+            # Don't spin if it crashes right away
+            if monotonic() - self.__started[index] < 1:
+                sleep(1)
+            self.__spawn(index)
+
+    def __close_channel(self, index: int) -> None:
+        """
+        Close the channel of a worker
+
+        Args:
+            index (int): Number of the worker
+        """
+        channel = self.__channels.pop(index, None)
+        if channel is not None:
+            self.__selector.unregister(channel)
+            channel.close()
+
+    def __on_stop(self, signum, frame) -> None:
+        """
+        Tell every worker to drain
+        """
+        if self.__stopping:
+            return
+        self.__stopping = True
+        self.__deadline = monotonic() + self.config.DRAIN_TIMEOUT + 5
+        msg.info(f"Draining {len(self.__pids)} workers")
+        for pid in self.__pids:
+            self.__signal(pid, signal.SIGTERM)
+
+    def __signal(self, pid: int, signum: int) -> None:
+        """
+        Signal a worker, ignoring the ones that already exited
+
+        Args:
+            pid (int): The worker's pid
+            signum (int): The signal
+        """
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+def serve(config) -> None:
+    """
+    Serve with worker processes, returns once they all exited
+
+    Args:
+        config (models.Config): Config instance
+    """
+    Supervisor(config).run()
+
+# EOF
@@ -0,0 +1,260 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Precomputed /public response: the number of markers of each type and the
+# generated zones of every cell, without any exact coords, dates or times.
+# A background thread rebuilds it every public_update_delay seconds, if
+# something was written since, and keeps it serialized and gzipped, so a
+# public request only copies bytes and never reaches the database or the
+# zone builder.
+#
+# Anonymised: cells with fewer than public_min_markers markers are left out
+# and the zone corners, which are the coords of markers, are rounded to
+# COORDS_DECIMALS. Every worker process builds its own.
+
+__author__ = 'David Pescariu'
+
+import gzip
+import hashlib
+import json
+import threading
+from datetime import datetime
+from time import monotonic, perf_counter
+import utils.console_messages as msg
+import api.db_connector as db
+
+# About 110m, no zone corner points at a single marker
+COORDS_DECIMALS = 3
+
+class Snapshot:
+    """
+    A built /public response, never modified once built
+
+    Params:
+        body (bytes): The JSON response
+        generated (str): When it was built, ex: "2021-02-01 12:00:00"
+        seq (int): Change log sequence number it was read at
+    """
+    __slots__ = ("body", "gzipped", "etag", "generated", "seq")
+
+    def __init__(self, body: bytes, generated: str, seq: int) -> None:
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9)
+        self.etag = hashlib.sha1(body).hexdigest()[:16]
+        self.generated = generated
+        self.seq = seq
+
+    def respond(self, accept_encoding: str, not_modified: bool, max_age: int) -> tuple:
+        """
+        Pick what to send for a request, the same way for both serving modes
+
+        Args:
+            accept_encoding (str): Accept-Encoding header of the request, "" if there's none
+            not_modified (bool): The request's If-None-Match has the etag
+            max_age (int): Seconds the clients can cache it
+
+        Returns:
+            tuple: (status, body, headers)
+        """
+        headers = {
+            "Cache-Control": f"public, max-age={max_age}",
+            "ETag": f'"{self.etag}"',
+            "Vary": "Accept-Encoding"
+        }
+        if not_modified:
+            return 304, b"", headers
+
+        headers["Content-Type"] = "application/json"
+        # Tiny snapshots come out bigger
+        if accepts_gzip(accept_encoding) and len(self.gzipped) < len(self.body):
+            headers["Content-Encoding"] = "gzip"
+            return 200, self.gzipped, headers
+        return 200, self.body, headers
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Check if an Accept-Encoding header allows gzip
+
+    Args:
+        accept_encoding (str): The header, ex: "gzip, deflate, br;q=0.5"
+
+    Returns:
+        bool: True / False
+    """
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() not in ("gzip", "*"):
+            continue
+        try:
+            quality = float(params.strip()[2:]) if params.strip().startswith("q=") else 1.0
+        except ValueError:
+            quality = 1.0
+        return quality > 0
+    return False
+
+def build(config, seq: int) -> Snapshot:
+    """
+    Build the snapshot from the database
+
+    Args:
+        config (models.Config): Config instance
+        seq (int): Sequence number of the last change, read before calling it
+
+    Returns:
+        Snapshot: The snapshot
+    """
+    _, counts, zones = db.return_summary(config)
+
+    cells = []
+    for cell in sorted(counts):
+        types = counts[cell]
+        total = sum(types.values())
+        if total < config.PUBLIC_MIN_MARKERS:
+            continue
+        cells.append(dict(
+            lat=cell[0],
+            long=cell[1],
+            markers=total,
+            types={str(_type): count for _type, count in sorted(types.items(), key=lambda item: str(item[0]))},
+            zones=[
+                [[round(lat, COORDS_DECIMALS), round(long, COORDS_DECIMALS)] for (lat, long) in zone]
+                for zone in zones.get(cell, ())
+            ] if zones is not None else None
+        ))
+
+    generated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Laid out like serve_asgi.json_response
+    body = json.dumps(dict(data=dict(generated=generated, cells=cells)), sort_keys=True, separators=(",", ":")) + "\n"
+    return Snapshot(body.encode(), generated, seq)
+
+class SnapshotBuilder(threading.Thread):
+    """
+    Rebuilds the snapshot every public_update_delay seconds, only if the
+    change log moved since the last one
+
+    Params:
+        config (models.Config): Config instance
+    """
+    def __init__(self, config) -> None:
+        super().__init__(name="public-snapshot", daemon=True)
+        self.config = config
+        self.interval = config.PUBLIC_UPDATE_DELAY
+        self.snapshot = None
+        self.__stopped = threading.Event()
+        self.__lock = threading.Lock()
+
+        self.__builds = 0
+        self.__skipped = 0
+        self.__failed = 0
+        self.__build_seconds = 0.0
+        self.__built_at = None
+
+    def run(self) -> None:
+        """
+        Build the snapshot, then rebuild it every interval, until stopped
+        """
+        while not self.__stopped.is_set():
+            self.rebuild()
+            self.__stopped.wait(self.interval)
+
+    def rebuild(self) -> None:
+        """
+        Build a new snapshot if something was written since the current one,
+        keep serving the current one if it fails
+        """
+        try:
+            # Read before the summary, a write in between only rebuilds it once more
+            seq = db.return_last_change(self.config)
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.seq == seq:
+                with self.__lock:
+                    self.__skipped += 1
+                return
+
+            start = perf_counter()
+            self.snapshot = build(self.config, seq)
+            with self.__lock:
+                self.__builds += 1
+                self.__build_seconds = perf_counter() - start
+                self.__built_at = monotonic()
+        except Exception as e:
+            msg.exception(e, "public")
+            with self.__lock:
+                self.__failed += 1
+
+    def stop(self) -> None:
+        """
+        Stop after the snapshot being built, if any
+        """
+        self.__stopped.set()
+
+    def stats(self) -> dict:
+        """
+        Get the builder metrics
+
+        Returns:
+            dict: Builds, skipped / failed rebuilds, size and age of the snapshot...
+        """
+        snapshot = self.snapshot
+        with self.__lock:
+            return dict(
+                builds=self.__builds,
+                skipped=self.__skipped,
+                failed=self.__failed,
+                build_seconds=self.__build_seconds,
+                age_seconds=monotonic() - self.__built_at if self.__built_at is not None else 0.0,
+                bytes=len(snapshot.body) if snapshot is not None else 0,
+                gzipped_bytes=len(snapshot.gzipped) if snapshot is not None else 0
+            )
+
+__builder = None
+
+def start(config) -> None:
+    """
+    Start building the snapshot, if allow_public is enabled
+
+    Args:
+        config (models.Config): Config instance
+    """
+    global __builder
+
+    if config.ALLOW_PUBLIC and __builder is None:
+        __builder = SnapshotBuilder(config)
+        __builder.start()
+        msg.info(f"Public snapshot started, rebuilding every {config.PUBLIC_UPDATE_DELAY}s", "public")
+
+def stop() -> None:
+    """
+    Stop building the snapshot, if it was started
+    """
+    global __builder
+
+    if __builder is not None:
+        __builder.stop()
+        __builder = None
+
+def get() -> Snapshot or None:
+    """
+    Get the current snapshot
+
+    Returns:
+        Snapshot or None: The snapshot, None until the first one is built
+    """
+    builder = __builder
+    if builder is None:
+        return None
+    return builder.snapshot
+
+def stats() -> dict:
+    """
+    Get the builder metrics
+
+    Returns:
+        dict: See SnapshotBuilder.stats(), empty if it isn't running
+    """
+    builder = __builder
+    if builder is None:
+        return {}
+    return builder.stats()
+
+# EOF
@@ -0,0 +1,423 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Server-sent events for /subscribe: clients subscribe to some cells and get
+# the markers added / deleted and the zones stored in them as they are
+# written. One hub per process listens to the write events (the other
+# workers' ones included), encodes each event once and queues the same bytes
+# for every subscriber of the cell, no subscriber ever reads the database.
+#
+# An idle subscription is a queue and a parked coroutine in serve_mode
+# "asgi". With waitress it holds a serving thread, so only serve_threads - 1
+# are accepted there.
+
+__author__ = 'David Pescariu'
+
+import asyncio
+import json
+import threading
+from collections import deque
+import api.events as events
+
+MIME_TYPE = "text/event-stream"
+HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# First frame of a stream, clients reconnect after retry ms if it's cut
+OPENED = b"retry: 5000\n\n"
+# Sent after push_heartbeat seconds without events, so proxies and dead clients are noticed
+HEARTBEAT = b": ping\n\n"
+# Last frame for a subscriber that fell push_max_queued events behind, it has to /sync
+RESYNC = b"event: resync\ndata: {}\n\n"
+
+class Subscriber:
+    """
+        A client's subscription, the hub queues frames that its connection
+    sends. Frames are queued from the loop of the connection (asyncio) or
+    from any thread (waitress, loop is None).
+
+    Params:
+        cells (list): (lat, long) of the cells
+        max_queued (int): Frames queued before it's dropped
+        loop (asyncio.AbstractEventLoop, optional): Loop of the connection. Defaults to None.
+    """
+    __slots__ = ("cells", "max_queued", "loop", "frames", "wake", "overflowed", "closed")
+
+    def __init__(self, cells: list, max_queued: int, loop=None) -> None:
+        self.cells = cells
+        self.max_queued = max_queued
+        self.loop = loop
+        self.frames = deque()
+        self.wake = asyncio.Event() if loop is not None else threading.Event()
+        self.overflowed = False
+        self.closed = False
+
+    def push(self, frame: bytes) -> bool:
+        """
+        Queue a frame
+
+        Args:
+            frame (bytes): The SSE frame
+
+        Returns:
+            bool: False if the queue was full and the subscriber is dropped
+        """
+        if self.overflowed or self.closed:
+            return True
+        if len(self.frames) >= self.max_queued:
+            self.overflowed = True
+            self.frames.clear()
+            self.wake.set()
+            return False
+        self.frames.append(frame)
+        self.wake.set()
+        return True
+
+    def close(self) -> None:
+        """
+        End the stream after the queued frames
+        """
+        self.closed = True
+        self.wake.set()
+
+    def wait(self, timeout: float) -> list:
+        """
+        Wait for frames, from the connection's thread
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            list: The queued frames, empty on timeout
+        """
+        # Cleared before taking the frames, so a frame queued in between still wakes it
+        self.wake.clear()
+        frames = self.__take()
+        if not frames and not self.overflowed and not self.closed:
+            self.wake.wait(timeout)
+            frames = self.__take()
+        return frames
+
+    async def wait_async(self, timeout: float) -> list:
+        """
+        Wait for frames, from the connection's loop
+
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            list: The queued frames, empty on timeout
+        """
+        self.wake.clear()
+        frames = self.__take()
+        if not frames and not self.overflowed and not self.closed:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            frames = self.__take()
+        return frames
+
+    def __take(self) -> list:
+        """
+        Dequeue every queued frame, safe against a thread queueing more
+
+        Returns:
+            list: The frames
+        """
+        frames = []
+        while self.frames:
+            frames.append(self.frames.popleft())
+        return frames
+
+class PushHub:
+    """
+    Fans the write events out to the subscribers of their cell
+
+    Params:
+        max_subscribers (int): Subscribers accepted at once
+        max_queued (int): Frames queued per subscriber before it's dropped
+    """
+    def __init__(self, max_subscribers: int, max_queued: int) -> None:
+        self.max_subscribers = max_subscribers
+        self.max_queued = max_queued
+        self.__lock = threading.Lock()
+        self.__cells = {}  # (cell_lat, cell_long) -> set of Subscriber
+        self.__subscribers = set()
+        self.__closed = False
+
+        self.__events = 0
+        self.__delivered = 0
+        self.__dropped = 0
+        self.__rejected = 0
+
+    def subscribe(self, cells: list, loop=None) -> Subscriber or None:
+        """
+        Subscribe to some cells
+
+        Args:
+            cells (list): (lat, long) of the cells
+            loop (asyncio.AbstractEventLoop, optional): Loop of the connection, None for a thread. Defaults to None.
+
+        Returns:
+            Subscriber or None: The subscription, None if there are max_subscribers already
+        """
+        subscriber = Subscriber(cells, self.max_queued, loop)
+        with self.__lock:
+            if self.__closed or len(self.__subscribers) >= self.max_subscribers:
+                self.__rejected += 1
+                return None
+            self.__subscribers.add(subscriber)
+            for cell in cells:
+                self.__cells.setdefault(cell, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """
+        Remove a subscription, once its connection is done
+
+        Args:
+            subscriber (Subscriber): The subscription
+        """
+        with self.__lock:
+            self.__subscribers.discard(subscriber)
+            for cell in subscriber.cells:
+                subscribers = self.__cells.get(cell)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.__cells[cell]
+
+    def close(self) -> None:
+        """
+        End every stream and refuse new subscriptions, so a drain doesn't wait for them
+        """
+        with self.__lock:
+            self.__closed = True
+            subscribers = list(self.__subscribers)
+        for subscriber in subscribers:
+            if subscriber.loop is None:
+                subscriber.close()
+            else:
+                self.__call_soon(subscriber.loop, subscriber.close)
+
+    def on_write(self, event: str, cell: tuple, data: dict) -> None:
+        """
+        events listener, queues the event for the subscribers of its cell
+        """
+        with self.__lock:
+            subscribers = self.__cells.get(cell)
+            if not subscribers:
+                return
+            subscribers = list(subscribers)
+
+        frame = encode(event, cell, data)
+        if frame is None:
+            return
+
+        # One call per loop, not per subscriber, the loop fans it out itself
+        loops = {}
+        dropped = 0
+        for subscriber in subscribers:
+            if subscriber.loop is None:
+                dropped += not subscriber.push(frame)
+            else:
+                loops.setdefault(subscriber.loop, []).append(subscriber)
+        for loop, loop_subscribers in loops.items():
+            self.__call_soon(loop, self.__deliver, frame, loop_subscribers)
+
+        with self.__lock:
+            self.__events += 1
+            self.__delivered += len(subscribers)
+            self.__dropped += dropped
+
+    def stats(self) -> dict:
+        """
+        Get the hub metrics
+
+        Returns:
+            dict: Subscribers, subscribed cells, events, frames delivered...
+        """
+        with self.__lock:
+            return dict(
+                subscribers=len(self.__subscribers),
+                cells=len(self.__cells),
+                max_subscribers=self.max_subscribers,
+                events=self.__events,
+                delivered=self.__delivered,
+                dropped=self.__dropped,
+                rejected=self.__rejected
+            )
+
+    def __deliver(self, frame: bytes, subscribers: list) -> None:
+        """
+        Queue a frame for the subscribers of a loop, runs in that loop
+
+        Args:
+            frame (bytes): The SSE frame
+            subscribers (list): The subscribers
+        """
+        dropped = 0
+        for subscriber in subscribers:
+            dropped += not subscriber.push(frame)
+        if dropped:
+            with self.__lock:
+                self.__dropped += dropped
+
+    @staticmethod
+    def __call_soon(loop, callback, *args) -> None:
+        """
+        Run a callback in a loop, from any thread
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The loop
+            callback (callable): The callback
+        """
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop is closed, its subscribers are gone with it
+            pass
+
+def encode(event: str, cell: tuple, data: dict) -> bytes or None:
+    """
+    Encode a write event as an SSE frame, markers in the format of
+    /get_markers and zones in the one of /get_zones
+
+    Args:
+        event (str): One of the api.events constants
+        cell (tuple): (lat, long) of the cell
+        data (dict): Event details
+
+    Returns:
+        bytes or None: The frame, None for the events that aren't pushed
+    """
+    if event == events.MARKER_ADDED:
+        payload = dict(cell=cell,
+            marker=f"{data['lat']}&{data['long']}&{data['type']}&{data.get('date')}&{data.get('time')}")
+    elif event == events.MARKERS_DELETED:
+        payload = dict(cell=cell, lat=data['lat'], long=data['long'])
+    elif event == events.ZONES_STORED and "coords" in data:
+        # Every generated zone of the cell, they replace the previous ones
+        payload = dict(cell=cell, zones=[__parse_coords(coords) for coords in data['coords']])
+    else:
+        return None
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
+
+def __parse_coords(coords: str) -> list:
+    """
+    Parse stored zone coords, like db_connector.parse_coords
+
+    Args:
+        coords (str): Format is lat1@long1,lat2@long2,...
+
+    Returns:
+        list: The zone, as a list of [lat, long]
+    """
+    return [[float(value) for value in point.split('@')] for point in coords.split(',')]
+
+def stream(hub: PushHub, subscriber: Subscriber, heartbeat: float):
+    """
+    The frames of a subscription, for a thread serving it
+
+    Args:
+        hub (PushHub): The hub
+        subscriber (Subscriber): The subscription
+        heartbeat (float): Seconds between heartbeats
+
+    Yields:
+        bytes: The frames
+    """
+    try:
+        yield OPENED
+        while True:
+            frames = subscriber.wait(heartbeat)
+            if subscriber.overflowed:
+                yield RESYNC
+                return
+            if frames:
+                yield b"".join(frames)
+            elif subscriber.closed:
+                return
+            else:
+                yield HEARTBEAT
+    finally:
+        hub.unsubscribe(subscriber)
+
+async def stream_async(hub: PushHub, subscriber: Subscriber, heartbeat: float):
+    """
+    The frames of a subscription, for a coroutine serving it
+
+    Args:
+        hub (PushHub): The hub
+        subscriber (Subscriber): The subscription
+        heartbeat (float): Seconds between heartbeats
+
+    Yields:
+        bytes: The frames
+    """
+    try:
+        yield OPENED
+        while True:
+            frames = await subscriber.wait_async(heartbeat)
+            if subscriber.overflowed:
+                yield RESYNC
+                return
+            if frames:
+                yield b"".join(frames)
+            elif subscriber.closed:
+                return
+            else:
+                yield HEARTBEAT
+    finally:
+        hub.unsubscribe(subscriber)
+
+__hub = None
+__hub_lock = threading.Lock()
+
+def get_hub(config) -> PushHub or None:
+    """
+    Get the push hub, creating it on first use
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        PushHub or None: The hub, None if push_enabled is false
+    """
+    global __hub
+
+    if not config.PUSH_ENABLED:
+        return None
+    if __hub is None:
+        with __hub_lock:
+            if __hub is None:
+                max_subscribers = config.PUSH_MAX_SUBSCRIBERS
+                if config.SERVE_MODE != "asgi":
+                    # Every subscriber holds a waitress thread, keep one for the requests
+                    max_subscribers = min(max_subscribers, max(0, config.SERVE_THREADS - 1))
+                __hub = PushHub(max_subscribers, config.PUSH_MAX_QUEUED)
+                events.subscribe(__hub.on_write)
+    return __hub
+
+def close() -> None:
+    """
+    End the open subscriptions, if the hub was created
+    """
+    hub = __hub
+    if hub is not None:
+        hub.close()
+
+def stats() -> dict:
+    """
+    Get the hub metrics
+
+    Returns:
+        dict: See PushHub.stats(), empty if it wasn't created
+    """
+    hub = __hub
+    if hub is None:
+        return {}
+    return hub.stats()
+
+# EOF
@@ -0,0 +1,315 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Keeps every marker in memory in front of the storage backend, so reads never
+# reach the database (read_store_enabled). Markers are loaded on start and
+# indexed per cell, sorted by lat. Writes go to the backend first and to the
+# index only once they're committed. The writes of other worker processes
+# arrive as events, and every read_store_reconcile_interval seconds each cell
+# is reloaded from the backend to fix whatever drifted.
+
+__author__ = 'David Pescariu'
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from time import perf_counter
+import utils.console_messages as msg
+from api.storage import Storage
+import api.events as events
+
+class CellMarkers:
+    """
+        The markers of one cell, sorted by lat, with their lats in a separate
+    array to bisect. Never modified once built, a write builds a new one, so
+    readers don't need a lock.
+
+    Params:
+        rows (list): (exact_lat, exact_long, type, date, time) rows, in any order
+        lats (array, optional): Their lats, if the rows are already sorted. Defaults to None.
+    """
+    __slots__ = ("lats", "rows")
+
+    def __init__(self, rows: list, lats: array = None) -> None:
+        if lats is None:
+            rows = sorted(rows, key=lambda row: float(row[0]))
+            lats = array('d', (float(row[0]) for row in rows))
+        self.rows = tuple(rows)
+        self.lats = lats
+
+    def add(self, rows: list) -> "CellMarkers":
+        """
+        Get a copy with more markers
+
+        Args:
+            rows (list): The rows to add
+
+        Returns:
+            CellMarkers: The copy
+        """
+        merged, lats = list(self.rows), array('d', self.lats)
+        for row in rows:
+            index = bisect_right(lats, float(row[0]))
+            merged.insert(index, row)
+            lats.insert(index, float(row[0]))
+        return CellMarkers(merged, lats)
+
+    def remove(self, exact_lat: float, exact_long: float) -> "CellMarkers":
+        """
+        Get a copy without the markers at exact coords
+
+        Args:
+            exact_lat (float): The exact lat of the marker(s)
+            exact_long (float): The exact long of the marker(s)
+
+        Returns:
+            CellMarkers: The copy
+        """
+        start, end = bisect_left(self.lats, exact_lat), bisect_right(self.lats, exact_lat)
+        kept = [row for row in self.rows[start:end] if float(row[1]) != exact_long]
+        return CellMarkers(
+            self.rows[:start] + tuple(kept) + self.rows[end:],
+            self.lats[:start] + array('d', (float(row[0]) for row in kept)) + self.lats[end:])
+
+    def in_box(self, min_lat: float, min_long: float, max_lat: float, max_long: float) -> list:
+        """
+        Get the markers inside a bounding box
+
+        Args:
+            min_lat (float): South edge
+            min_long (float): West edge
+            max_lat (float): North edge
+            max_long (float): East edge
+
+        Returns:
+            list: The rows
+        """
+        start, end = bisect_left(self.lats, min_lat), bisect_right(self.lats, max_lat)
+        return [row for row in self.rows[start:end] if min_long <= float(row[1]) <= max_long]
+
+    def key(self) -> Counter:
+        """
+        Get what is compared to find drift
+
+        Returns:
+            Counter: (lat, long, type) -> count
+        """
+        return Counter((float(row[0]), float(row[1]), row[2]) for row in self.rows)
+
+class ReadStore(Storage):
+    """
+        Serves the marker reads of a backend from memory, zones are passed
+    through. The markers are loaded when it's created.
+
+    Params:
+        backend (Storage): The backend, written through
+        config (models.Config): Config instance
+    """
+    def __init__(self, backend: Storage, config) -> None:
+        self.backend = backend
+        self.interval = config.READ_STORE_RECONCILE_INTERVAL
+        self.__cells = {}  # (cell_lat, cell_long) -> CellMarkers
+        # Held by writes and reloads, so the index changes in the order the backend committed
+        self.__write_lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+        self.__reconciles = 0
+        self.__drifted_cells = 0
+
+        start = perf_counter()
+        self.reconcile()
+        self.load_seconds = perf_counter() - start
+        self.__reconciles = self.__drifted_cells = 0
+        msg.info(f"[READ_STORE] Loaded {self.__count()} markers in {len(self.__cells)} cells "
+                 f"in {self.load_seconds:.2f}s")
+
+        events.subscribe(self.__on_remote_write, local=False)
+        self.__thread = None
+        if self.interval > 0:
+            self.__thread = threading.Thread(target=self.__reconcile_loop, name="read-store", daemon=True)
+            self.__thread.start()
+
+    def markers(self, cell_lat: int, cell_long: int) -> list:
+        cell = self.__cells.get((cell_lat, cell_long))
+        return cell.rows if cell is not None else ()
+
+    def iter_markers(self, cell_lat: int, cell_long: int, chunk_size: int):
+        rows = self.markers(cell_lat, cell_long)
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def markers_in_cells(self, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+        rows = []
+        # One lookup per cell of the range, it's capped at bbox_max_cells by the handlers
+        for cell_lat in range(min_cell[0], max_cell[0] + 1):
+            for cell_long in range(min_cell[1], max_cell[1] + 1):
+                cell = self.__cells.get((cell_lat, cell_long))
+                if cell is None:
+                    continue
+                if bbox is None:
+                    rows.extend(cell.rows)
+                else:
+                    rows.extend(cell.in_box(*bbox))
+        return rows
+
+    def add_markers(self, rows: list) -> None:
+        with self.__write_lock:
+            self.backend.add_markers(rows)
+            self.__add(rows)
+
+    def del_markers(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        with self.__write_lock:
+            self.backend.del_markers(cell_lat, cell_long, exact_lat, exact_long)
+            self.__remove(cell_lat, cell_long, exact_lat, exact_long)
+
+    def cells(self) -> list:
+        return list(self.__cells)
+
+    def zones(self, cell_lat: int, cell_long: int, _type: int) -> list:
+        return self.backend.zones(cell_lat, cell_long, _type)
+
+    def replace_zones(self, cell_lat: int, cell_long: int, _type: int,
+                      coords: list, date: str, time: str) -> None:
+        self.backend.replace_zones(cell_lat, cell_long, _type, coords, date, time)
+
+    def add_zone(self, cell_lat: int, cell_long: int, _type: int,
+                 coords: str, date: str, time: str) -> None:
+        self.backend.add_zone(cell_lat, cell_long, _type, coords, date, time)
+
+    def del_zone(self, cell_lat: int, cell_long: int, coords: str) -> None:
+        self.backend.del_zone(cell_lat, cell_long, coords)
+
+    def changes(self, cells: list, since: int, limit: int) -> list:
+        return self.backend.changes(cells, since, limit)
+
+    def change_range(self) -> tuple:
+        return self.backend.change_range()
+
+    def prune_changes(self, keep: int) -> None:
+        self.backend.prune_changes(keep)
+
+    def cell_seq(self, cell_lat: int, cell_long: int) -> int:
+        # From the backend, it also counts the writes of other processes
+        return self.backend.cell_seq(cell_lat, cell_long)
+
+    def snapshot(self, cells: list, zone_type: int) -> tuple:
+        # From the backend, the sequence number has to match the rows
+        return self.backend.snapshot(cells, zone_type)
+
+    def summary(self, zone_type: int) -> tuple:
+        return self.backend.summary(zone_type)
+
+    def reconcile(self) -> int:
+        """
+        Reload every cell from the backend, one at a time so writes only wait
+        for one cell
+
+        Returns:
+            int: Number of cells that didn't match the backend
+        """
+        drifted = 0
+        for cell in set(self.backend.cells()) | set(self.__cells):
+            if self.__stopped.is_set():
+                break
+            with self.__write_lock:
+                loaded = CellMarkers(self.backend.markers(*cell))
+                current = self.__cells.get(cell, CellMarkers(()))
+                if current.key() != loaded.key():
+                    drifted += 1
+                if loaded.rows:
+                    self.__cells[cell] = loaded
+                else:
+                    self.__cells.pop(cell, None)
+
+        self.__reconciles += 1
+        self.__drifted_cells += drifted
+        return drifted
+
+    def stats(self) -> dict:
+        stats = self.backend.stats()
+        stats.update(
+            read_store_cells=len(self.__cells),
+            read_store_markers=self.__count(),
+            read_store_reconciles=self.__reconciles,
+            read_store_drifted_cells=self.__drifted_cells)
+        return stats
+
+    def close(self) -> None:
+        self.__stopped.set()
+        events.unsubscribe(self.__on_remote_write)
+        if self.__thread is not None:
+            self.__thread.join()
+        self.backend.close()
+
+    def __count(self) -> int:
+        """
+        Count the markers in memory
+
+        Returns:
+            int: The count
+        """
+        return sum(len(cell.rows) for cell in list(self.__cells.values()))
+
+    def __add(self, rows: list) -> None:
+        """
+        Add written markers to the index, hold the write lock
+
+        Args:
+            rows (list): (cell_lat, cell_long, exact_lat, exact_long, type, date, time) rows
+        """
+        per_cell = {}
+        for (cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in rows:
+            per_cell.setdefault((cell_lat, cell_long), []).append((exact_lat, exact_long, _type, date, time))
+        for cell, cell_rows in per_cell.items():
+            current = self.__cells.get(cell)
+            self.__cells[cell] = current.add(cell_rows) if current is not None else CellMarkers(cell_rows)
+
+    def __remove(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        """
+        Remove deleted markers from the index, hold the write lock
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            exact_lat (float): The exact lat of the marker(s)
+            exact_long (float): The exact long of the marker(s)
+        """
+        current = self.__cells.get((cell_lat, cell_long))
+        if current is None:
+            return
+        updated = current.remove(exact_lat, exact_long)
+        if updated.rows:
+            self.__cells[(cell_lat, cell_long)] = updated
+        else:
+            del self.__cells[(cell_lat, cell_long)]
+
+    def __on_remote_write(self, event: str, cell: tuple, data: dict) -> None:
+        """
+        Apply the markers written by another worker process
+
+        Args:
+            event (str): Event name, see api.events
+            cell (tuple): (lat, long) of the cell
+            data (dict): Event details
+        """
+        with self.__write_lock:
+            if event == events.MARKER_ADDED:
+                self.__add([(cell[0], cell[1], data["lat"], data["long"], data["type"],
+                    data.get("date"), data.get("time"))])
+            elif event == events.MARKERS_DELETED:
+                self.__remove(cell[0], cell[1], data["lat"], data["long"])
+
+    def __reconcile_loop(self) -> None:
+        """
+        Reconcile every interval until closed
+        """
+        while not self.__stopped.wait(self.interval):
+            try:
+                drifted = self.reconcile()
+                if drifted:
+                    msg.info(f"[READ_STORE] Reconciled, {drifted} cells had drifted")
+            except Exception as e:
+                msg.exception(e)
+
+# EOF
@@ -3,9 +3,18 @@
 
 __author__ = 'David Pescariu'
 
+import json
 from datetime import datetime
 import utils.console_messages as msg
 import api.db_connector as db
+import api.limiter as limiter
+import api.metrics as metrics
+import api.public_snapshot as public_snapshot
+import api.push as push
+import api.versions as versions
+import api.wire as wire
+import api.write_behind as write_behind
+from api.cache import cached
 from models.types import TYPES
 
 def isValidKey(_type: str, key: str, config) -> bool:
@@ -25,25 +34,79 @@ def isValidKey(_type: str, key: str, config) -> bool:
             if config.PUBLIC_KEYS[key] == "valid":
                 return True 
             else:
-                msg.fail(f"Invalid key: {key}")
+                msg.fail(f"Invalid key: {key}", "auth")
                 return False
         except KeyError:
-            msg.fail(f"Non-existant key: {key}")
+            msg.fail(f"Non-existant key: {key}", "auth")
             return False
     elif _type == "private":
         try:
             if config.PRIVATE_KEYS[key] == "valid":
                 return True 
             else:
-                msg.fail(f"Invalid key: {key}")
+                msg.fail(f"Invalid key: {key}", "auth")
                 return False
         except KeyError:
-            msg.fail(f"Non-existant key: {key}")
+            msg.fail(f"Non-existant key: {key}", "auth")
             return False
     else:
-        msg.debug("In method isValidKey :: Invalid type of key")
+        msg.debug("In method isValidKey :: Invalid type of key", "auth")
         return False
 
+def parse_bbox(req, config) -> tuple or None:
+    """
+    Parse and check the bounding box of a request
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        tuple or None: (min_lat, min_long, max_lat, max_long), None if invalid or too big
+    """
+    try:
+        bbox = tuple(float(req.args.get(arg)) for arg in ('min_lat', 'min_long', 'max_lat', 'max_long'))
+    except (TypeError, ValueError):
+        return None
+
+    min_lat, min_long, max_lat, max_long = bbox
+    if min_lat > max_lat or min_long > max_long:
+        return None
+    if not (-90 <= min_lat and max_lat <= 90 and -180 <= min_long and max_long <= 180):
+        return None
+
+    cells = (int(max_lat) - int(min_lat) + 1) * (int(max_long) - int(min_long) + 1)
+    if cells > config.BBOX_MAX_CELLS:
+        return None
+    return bbox
+
+def parse_cells(req, config) -> list or None:
+    """
+    Parse and check the cell list of a request, cells=lat,long;lat,long;...
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        list or None: The (lat, long) cells without duplicates, None if invalid or too many
+    """
+    cells = []
+    try:
+        for cell in str(req.args.get('cells')).split(';'):
+            _lat, _long = cell.split(',')
+            cell = (int(float(_lat)), int(float(_long)))
+            if not (-90 <= cell[0] <= 90 and -180 <= cell[1] <= 180):
+                return None
+            if cell not in cells:
+                cells.append(cell)
+    except ValueError:
+        return None
+
+    if len(cells) > config.BBOX_MAX_CELLS:
+        return None
+    return cells
+
 ################################################################################
 ################################### PUBLIC #####################################
 ################################################################################
@@ -65,47 +128,140 @@ def handle_base(req) -> dict:
                 f"incoming_headers={req.headers}" 
         }
 
-def handle_public(req, config) -> dict:
+def handle_public(req, config) -> dict or public_snapshot.Snapshot:
     """
-    Handle the public request
+    Handle the public request, from the snapshot api/public_snapshot.py keeps
 
     Args:
         req (werkzeug.local.LocalProxy): Flask request
         config (models.Config): Config instance
 
     Returns:
-        dict: Response
+        dict or public_snapshot.Snapshot: Response if it failed, otherwise the snapshot to send
     """
     if not config.ALLOW_PUBLIC:
         return dict(UNAVAILABLE="PUBLIC_REQUESTS_NOT_AVAILABLE_AT_THIS_TIME")
 
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "public")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("public", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    snapshot = public_snapshot.get()
+    if snapshot is None:
+        # Not built yet, or the database was down since the start
+        return dict(UNAVAILABLE="PUBLIC_SNAPSHOT_NOT_AVAILABLE_AT_THIS_TIME")
+    return snapshot
+
+def handle_metrics(req, config) -> dict or str:
+    """
+    Handle the metrics request
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict or str: Response if the request failed, otherwise the metrics in the Prometheus text format
+    """
+    if not config.METRICS_ENABLED:
+        return dict(UNAVAILABLE="METRICS_NOT_AVAILABLE")
+
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "metrics")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
-    return dict(UNIMPLEMENTED="NOT_IMPLEMENTED_YET")
+    return metrics.render()
 
 ################################################################################
 ################################## MARKERS #####################################
 ################################################################################
 
-def handle_get_markers(req, config) -> dict:
+def etag_cell(req, config) -> tuple or None:
+    """
+    Get the cell of a get_markers / get_zones request to tag
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        tuple or None: (lat, long) of the cell, None if etags are disabled, the request is invalid or banned
+    """
+    if not config.ETAGS_ENABLED:
+        return None
+    # Don't confirm anything to invalid keys, the handler will log them
+    if config.PRIVATE_KEYS.get(req.args.get('key')) != "valid":
+        return None
+    # Nor to banned clients, the handler will reject them
+    if limiter.is_banned(req, config):
+        return None
+
+    try:
+        return int(float(req.args.get('lat'))), int(float(req.args.get('long')))
+    except (TypeError, ValueError):
+        return None
+
+def cell_etag(req, config, variant: str) -> str or None:
+    """
+        Get the ETag of a get_markers / get_zones request, from the sequence
+    number its cell is at in the change log, kept in memory by api/versions.py.
+    Read it before the data, so a write made while loading it gives the next
+    request a new tag.
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+        variant (str): Representation of the response, ex: "json", "bin32"
+
+    Returns:
+        str or None: The ETag, None if etags are disabled, the request is invalid or banned
+    """
+    cell = etag_cell(req, config)
+    if cell is None:
+        return None
+    try:
+        seq = versions.cell_seq(config, cell, lambda: db.return_cell_seq(config, cell[0], cell[1]))
+        return f"{seq}-{variant}"
+    except Exception as e:
+        # Sent untagged, the handler answers the request
+        msg.exception(e)
+        return None
+
+def handle_get_markers(req, config, bits: int = None) -> dict:
     """
     Handle the get markers call
 
     Args:
         req (werkzeug.local.LocalProxy): Flask request
         config (models.Config): Config instance
+        bits (int, optional): Coordinate bits of the wire encoding to answer with, see wire.negotiate. Defaults to None, JSON.
 
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_markers")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _lat, _long = req.args.get('lat'), req.args.get('long')
@@ -116,14 +272,65 @@ def handle_get_markers(req, config) -> dict:
     except ValueError:
         return dict(FAIL="INVALID_DATA")
     
-    msg.info(f"[REQ_GET_MKS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}")
+    msg.info(f"[REQ_GET_MKS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
     try:
-        markers = db.return_markers(config, recv_lat, recv_long)
-        return dict(data=markers)
+        def load():
+            return cached(config, ("markers", recv_lat, recv_long),
+                lambda: db.return_markers(config, recv_lat, recv_long))
+
+        if bits is None:
+            return dict(data=load())
+        # Encoded once per cell and bits, dropped with the JSON entry on writes
+        return dict(data=cached(config, ("markers", bits, recv_lat, recv_long),
+            lambda: wire.encode_markers(load(), bits)))
     except Exception as e:
         msg.exception(e)
         return dict(FAIL="UNKNOWN_FAIL")
 
+def handle_get_markers_stream(req, config):
+    """
+        Handle the get markers call with stream=1, the markers are sent as they
+    are read from the database, one JSON string per line, ending with "end".
+    A stream that fails midway is cut short without the "end" line.
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict or generator: Response if the request failed, otherwise the lines to send
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_markers")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long = req.args.get('lat'), req.args.get('long')
+
+    # Convert to ints
+    try:
+        recv_lat, recv_long = int(float(_lat)), int(float(_long))
+    except (TypeError, ValueError):
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_MKS] Received stream request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
+
+    def lines():
+        try:
+            for chunk in db.iter_markers(config, recv_lat, recv_long, config.STREAM_CHUNK_SIZE):
+                yield "".join(json.dumps(marker) + "\n" for marker in chunk)
+            yield '"end"\n'
+        except Exception as e:
+            msg.exception(e)
+
+    return lines()
+
 def handle_add_marker(req, config) -> dict:
     """
     Handle the add marker call
@@ -135,10 +342,15 @@ def handle_add_marker(req, config) -> dict:
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "add_marker")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _lat, _long, _type = req.args.get('lat'), req.args.get('long'), req.args.get('type')
@@ -156,11 +368,15 @@ def handle_add_marker(req, config) -> dict:
         msg.debug(f"[RUNTIME_DEBUG] Type {_type} is NOT valid!")
         return dict(FAIL="INVALID_TYPE")
 
-    msg.info(f"[REQ_ADD_MKS] Received request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long} and type: {_type}")
+    msg.info(f"[REQ_ADD_MKS] Received request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long} and type: {_type}", "request")
     try:
-        response = db.add_marker(config, recv_lat, recv_long, _type)
+        # Queued for the next group commit if write_behind_enabled
+        response = write_behind.add_marker(config, recv_lat, recv_long, _type)
         if response == 0:
             return dict(SUCCESS="DATA_ADDED")
+        elif response == write_behind.QUEUE_FULL:
+            msg.fail("[REQ_ADD_MKS] Write-behind queue is full", "request")
+            return dict(FAIL="QUEUE_FULL")
         else:
             msg.fail(f"Recieved {response} from method add_marker")
             return dict(FAIL=str(response))
@@ -168,6 +384,69 @@ def handle_add_marker(req, config) -> dict:
         msg.exception(e)
         return dict(FAIL="UNKNOWN_FAIL")
 
+def handle_add_markers(req, config) -> dict:
+    """
+    Handle the batch add markers call, the body is a JSON array of
+    {"lat": <lat_exact>, "long": <long_exact>, "type": <type_of_data>}
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response, data has the status of every marker, in order
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "add_markers")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    batch = req.get_json(silent=True)
+    if not isinstance(batch, list):
+        return dict(FAIL="INVALID_DATA")
+    if len(batch) > config.BATCH_MAX_MARKERS:
+        return dict(FAIL="BATCH_TOO_LARGE")
+
+    statuses = []
+    markers = []
+    for item in batch:
+        # Convert to float
+        try:
+            recv_lat, recv_long, _type = float(item['lat']), float(item['long']), item['type']
+        except (TypeError, KeyError, ValueError):
+            statuses.append("INVALID_DATA")
+            continue
+
+        # Check to see if the type is valid
+        try:
+            if TYPES[_type] == "valid": pass
+        except (KeyError, TypeError):
+            statuses.append("INVALID_TYPE")
+            continue
+
+        statuses.append(None)
+        markers.append((recv_lat, recv_long, _type))
+
+    msg.info(f"[REQ_ADD_MKB] Received request from {req.remote_addr} with {len(markers)}/{len(batch)} valid markers", "request")
+    try:
+        response = db.add_markers(config, markers)
+        if response == 0:
+            result = "DATA_ADDED"
+        else:
+            msg.fail(f"Recieved {response} from method add_markers")
+            result = str(response)
+    except Exception as e:
+        msg.exception(e)
+        result = "UNKNOWN_FAIL"
+
+    return dict(data=[result if status is None else status for status in statuses])
+
 def handle_del_markers(req, config) -> dict:
     """
     Handle the delete markers call
@@ -179,10 +458,15 @@ def handle_del_markers(req, config) -> dict:
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "del_markers")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _lat, _long = req.args.get('lat'), req.args.get('long')
@@ -193,7 +477,7 @@ def handle_del_markers(req, config) -> dict:
     except ValueError:
         return dict(FAIL="INVALID_DATA")
 
-    msg.info(f"[REQ_DEL_MKS] Received DELETE request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long}")
+    msg.info(f"[REQ_DEL_MKS] Received DELETE request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long}", "request")
     try:
         response = db.del_markers(config, recv_lat, recv_long)
         if response == 0:
@@ -205,25 +489,65 @@ def handle_del_markers(req, config) -> dict:
         msg.exception(e)
         return dict(FAIL="UNKNOWN_FAIL")
 
+def handle_get_markers_bbox(req, config) -> dict:
+    """
+    Handle the get markers call for a bounding box
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_markers_bbox")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    bbox = parse_bbox(req, config)
+    if bbox is None:
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_MKB] Received request from {req.remote_addr} for bbox: {bbox}", "request")
+    try:
+        markers = db.return_markers_bbox(config, *bbox)
+        return dict(data=markers)
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
 ################################################################################
 ################################### ZONES ######################################
 ################################################################################
 
-def handle_get_zones(req, config) -> dict:
+def handle_get_zones(req, config, bits: int = None) -> dict:
     """
     Handle the get zones call
 
     Args:
         req (werkzeug.local.LocalProxy): Flask request
         config (models.Config): Config instance
+        bits (int, optional): Coordinate bits of the wire encoding to answer with, see wire.negotiate. Defaults to None, JSON.
 
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_zones")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _lat, _long = req.args.get('lat'), req.args.get('long')
@@ -234,15 +558,56 @@ def handle_get_zones(req, config) -> dict:
     except ValueError:
         return dict(FAIL="INVALID_DATA")
     
-    msg.info(f"[REQ_GET_ZNS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}")
+    msg.info(f"[REQ_GET_ZNS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
     try:
-        zones = db.return_zones(config, recv_lat, recv_long)
-        return dict(data=zones)
+        def load():
+            return cached(config, ("zones", recv_lat, recv_long),
+                lambda: db.return_zones(config, recv_lat, recv_long))
+
+        if bits is None:
+            return dict(data=load())
+        # Encoded once per cell and bits, dropped with the JSON entry on writes
+        return dict(data=cached(config, ("zones", bits, recv_lat, recv_long),
+            lambda: wire.encode_zones(load(), bits)))
     except Exception as e:
         msg.exception(e)
         return dict(FAIL="UNKNOWN_FAIL")
 
 
+def handle_get_zones_bbox(req, config) -> dict:
+    """
+    Handle the get zones call for a bounding box
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_zones_bbox")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    bbox = parse_bbox(req, config)
+    if bbox is None:
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_ZNB] Received request from {req.remote_addr} for bbox: {bbox}", "request")
+    try:
+        zones = db.return_zones_bbox(config, *bbox)
+        return dict(data=zones)
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
 def handle_add_zone(req, config) -> dict:
     """
     Handle the add zone call
@@ -254,10 +619,15 @@ def handle_add_zone(req, config) -> dict:
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "add_zone")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _type = req.args.get('type')
@@ -275,7 +645,7 @@ def handle_add_zone(req, config) -> dict:
     if coords.find('@') == -1:
         return dict(FAIL="INVALID_DATA")
 
-    msg.info(f"[REQ_ADD_ZNS] Received request from {req.remote_addr} with type: {_type} and coords: {coords}")
+    msg.info(f"[REQ_ADD_ZNS] Received request from {req.remote_addr} with type: {_type} and coords: {coords}", "request")
     try:
         response = db.add_zone(config, _type, coords)
         if response == 0:
@@ -299,10 +669,15 @@ def handle_del_zone(req, config) -> dict:
     Returns:
         dict: Response
     """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "del_zone")
+    if rejected is not None:
+        return rejected
+
     key = req.args.get('key')
     # If the key is invalid just return INVALID_KEY
     if not isValidKey("private", key, config):
-        msg.fail(f"Requested from {req.remote_addr}")
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
         return dict(FAIL="INVALID_KEY")
 
     _coords = req.args.get('coords')
@@ -313,9 +688,9 @@ def handle_del_zone(req, config) -> dict:
     if coords.find('@') == -1:
         return dict(FAIL="INVALID_DATA")
 
-    msg.info(f"[REQ_DEL_ZNS] Received DELETE request from {req.remote_addr} for coords: {coords}")
+    msg.info(f"[REQ_DEL_ZNS] Received DELETE request from {req.remote_addr} for coords: {coords}", "request")
     try:
-        response = db.del_markers(config, coords)
+        response = db.del_zone(config, coords)
         if response == 0:
             return dict(SUCCESS="DATA_DELETED")
         else:
@@ -324,3 +699,85 @@ def handle_del_zone(req, config) -> dict:
     except Exception as e:
         msg.exception(e)
         return dict(FAIL="UNKNOWN_FAIL")
+
+################################################################################
+#################################### SYNC ######################################
+################################################################################
+
+def handle_sync(req, config) -> dict:
+    """
+    Handle the sync call, what changed in some cells since the token of the last sync
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "sync")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    cells = parse_cells(req, config)
+    if cells is None:
+        return dict(FAIL="INVALID_DATA")
+
+    # No token, or one that isn't ours, gets a snapshot
+    try:
+        token = int(req.args.get('token'))
+    except (TypeError, ValueError):
+        token = None
+
+    msg.info(f"[REQ_SYNC] Received request from {req.remote_addr} for cells: {cells} since: {token}", "request")
+    try:
+        return dict(data=db.return_changes(config, cells, token))
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
+def handle_subscribe(req, config, loop=None):
+    """
+        Handle the subscribe call, the markers and zones written in some cells
+    are pushed as server-sent events until the client disconnects. Events
+    missed while disconnected are fetched with /sync.
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+        config (models.Config): Config instance
+        loop (asyncio.AbstractEventLoop, optional): Loop serving the connection, None for a thread. Defaults to None.
+
+    Returns:
+        dict or push.Subscriber: Response if the request failed, otherwise the subscription to stream
+    """
+    hub = push.get_hub(config)
+    if hub is None:
+        return dict(UNAVAILABLE="PUSH_NOT_AVAILABLE_AT_THIS_TIME")
+
+    # Drop banned / rate limited clients before the key
+    rejected = limiter.check(req, config, "subscribe")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    cells = parse_cells(req, config)
+    if cells is None:
+        return dict(FAIL="INVALID_DATA")
+
+    subscriber = hub.subscribe(cells, loop)
+    if subscriber is None:
+        return dict(FAIL="TOO_MANY_SUBSCRIBERS")
+    msg.info(f"[REQ_SUBSCRIBE] Received request from {req.remote_addr} for cells: {cells}", "request")
+    return subscriber
@@ -0,0 +1,279 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# asyncio versions of the request_handler calls that hit the database on every
+# request, used by api/serve_asgi.py. Checks and responses are the same as
+# request_handler's.
+
+__author__ = 'David Pescariu'
+
+import json
+import utils.console_messages as msg
+import api.db_connector_async as db
+import api.limiter as limiter
+import api.versions as versions
+import api.wire as wire
+import api.write_behind as write_behind
+from api.cache import cached_async
+from api.request_handler import isValidKey, etag_cell
+from models.types import TYPES
+
+async def cell_etag(req, config, variant: str) -> str or None:
+    """
+    Get the ETag of a get_markers / get_zones request, see request_handler.cell_etag
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+        variant (str): Representation of the response, ex: "json", "bin32"
+
+    Returns:
+        str or None: The ETag, None if etags are disabled, the request is invalid or banned
+    """
+    cell = etag_cell(req, config)
+    if cell is None:
+        return None
+    try:
+        seq = await versions.cell_seq_async(config, cell, lambda: db.return_cell_seq(config, cell[0], cell[1]))
+        return f"{seq}-{variant}"
+    except Exception as e:
+        msg.exception(e)
+        return None
+
+async def handle_get_markers(req, config, bits: int = None) -> dict:
+    """
+    Handle the get markers call
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+        bits (int, optional): Coordinate bits of the wire encoding to answer with, see wire.negotiate. Defaults to None, JSON.
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_markers")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long = req.args.get('lat'), req.args.get('long')
+
+    # Convert to ints
+    try:
+        recv_lat, recv_long = int(float(_lat)), int(float(_long))
+    except ValueError:
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_MKS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
+    try:
+        async def load():
+            return await cached_async(config, ("markers", recv_lat, recv_long),
+                lambda: db.return_markers(config, recv_lat, recv_long))
+
+        async def encode():
+            return wire.encode_markers(await load(), bits)
+
+        if bits is None:
+            return dict(data=await load())
+        # See request_handler.handle_get_markers
+        return dict(data=await cached_async(config, ("markers", bits, recv_lat, recv_long), encode))
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
+async def handle_get_markers_stream(req, config):
+    """
+    Handle the get markers call with stream=1, see request_handler.handle_get_markers_stream
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+
+    Returns:
+        dict or async generator: Response if the request failed, otherwise the lines to send
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_markers")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long = req.args.get('lat'), req.args.get('long')
+
+    # Convert to ints
+    try:
+        recv_lat, recv_long = int(float(_lat)), int(float(_long))
+    except (TypeError, ValueError):
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_MKS] Received stream request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
+
+    async def lines():
+        try:
+            async for chunk in db.iter_markers(config, recv_lat, recv_long, config.STREAM_CHUNK_SIZE):
+                yield "".join(json.dumps(marker) + "\n" for marker in chunk)
+            yield '"end"\n'
+        except Exception as e:
+            msg.exception(e)
+
+    return lines()
+
+async def handle_add_marker(req, config) -> dict:
+    """
+    Handle the add marker call
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "add_marker")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long, _type = req.args.get('lat'), req.args.get('long'), req.args.get('type')
+
+    # Convert to float
+    try:
+        recv_lat, recv_long = float(_lat), float(_long)
+    except ValueError:
+        return dict(FAIL="INVALID_DATA")
+
+    # Check to see if the type is valid
+    try:
+        if TYPES[_type] == "valid": pass
+    except KeyError:
+        msg.debug(f"[RUNTIME_DEBUG] Type {_type} is NOT valid!")
+        return dict(FAIL="INVALID_TYPE")
+
+    msg.info(f"[REQ_ADD_MKS] Received request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long} and type: {_type}", "request")
+    try:
+        if write_behind.is_running():
+            # Waiting for room would block the event loop
+            response = write_behind.add_marker(config, recv_lat, recv_long, _type, block=False)
+        else:
+            response = await db.add_marker(config, recv_lat, recv_long, _type)
+        if response == 0:
+            return dict(SUCCESS="DATA_ADDED")
+        elif response == write_behind.QUEUE_FULL:
+            msg.fail("[REQ_ADD_MKS] Write-behind queue is full", "request")
+            return dict(FAIL="QUEUE_FULL")
+        else:
+            msg.fail(f"Recieved {response} from method add_marker")
+            return dict(FAIL=str(response))
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
+async def handle_del_markers(req, config) -> dict:
+    """
+    Handle the delete markers call
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "del_markers")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long = req.args.get('lat'), req.args.get('long')
+
+    # Convert to float
+    try:
+        recv_lat, recv_long = float(_lat), float(_long)
+    except ValueError:
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_DEL_MKS] Received DELETE request from {req.remote_addr} for lat: {recv_lat}, long: {recv_long}", "request")
+    try:
+        response = await db.del_markers(config, recv_lat, recv_long)
+        if response == 0:
+            return dict(SUCCESS="DATA_DELETED")
+        else:
+            msg.fail(f"Recieved {response} from method del_markers")
+            return dict(FAIL=str(response))
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
+async def handle_get_zones(req, config, bits: int = None) -> dict:
+    """
+    Handle the get zones call
+
+    Args:
+        req (api.serve_asgi.RequestView): The request
+        config (models.Config): Config instance
+        bits (int, optional): Coordinate bits of the wire encoding to answer with, see wire.negotiate. Defaults to None, JSON.
+
+    Returns:
+        dict: Response
+    """
+    # Drop banned / rate limited clients before the key and the database
+    rejected = limiter.check(req, config, "get_zones")
+    if rejected is not None:
+        return rejected
+
+    key = req.args.get('key')
+    # If the key is invalid just return INVALID_KEY
+    if not isValidKey("private", key, config):
+        msg.fail(f"Requested from {req.remote_addr}", "auth")
+        return dict(FAIL="INVALID_KEY")
+
+    _lat, _long = req.args.get('lat'), req.args.get('long')
+
+    # Convert to ints
+    try:
+        recv_lat, recv_long = int(float(_lat)), int(float(_long))
+    except ValueError:
+        return dict(FAIL="INVALID_DATA")
+
+    msg.info(f"[REQ_GET_ZNS] Received request from {req.remote_addr} for lat: {recv_lat} and long: {recv_long}", "request")
+    try:
+        async def load():
+            return await cached_async(config, ("zones", recv_lat, recv_long),
+                lambda: db.return_zones(config, recv_lat, recv_long))
+
+        async def encode():
+            return wire.encode_zones(await load(), bits)
+
+        if bits is None:
+            return dict(data=await load())
+        # See request_handler.handle_get_zones
+        return dict(data=await cached_async(config, ("zones", bits, recv_lat, recv_long), encode))
+    except Exception as e:
+        msg.exception(e)
+        return dict(FAIL="UNKNOWN_FAIL")
+
+# EOF
@@ -3,44 +3,187 @@
 
 __author__ = 'David Pescariu'
 
+from time import perf_counter
 from waitress import serve
 from flask import Flask
-from flask import request
+from flask import request, g
+from flask import Response, stream_with_context
 import api.request_handler as handler
+import api.db_connector as db
+import api.limiter as limiter
+import api.metrics as metrics
+import api.public_snapshot as public_snapshot
+import api.push as push
+import api.versions as versions
+import api.write_behind as write_behind
+import api.wire as wire
+from api.cache import get_cache
 
 api = Flask(__name__)
 
-def start_serving(config) -> None:
+def negotiated(response: dict, bits: int or None) -> dict or Response:
     """
-    Start serving the API
+    Send a response in the binary wire format if the request asked for it,
+    failed responses are always JSON
+
+    Args:
+        response (dict): Response from the handler, its data already encoded if bits is set
+        bits (int or None): Coordinate bits from wire.negotiate, None for JSON
+
+    Returns:
+        dict or Response: The response to send
+    """
+    if bits is None or "data" not in response:
+        return response
+    return Response(response["data"], mimetype=wire.MIME_TYPE)
+
+def conditional(config, endpoint: str, respond) -> Response:
+    """
+        Answer a get_markers / get_zones request with a 304 if the client has
+    the current version of the cell (If-None-Match), without calling respond,
+    otherwise tag the response with it
+
+    Args:
+        config (models.Config): Config instance
+        endpoint (str): Rate limited as, ex: "get_markers"
+        respond (callable): Builds the response
+
+    Returns:
+        Response: The response to send
+    """
+    if request.args.get('stream') == "1":
+        variant = "ndjson"
+    else:
+        bits = wire.negotiate(request)
+        variant = "json" if bits is None else f"bin{bits}"
+
+    etag = handler.cell_etag(request, config, variant)
+    if etag is not None and request.if_none_match.contains(etag):
+        # Takes the token of the request it answers, the handler isn't called
+        rejected = limiter.check(request, config, endpoint)
+        if rejected is not None:
+            return api.make_response(rejected)
+        not_modified = Response(status=304)
+        not_modified.set_etag(etag)
+        return not_modified
+
+    response = respond()
+    failed = isinstance(response, dict) and "FAIL" in response
+    response = api.make_response(response)
+    if etag is not None and not failed:
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept"
+    return response
+
+def register_collectors(config) -> None:
+    """
+    Export the connection pool, cache and limiter stats in /metrics
+
+    Args:
+        config (models.Config): Config instance
+    """
+    metrics.add_collector("api_db_pool", db.pool_stats,
+        counters=("acquired", "waited", "timeouts", "recycled", "failed_checks",
+                  "read_store_reconciles", "read_store_drifted_cells"))
+    metrics.add_collector("api_cache",
+        lambda: get_cache(config).stats() if get_cache(config) is not None else {},
+        counters=("hits", "misses", "evictions", "expirations", "invalidations"))
+    metrics.add_collector("api_etag_seqs", versions.stats,
+        counters=("hits", "misses", "evictions", "expirations", "invalidations"))
+    metrics.add_collector("api_limiter", lambda: limiter.stats(config),
+        counters=("allowed", "rejected", "banned_requests"))
+    metrics.add_collector("api_write_behind", write_behind.stats,
+        counters=("flushed", "dropped", "groups", "rejected", "failed_flushes", "replayed"))
+    metrics.add_collector("api_push", push.stats,
+        counters=("events", "delivered", "dropped", "rejected"))
+    metrics.add_collector("api_public", public_snapshot.stats,
+        counters=("builds", "skipped", "failed"))
+
+def create_app(config) -> Flask:
+    """
+    Register the routes of the API
 
     Args:
         config (models.Config): configs (instance of Config)
+
+    Returns:
+        Flask: The app
     """
+    register_collectors(config)
+    if config.READ_STORE_ENABLED:
+        # Load the markers now rather than on the first request
+        db.get_storage(config)
+
+    @api.before_request
+    def start_timer() -> None:
+        g.start = perf_counter()
+
+    @api.after_request
+    def observe(response: Response) -> Response:
+        # Streamed responses are timed until the first byte
+        endpoint = request.endpoint or "unknown"
+        metrics.REQUEST_LATENCY.observe(perf_counter() - g.start, endpoint)
+        metrics.REQUESTS.inc(endpoint, response.status_code)
+        return response
+
+    @api.route("/metrics", methods=["GET"], endpoint="metrics")
+    def metrics_() -> dict or Response:
+        response = handler.handle_metrics(request, config)
+        if isinstance(response, dict):
+            return response
+        return Response(response, content_type=metrics.MIME_TYPE)
     
     @api.route("/", methods=["GET"])
     def base() -> dict:
         return handler.handle_base(request)
 
     @api.route("/public", methods=["GET"])
-    def public() -> dict:
-        return handler.handle_public(request, config)
+    def public() -> dict or Response:
+        response = handler.handle_public(request, config)
+        if isinstance(response, dict):
+            return response
+        status, body, headers = response.respond(request.headers.get('Accept-Encoding', ""),
+            request.if_none_match.contains(response.etag), int(config.PUBLIC_UPDATE_DELAY))
+        return Response(body, status=status, headers=headers)
 
     @api.route("/get_markers", methods=["GET"])
     def get_markers() -> dict:
-        return handler.handle_get_markers(request, config)
+        def respond():
+            if request.args.get('stream') == "1":
+                response = handler.handle_get_markers_stream(request, config)
+                if isinstance(response, dict):
+                    return response
+                return Response(stream_with_context(response), mimetype="application/x-ndjson")
+            bits = wire.negotiate(request)
+            return negotiated(handler.handle_get_markers(request, config, bits), bits)
+        return conditional(config, "get_markers", respond)
+
+    @api.route("/get_markers_bbox", methods=["GET"])
+    def get_markers_bbox() -> dict:
+        return handler.handle_get_markers_bbox(request, config)
 
     @api.route("/add_marker", methods=["GET"])
     def add_marker() -> dict:
         return handler.handle_add_marker(request, config)
 
+    @api.route("/add_markers", methods=["POST"])
+    def add_markers() -> dict:
+        return handler.handle_add_markers(request, config)
+
     @api.route("/del_markers", methods=["GET"])
     def del_markers() -> dict:
         return handler.handle_del_markers(request, config)
 
     @api.route("/get_zones", methods=["GET"])
     def get_zones() -> dict:
-        return handler.handle_get_zones(request, config)
+        def respond():
+            bits = wire.negotiate(request)
+            return negotiated(handler.handle_get_zones(request, config, bits), bits)
+        return conditional(config, "get_zones", respond)
+
+    @api.route("/get_zones_bbox", methods=["GET"])
+    def get_zones_bbox() -> dict:
+        return handler.handle_get_zones_bbox(request, config)
 
     @api.route("/add_zone", methods=["GET"])
     def add_zone() -> dict:
@@ -50,8 +193,30 @@ def start_serving(config) -> None:
     def del_zone() -> dict:
         return handler.handle_del_zone(request, config)
 
+    @api.route("/sync", methods=["GET"])
+    def sync() -> dict:
+        return handler.handle_sync(request, config)
+
+    @api.route("/subscribe", methods=["GET"])
+    def subscribe() -> dict or Response:
+        response = handler.handle_subscribe(request, config)
+        if isinstance(response, dict):
+            return response
+        return Response(push.stream(push.get_hub(config), response, config.PUSH_HEARTBEAT),
+            mimetype=push.MIME_TYPE, headers=push.HEADERS)
+
+    return api
+
+def start_serving(config) -> None:
+    """
+    Start serving the API
+
+    Args:
+        config (models.Config): configs (instance of Config)
+    """
     serve(
-        api,
+        create_app(config),
         port=int(config.SERVE_PORT),
+        threads=config.SERVE_THREADS,
         ipv6=False
     )
\ No newline at end of file
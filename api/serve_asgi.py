@@ -0,0 +1,305 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# asyncio serving mode (serve_mode "asgi"): same routes and responses as
+# api/serve_api.py, on Starlette + uvicorn. get_markers / get_zones /
+# add_marker / del_markers run on aiomysql without blocking a thread, the
+# other routes run the request_handler calls in a thread pool.
+
+__author__ = 'David Pescariu'
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from time import perf_counter
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+import api.request_handler as handler
+import api.request_handler_async as async_handler
+import api.db_connector_async as async_db
+import api.limiter as limiter
+import api.metrics as metrics
+import api.push as push
+import api.wire as wire
+from api.serve_api import register_collectors
+
+class RequestView:
+    """
+    The parts of a Flask request the handlers use, over a Starlette request
+
+    Params:
+        request (starlette.requests.Request): The request
+        body (bytes, optional): The body, if it was read. Defaults to b"".
+    """
+    def __init__(self, request, body: bytes = b"") -> None:
+        self.args = request.query_params
+        self.headers = request.headers
+        self.remote_addr = request.client.host if request.client else None
+        self.__body = body
+
+    def get_json(self, silent: bool = False):
+        """
+        Parse the body as JSON, like Flask's Request.get_json
+
+        Args:
+            silent (bool, optional): Return None instead of raising. Defaults to False.
+
+        Returns:
+            The parsed body, None if it isn't JSON and silent
+        """
+        try:
+            if self.headers.get('Content-Type', "").split(';')[0].strip() != "application/json":
+                raise ValueError("Not a JSON body")
+            return json.loads(self.__body)
+        except ValueError:
+            if silent:
+                return None
+            raise
+
+def json_response(response: dict) -> Response:
+    """
+    Render a handler's dict like Flask does, so both modes send the same bytes
+
+    Args:
+        response (dict): Response from the handler
+
+    Returns:
+        Response: The response
+    """
+    body = json.dumps(response, sort_keys=True, separators=(",", ":")) + "\n"
+    return Response(body, media_type="application/json")
+
+def negotiated(response: dict, bits: int or None) -> Response:
+    """
+    Send a response in the binary wire format if the request asked for it,
+    see serve_api.negotiated
+
+    Args:
+        response (dict): Response from the handler, its data already encoded if bits is set
+        bits (int or None): Coordinate bits from wire.negotiate, None for JSON
+
+    Returns:
+        Response: The response to send
+    """
+    if bits is None or "data" not in response:
+        return json_response(response)
+    return Response(response["data"], media_type=wire.MIME_TYPE)
+
+def __if_none_match(request: RequestView) -> set:
+    """
+    Get the ETags of an If-None-Match header
+
+    Args:
+        request (RequestView): The request
+
+    Returns:
+        set: The ETags, without quotes / W/
+    """
+    etags = set()
+    for etag in request.headers.get('If-None-Match', "").split(','):
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        etags.add(etag.strip('"'))
+    return etags
+
+async def conditional(request: RequestView, config, endpoint: str, respond) -> Response:
+    """
+    Answer with a 304 if the client has the current version of the cell, see
+    serve_api.conditional
+
+    Args:
+        request (RequestView): The request
+        config (models.Config): Config instance
+        endpoint (str): Rate limited as, ex: "get_markers"
+        respond (callable): Returns an awaitable of (response, failed)
+
+    Returns:
+        Response: The response to send
+    """
+    if request.args.get('stream') == "1":
+        variant = "ndjson"
+    else:
+        bits = wire.negotiate(request)
+        variant = "json" if bits is None else f"bin{bits}"
+
+    etag = await async_handler.cell_etag(request, config, variant)
+    if etag is not None:
+        etags = __if_none_match(request)
+        if etag in etags or "*" in etags:
+            rejected = limiter.check(request, config, endpoint)
+            if rejected is not None:
+                return json_response(rejected)
+            return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+
+    response, failed = await respond()
+    if etag is not None and not failed:
+        response.headers["ETag"] = f'"{etag}"'
+        response.headers["Vary"] = "Accept"
+    return response
+
+def timed(name: str, endpoint):
+    """
+    Count and time the requests of an endpoint, like serve_api's after_request
+
+    Args:
+        name (str): Endpoint name, same as in serve_api
+        endpoint (callable): The Starlette endpoint
+
+    Returns:
+        callable: The timed endpoint
+    """
+    async def timed_endpoint(request):
+        start = perf_counter()
+        status = 500
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+            return response
+        finally:
+            # Streamed responses are timed until the first byte
+            metrics.REQUEST_LATENCY.observe(perf_counter() - start, name)
+            metrics.REQUESTS.inc(name, status)
+    return timed_endpoint
+
+def subscribe_endpoint(config):
+    """
+    Create the /subscribe endpoint, the streams are served by the loop without a thread each
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        callable: The Starlette endpoint
+    """
+    async def subscribe(request):
+        response = handler.handle_subscribe(RequestView(request), config, asyncio.get_running_loop())
+        if isinstance(response, dict):
+            return json_response(response)
+        return StreamingResponse(push.stream_async(push.get_hub(config), response, config.PUSH_HEARTBEAT),
+            media_type=push.MIME_TYPE, headers=push.HEADERS)
+    return subscribe
+
+class Server(uvicorn.Server):
+    """
+    uvicorn server that ends the /subscribe streams when asked to exit, they
+    would otherwise hold the drain for the whole drain_timeout
+    """
+    def handle_exit(self, sig, frame) -> None:
+        push.close()
+        super().handle_exit(sig, frame)
+
+def create_app(config) -> Starlette:
+    """
+    Create the ASGI app
+
+    Args:
+        config (models.Config): configs (instance of Config)
+
+    Returns:
+        Starlette: The app
+    """
+    def threaded(handle, read_body: bool = False):
+        # Routes without an asyncio version
+        async def endpoint(request):
+            view = RequestView(request, await request.body() if read_body else b"")
+            return json_response(await run_in_threadpool(handle, view, config))
+        return endpoint
+
+    async def get_markers(request):
+        view = RequestView(request)
+
+        async def respond():
+            if view.args.get('stream') == "1":
+                response = await async_handler.handle_get_markers_stream(view, config)
+                if isinstance(response, dict):
+                    return json_response(response), True
+                return StreamingResponse(response, media_type="application/x-ndjson"), False
+            bits = wire.negotiate(view)
+            response = await async_handler.handle_get_markers(view, config, bits)
+            return negotiated(response, bits), "FAIL" in response
+        return await conditional(view, config, "get_markers", respond)
+
+    async def get_zones(request):
+        view = RequestView(request)
+
+        async def respond():
+            bits = wire.negotiate(view)
+            response = await async_handler.handle_get_zones(view, config, bits)
+            return negotiated(response, bits), "FAIL" in response
+        return await conditional(view, config, "get_zones", respond)
+
+    async def add_marker(request):
+        return json_response(await async_handler.handle_add_marker(RequestView(request), config))
+
+    async def del_markers(request):
+        return json_response(await async_handler.handle_del_markers(RequestView(request), config))
+
+    async def public(request):
+        view = RequestView(request)
+        # Only reads the prebuilt snapshot, no thread needed
+        response = handler.handle_public(view, config)
+        if isinstance(response, dict):
+            return json_response(response)
+        status, body, headers = response.respond(view.headers.get('Accept-Encoding', ""),
+            response.etag in __if_none_match(view), int(config.PUBLIC_UPDATE_DELAY))
+        return Response(body, status_code=status, headers=headers)
+
+    async def metrics_(request):
+        response = await run_in_threadpool(handler.handle_metrics, RequestView(request), config)
+        if isinstance(response, dict):
+            return json_response(response)
+        return Response(response, headers={"Content-Type": metrics.MIME_TYPE})
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await async_db.open_pool(config)
+        yield
+        await async_db.close_pool()
+
+    register_collectors(config)
+    metrics.add_collector("api_async_db_pool", async_db.pool_stats)
+
+    endpoints = [
+        ("/metrics", "metrics", metrics_, "GET"),
+        ("/", "base", threaded(lambda req, config: handler.handle_base(req)), "GET"),
+        ("/public", "public", public, "GET"),
+        ("/get_markers", "get_markers", get_markers, "GET"),
+        ("/get_markers_bbox", "get_markers_bbox", threaded(handler.handle_get_markers_bbox), "GET"),
+        ("/add_marker", "add_marker", add_marker, "GET"),
+        ("/add_markers", "add_markers", threaded(handler.handle_add_markers, read_body=True), "POST"),
+        ("/del_markers", "del_markers", del_markers, "GET"),
+        ("/get_zones", "get_zones", get_zones, "GET"),
+        ("/get_zones_bbox", "get_zones_bbox", threaded(handler.handle_get_zones_bbox), "GET"),
+        ("/add_zone", "add_zone", threaded(handler.handle_add_zone), "GET"),
+        ("/del_zone", "del_zone", threaded(handler.handle_del_zone), "GET"),
+        ("/sync", "sync", threaded(handler.handle_sync), "GET"),
+        ("/subscribe", "subscribe", subscribe_endpoint(config), "GET"),
+    ]
+    return Starlette(routes=[
+        Route(path, timed(name, endpoint), methods=[method]) for path, name, endpoint, method in endpoints
+    ], lifespan=lifespan)
+
+def start_serving(config, sockets: list = None) -> None:
+    """
+    Start serving the API, returns on Ctrl-C / SIGTERM once the open
+    requests are done (up to drain_timeout)
+
+    Args:
+        config (models.Config): configs (instance of Config)
+        sockets (list, optional): Listening sockets to serve on, ex: from api/prefork.py. Defaults to binding serve_port.
+    """
+    server = Server(uvicorn.Config(
+        create_app(config),
+        host="0.0.0.0",
+        port=int(config.SERVE_PORT),
+        log_level="warning",
+        access_log=False,
+        timeout_graceful_shutdown=config.DRAIN_TIMEOUT
+    ))
+    server.run(sockets=sockets)
+
+# EOF
@@ -0,0 +1,325 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Storage backends of api/db_connector.py. A backend only stores and finds
+# rows, db_connector stays the entry point: it fills in the cells and dates,
+# formats the rows for the handlers and publishes the events.
+#   "mysql"  -> api/storage_mysql.py, the production database
+#   "sqlite" -> api/storage_sqlite.py, an embedded file, no server needed
+#   "memory" -> api/storage_memory.py, per process and lost on exit
+
+__author__ = 'David Pescariu'
+
+BACKENDS = ("mysql", "sqlite", "memory")
+
+# Change log entries, see Storage.changes()
+MARKER  = "marker"
+ZONE    = "zone"
+ADDED   = "add"
+REMOVED = "del"
+
+# Change log writes of MySQL, shared by storage_mysql, db_connector_async and
+# bulk_io. Every write takes the change_lock row right before its change_log
+# insert, after its data statements, and holds it until commit: only the log
+# inserts and commits are serialized and the seq grows in commit order (migration 3)
+MYSQL_LOCK_QUERY = "select id from change_lock where id = 1 for update;"
+MYSQL_LOG_QUERY = ("insert into change_log (celllat, celllong, kind, op, exactlat, exactlong, type, coords, "
+                   "submitdate, submittime) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);")
+# See Storage.cell_seq(), an index lookup on change_cell. A cell without entries
+# is at the last pruned seq, all of its writes came before it
+MYSQL_CELL_SEQ_QUERY = ("select coalesce(max(seq), (select coalesce(min(seq), 1) - 1 from change_log)) "
+                        "from change_log where celllat = %s and celllong = %s;")
+
+class StorageError(Exception):
+    """
+    Raised by a backend when a statement is rejected by the database (bad
+    query, missing table...), db_connector answers it with status code 1
+    """
+
+class Storage:
+    """
+        Interface of the storage backends. Markers are handled as rows of
+    (exact_lat, exact_long, type, date, time), zones by their coords string
+    (lat1@long1,lat2@long2,...). Every write is a single transaction.
+
+        Every write that changes something also appends to a change log, in
+    the same transaction, under a sequence number that grows in commit order:
+    a reader that saw a sequence number has seen every smaller one.
+    """
+    def markers(self, cell_lat: int, cell_long: int) -> list:
+        """
+        Get the markers of a cell
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+
+        Returns:
+            list: The rows
+        """
+        raise NotImplementedError
+
+    def iter_markers(self, cell_lat: int, cell_long: int, chunk_size: int):
+        """
+        Stream the markers of a cell, holding whatever the backend needs until
+        the generator is exhausted or closed
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            chunk_size (int): Rows per chunk
+
+        Yields:
+            list: Up to chunk_size rows
+        """
+        raise NotImplementedError
+
+    def markers_in_cells(self, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+        """
+        Get the markers of a range of cells
+
+        Args:
+            min_cell (tuple): (lat, long) of the south-west cell
+            max_cell (tuple): (lat, long) of the north-east cell
+            bbox (tuple, optional): Only keep the markers in (min_lat, min_long, max_lat, max_long). Defaults to None.
+
+        Returns:
+            list: The rows
+        """
+        raise NotImplementedError
+
+    def add_markers(self, rows: list) -> None:
+        """
+        Add markers, all of them or none
+
+        Args:
+            rows (list): (cell_lat, cell_long, exact_lat, exact_long, type, date, time) rows
+        """
+        raise NotImplementedError
+
+    def del_markers(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        """
+        Delete the markers at exact coords
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            exact_lat (float): The exact lat of the marker(s)
+            exact_long (float): The exact long of the marker(s)
+        """
+        raise NotImplementedError
+
+    def cells(self) -> list:
+        """
+        Get every cell that has markers
+
+        Returns:
+            list: The cells, as (lat, long) int tuples
+        """
+        raise NotImplementedError
+
+    def zones(self, cell_lat: int, cell_long: int, _type: int) -> list:
+        """
+        Get the zones of a cell with a type
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            _type (int): The type of the zones
+
+        Returns:
+            list: Their coords strings
+        """
+        raise NotImplementedError
+
+    def replace_zones(self, cell_lat: int, cell_long: int, _type: int,
+                      coords: list, date: str, time: str) -> None:
+        """
+        Replace the zones of a cell with a type
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            _type (int): The type of the zones
+            coords (list): Coords strings of the new zones
+            date (str): Submit date
+            time (str): Submit time
+        """
+        raise NotImplementedError
+
+    def add_zone(self, cell_lat: int, cell_long: int, _type: int,
+                 coords: str, date: str, time: str) -> None:
+        """
+        Add a zone
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            _type (int): The type/danger level of the zone
+            coords (str): Coords string
+            date (str): Submit date
+            time (str): Submit time
+        """
+        raise NotImplementedError
+
+    def del_zone(self, cell_lat: int, cell_long: int, coords: str) -> None:
+        """
+        Delete the zones with these coords
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+            coords (str): Coords string
+        """
+        raise NotImplementedError
+
+    def changes(self, cells: list, since: int, limit: int) -> list:
+        """
+        Get the change log entries of some cells, oldest first
+
+        Args:
+            cells (list): (lat, long) of the cells
+            since (int): Only the entries after this sequence number
+            limit (int): Max number of entries
+
+        Returns:
+            list: (seq, kind, op, exact_lat, exact_long, type, coords, date, time), kind is
+                MARKER / ZONE and op ADDED / REMOVED, markers have no coords and zones only have coords
+        """
+        raise NotImplementedError
+
+    def change_range(self) -> tuple:
+        """
+        Get the sequence numbers still in the change log
+
+        Returns:
+            tuple: (first, last), (last + 1, last) if it's empty, last being where the sequence starts
+        """
+        raise NotImplementedError
+
+    def prune_changes(self, keep: int) -> None:
+        """
+        Drop the oldest change log entries, the last one is always kept so
+        cell_seq() never goes back
+
+        Args:
+            keep (int): Number of entries to keep
+        """
+        raise NotImplementedError
+
+    def cell_seq(self, cell_lat: int, cell_long: int) -> int:
+        """
+            Get the sequence number a cell is at: its last change log entry, or
+        the last pruned one if its entries were all pruned. Any committed write
+        to the cell changes it and it never goes back to an older value, so it
+        tags the cell's data, writes from other processes (ex: bulk.py) included.
+
+        Args:
+            cell_lat (int): Cell lat
+            cell_long (int): Cell long
+
+        Returns:
+            int: The sequence number
+        """
+        raise NotImplementedError
+
+    def snapshot(self, cells: list, zone_type: int) -> tuple:
+        """
+        Get the markers and zones of some cells and the sequence number they
+        are at, all read at the same point in time
+
+        Args:
+            cells (list): (lat, long) of the cells
+            zone_type (int): The type of the zones
+
+        Returns:
+            tuple: (seq, marker rows, zone coords strings)
+        """
+        raise NotImplementedError
+
+    def summary(self, zone_type: int) -> tuple:
+        """
+        Get the number of markers of each type and the zones of every cell,
+        and the sequence number they are at, all read at the same point in time
+
+        Args:
+            zone_type (int): The type of the zones
+
+        Returns:
+            tuple: (seq, (cell_lat, cell_long, type, count) rows, (cell_lat, cell_long, coords) rows)
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """
+        Get the backend metrics, exported as api_db_pool
+
+        Returns:
+            dict: Numbers only, empty if there are none
+        """
+        return {}
+
+    def close(self) -> None:
+        """
+        Release the connections / files, the backend isn't used after this
+        """
+
+def cell_filter(cells: list, placeholder: str = "%s") -> tuple:
+    """
+    Build the where clause matching some cells, for the SQL backends
+
+    Args:
+        cells (list): (lat, long) of the cells
+        placeholder (str, optional): Parameter placeholder of the driver. Defaults to "%s".
+
+    Returns:
+        tuple: (clause, params)
+    """
+    clause = " or ".join([f"(celllat = {placeholder} and celllong = {placeholder})"] * len(cells))
+    params = tuple(value for cell in cells for value in cell)
+    return f"({clause})", params
+
+def pool_size(config) -> int:
+    """
+        Get the number of connections of the SQL backends: db_pool_size, or if
+    it's 0 one per serving thread plus one per enabled background thread that
+    uses the database (write-behind, zone scheduler, public snapshot, read
+    store reconcile), so they never leave a request waiting for a connection
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        int: The pool size
+    """
+    if config.DB_POOL_SIZE > 0:
+        return config.DB_POOL_SIZE
+    background = (config.WRITE_BEHIND_ENABLED, config.PRECOMPUTE_ZONES, config.ALLOW_PUBLIC, config.READ_STORE_ENABLED)
+    return config.SERVE_THREADS + sum(1 for enabled in background if enabled)
+
+def open_storage(config) -> Storage:
+    """
+    Create the backend configured in storage_backend
+
+    Args:
+        config (models.Config): Config instance
+
+    Raises:
+        ValueError: Unknown backend
+
+    Returns:
+        Storage: The backend
+    """
+    # Imported here so only the configured backend's driver has to be installed
+    if config.STORAGE_BACKEND == "mysql":
+        from api.storage_mysql import MySQLStorage
+        return MySQLStorage(config)
+    if config.STORAGE_BACKEND == "sqlite":
+        from api.storage_sqlite import SQLiteStorage
+        return SQLiteStorage(config)
+    if config.STORAGE_BACKEND == "memory":
+        from api.storage_memory import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend {config.STORAGE_BACKEND}, use one of {', '.join(BACKENDS)}")
+
+# EOF
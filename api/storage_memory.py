@@ -0,0 +1,161 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# In-memory storage, for tests, benchmarks and demos. Everything is lost when
+# the process exits and every process has its own copy, so it can't be used
+# with serve_workers above 1.
+
+__author__ = 'David Pescariu'
+
+import threading
+from time import time_ns
+from collections import Counter
+from api.storage import Storage, MARKER, ZONE, ADDED, REMOVED
+
+class MemoryStorage(Storage):
+    """
+    Storage in dicts of cell -> rows, behind one lock
+    """
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__markers = {}  # (cell_lat, cell_long) -> [(exact_lat, exact_long, type, date, time)]
+        self.__zones = {}    # (cell_lat, cell_long) -> [(type, coords, date, time)]
+        self.__changes = []  # (seq, (cell_lat, cell_long), kind, op, exact_lat, exact_long, type, coords, date, time)
+        self.__cell_seqs = {}  # (cell_lat, cell_long) -> seq of its last change
+        # Starts from the clock, so sync tokens / ETags of a previous process never match this one's
+        self.__seq = time_ns() // 1000
+
+    def __log(self, cell: tuple, kind: str, op: str, exact_lat: float = None, exact_long: float = None,
+              _type=None, coords: str = None, date: str = None, time: str = None) -> None:
+        """
+        Append to the change log, hold the lock
+        """
+        self.__seq += 1
+        self.__cell_seqs[cell] = self.__seq
+        self.__changes.append((self.__seq, cell, kind, op, exact_lat, exact_long, _type, coords, date, time))
+
+    def markers(self, cell_lat: int, cell_long: int) -> list:
+        with self.__lock:
+            return list(self.__markers.get((cell_lat, cell_long), ()))
+
+    def iter_markers(self, cell_lat: int, cell_long: int, chunk_size: int):
+        rows = self.markers(cell_lat, cell_long)
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def markers_in_cells(self, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+        rows = []
+        with self.__lock:
+            for (cell_lat, cell_long), cell_rows in self.__markers.items():
+                if min_cell[0] <= cell_lat <= max_cell[0] and min_cell[1] <= cell_long <= max_cell[1]:
+                    rows.extend(cell_rows)
+        if bbox is not None:
+            min_lat, min_long, max_lat, max_long = bbox
+            rows = [row for row in rows if min_lat <= row[0] <= max_lat and min_long <= row[1] <= max_long]
+        return rows
+
+    def add_markers(self, rows: list) -> None:
+        with self.__lock:
+            for (cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in rows:
+                self.__markers.setdefault((cell_lat, cell_long), []).append(
+                    (exact_lat, exact_long, _type, date, time))
+                self.__log((cell_lat, cell_long), MARKER, ADDED, exact_lat, exact_long, _type, date=date, time=time)
+
+    def del_markers(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        with self.__lock:
+            rows = self.__markers.get((cell_lat, cell_long))
+            if rows is None:
+                return
+            count = len(rows)
+            rows[:] = [row for row in rows if row[0] != exact_lat or row[1] != exact_long]
+            if len(rows) < count:
+                self.__log((cell_lat, cell_long), MARKER, REMOVED, exact_lat, exact_long)
+            if not rows:
+                del self.__markers[(cell_lat, cell_long)]
+
+    def cells(self) -> list:
+        with self.__lock:
+            return list(self.__markers)
+
+    def zones(self, cell_lat: int, cell_long: int, _type: int) -> list:
+        with self.__lock:
+            return [coords for (type_, coords, _, _) in self.__zones.get((cell_lat, cell_long), ()) if type_ == _type]
+
+    def replace_zones(self, cell_lat: int, cell_long: int, _type: int,
+                      coords: list, date: str, time: str) -> None:
+        with self.__lock:
+            zones = self.__zones.get((cell_lat, cell_long), ())
+            old = {zone[1] for zone in zones if zone[0] == _type}
+            kept = [zone for zone in zones if zone[0] != _type]
+            self.__zones[(cell_lat, cell_long)] = kept + [(_type, zone_coords, date, time) for zone_coords in coords]
+            for zone_coords in old.difference(coords):
+                self.__log((cell_lat, cell_long), ZONE, REMOVED, _type=_type, coords=zone_coords)
+            for zone_coords in dict.fromkeys(coords):
+                if zone_coords not in old:
+                    self.__log((cell_lat, cell_long), ZONE, ADDED, _type=_type, coords=zone_coords, date=date, time=time)
+
+    def add_zone(self, cell_lat: int, cell_long: int, _type: int,
+                 coords: str, date: str, time: str) -> None:
+        with self.__lock:
+            self.__zones.setdefault((cell_lat, cell_long), []).append((_type, coords, date, time))
+            self.__log((cell_lat, cell_long), ZONE, ADDED, _type=_type, coords=coords, date=date, time=time)
+
+    def del_zone(self, cell_lat: int, cell_long: int, coords: str) -> None:
+        with self.__lock:
+            zones = self.__zones.get((cell_lat, cell_long))
+            if zones is not None:
+                count = len(zones)
+                zones[:] = [zone for zone in zones if zone[1] != coords]
+                if len(zones) < count:
+                    self.__log((cell_lat, cell_long), ZONE, REMOVED, coords=coords)
+
+    def changes(self, cells: list, since: int, limit: int) -> list:
+        cells = set(cells)
+        with self.__lock:
+            # The seqs have no gaps, so the position of since is known
+            first = self.__changes[0][0] if self.__changes else 0
+            changes = self.__changes[max(0, since - first + 1):]
+        entries = []
+        for (seq, cell, *entry) in changes:
+            if cell in cells:
+                entries.append((seq, *entry))
+                if len(entries) >= limit:
+                    break
+        return entries
+
+    def change_range(self) -> tuple:
+        with self.__lock:
+            if not self.__changes:
+                return self.__seq + 1, self.__seq
+            return self.__changes[0][0], self.__changes[-1][0]
+
+    def prune_changes(self, keep: int) -> None:
+        with self.__lock:
+            del self.__changes[:max(0, len(self.__changes) - keep)]
+
+    def cell_seq(self, cell_lat: int, cell_long: int) -> int:
+        with self.__lock:
+            first = self.__changes[0][0] if self.__changes else self.__seq + 1
+            return max(self.__cell_seqs.get((cell_lat, cell_long), 0), first - 1)
+
+    def snapshot(self, cells: list, zone_type: int) -> tuple:
+        with self.__lock:
+            rows = [row for cell in cells for row in self.__markers.get(tuple(cell), ())]
+            zones = [coords for cell in cells for (type_, coords, _, _) in self.__zones.get(tuple(cell), ())
+                     if type_ == zone_type]
+            return self.__seq, rows, zones
+
+    def summary(self, zone_type: int) -> tuple:
+        with self.__lock:
+            counts = Counter((cell[0], cell[1], row[2]) for cell, rows in self.__markers.items() for row in rows)
+            zones = [(cell[0], cell[1], coords) for cell, cell_zones in self.__zones.items()
+                     for (type_, coords, _, _) in cell_zones if type_ == zone_type]
+            return self.__seq, [(*key, count) for key, count in counts.items()], zones
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(
+                cells=len(self.__markers),
+                markers=sum(len(rows) for rows in self.__markers.values()))
+
+# EOF
@@ -0,0 +1,286 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+import mysql.connector
+from contextlib import contextmanager
+from api.db_pool import ConnectionPool
+from api.storage import Storage, StorageError, MARKER, ZONE, ADDED, REMOVED, cell_filter, pool_size
+from api.storage import MYSQL_LOCK_QUERY, MYSQL_LOG_QUERY, MYSQL_CELL_SEQ_QUERY
+import api.db_connector as db
+import api.metrics as metrics
+
+MARKER_COLUMNS = "exactlat, exactlong, type, submitdate, submittime"
+
+# Rows deleted per transaction by prune_changes()
+PRUNE_CHUNK = 10000
+
+def connect(config) -> mysql.connector.connection:
+    """
+    Open a new connection to the database, outside of the pool
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        mysql.connector.connection: The connection, close it when done
+    """
+    db_user = config.DB_LOGIN_USER
+    db_pass = config.DB_LOGIN_PASS
+
+    return mysql.connector.connect(
+        user=db_user, password=db_pass,
+        host='127.0.0.1', database='data')
+
+class MySQLStorage(Storage):
+    """
+    Storage in the MySQL database, through a pool of storage.pool_size() connections
+
+    Params:
+        config (models.Config): Config instance
+    """
+    def __init__(self, config) -> None:
+        self.__pool = ConnectionPool(
+            lambda: connect(config),
+            size=pool_size(config),
+            timeout=config.DB_POOL_TIMEOUT,
+            recycle=config.DB_POOL_RECYCLE,
+            ping_after=config.DB_POOL_PING_AFTER)
+
+    @contextmanager
+    def __session(self):
+        """
+        Borrow a pooled connection for the duration of a with block, commit
+        after it or roll back and drop the connection if it raises
+
+        Raises:
+            StorageError: The statement was rejected (mysql.connector.errors.ProgrammingError)
+
+        Yields:
+            mysql.connector.cursor: The mysql cursor
+        """
+        with metrics.STAGE_LATENCY.time("connect"):
+            cnx = self.__pool.acquire()
+        cursor = cnx.cursor()
+        failed = True
+        try:
+            yield cursor
+            cnx.commit()
+            failed = False
+        except mysql.connector.errors.ProgrammingError as e:
+            raise StorageError(str(e)) from e
+        finally:
+            try:
+                if failed:
+                    cnx.rollback()
+                cursor.close()
+            except mysql.connector.Error:
+                failed = True
+            self.__pool.release(cnx, discard=failed)
+
+    def markers(self, cell_lat: int, cell_long: int) -> list:
+        query = (f"select {MARKER_COLUMNS} from marker_data "
+                 "where celllat = %s and celllong = %s;")
+
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                cursor.execute(query, (cell_lat, cell_long))
+                return cursor.fetchall()
+
+    def iter_markers(self, cell_lat: int, cell_long: int, chunk_size: int):
+        query = (f"select {MARKER_COLUMNS} from marker_data "
+                 "where celllat = %s and celllong = %s;")
+
+        # Closing it early drops the connection, it still has unread rows
+        with self.__session() as cursor:
+            cursor.execute(query, (cell_lat, cell_long))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def markers_in_cells(self, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+        query = (f"select {MARKER_COLUMNS} from marker_data "
+                 "where celllat between %s and %s and celllong between %s and %s")
+        params = (min_cell[0], max_cell[0], min_cell[1], max_cell[1])
+        if bbox is not None:
+            query += " and exactlat between %s and %s and exactlong between %s and %s"
+            params += (bbox[0], bbox[2], bbox[1], bbox[3])
+
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                cursor.execute(query + ";", params)
+                return cursor.fetchall()
+
+    def add_markers(self, rows: list) -> None:
+        query = ("insert into marker_data (zone, celllat, celllong, exactlat, exactlong, type, submitdate, submittime) "
+                 "values (%s, %s, %s, %s, %s, %s, %s, %s);")
+
+        with self.__session() as cursor:
+            if len(rows) == 1:
+                cursor.execute(query, (db.legacy_zone(rows[0][0], rows[0][1]), ) + tuple(rows[0]))
+            else:
+                cursor.executemany(query, [(db.legacy_zone(row[0], row[1]), ) + tuple(row) for row in rows])
+            cursor.execute(MYSQL_LOCK_QUERY)
+            cursor.fetchall()
+            cursor.executemany(MYSQL_LOG_QUERY, [
+                (cell_lat, cell_long, MARKER, ADDED, exact_lat, exact_long, _type, None, date, time)
+                for (cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in rows
+            ])
+
+    def del_markers(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        query = ("delete from marker_data "
+                 "where celllat = %s and celllong = %s and exactlat = %s and exactlong = %s;")
+
+        with self.__session() as cursor:
+            cursor.execute(query, (cell_lat, cell_long, exact_lat, exact_long))
+            if cursor.rowcount > 0:
+                cursor.execute(MYSQL_LOCK_QUERY)
+                cursor.fetchall()
+                cursor.execute(MYSQL_LOG_QUERY,
+                    (cell_lat, cell_long, MARKER, REMOVED, exact_lat, exact_long, None, None, None, None))
+
+    def cells(self) -> list:
+        query = ("select distinct celllat, celllong from marker_data;")
+
+        with self.__session() as cursor:
+            cursor.execute(query)
+            return [(int(cell_lat), int(cell_long)) for (cell_lat, cell_long) in cursor]
+
+    def zones(self, cell_lat: int, cell_long: int, _type: int) -> list:
+        query = ("select coords from zone_data where celllat = %s and celllong = %s and type = %s;")
+
+        with self.__session() as cursor:
+            cursor.execute(query, (cell_lat, cell_long, _type))
+            return [coords for (coords, ) in cursor]
+
+    def replace_zones(self, cell_lat: int, cell_long: int, _type: int,
+                      coords: list, date: str, time: str) -> None:
+        select_query = ("select coords from zone_data where celllat = %s and celllong = %s and type = %s;")
+        delete_query = ("delete from zone_data where celllat = %s and celllong = %s and type = %s;")
+        insert_query = ("insert into zone_data (zone, celllat, celllong, type, coords, submitdate, submittime) "
+                        "values (%s, %s, %s, %s, %s, %s, %s);")
+        zone = db.legacy_zone(cell_lat, cell_long)
+
+        with self.__session() as cursor:
+            cursor.execute(select_query, (cell_lat, cell_long, _type))
+            old = {zone_coords for (zone_coords, ) in cursor.fetchall()}
+            cursor.execute(delete_query, (cell_lat, cell_long, _type))
+            if coords:
+                cursor.executemany(insert_query, [
+                    (zone, cell_lat, cell_long, _type, zone_coords, date, time) for zone_coords in coords
+                ])
+            # Only what changed, most rebuilds give back the same zones
+            log = [
+                (cell_lat, cell_long, ZONE, REMOVED, None, None, _type, zone_coords, None, None)
+                for zone_coords in old.difference(coords)
+            ] + [
+                (cell_lat, cell_long, ZONE, ADDED, None, None, _type, zone_coords, date, time)
+                for zone_coords in dict.fromkeys(coords) if zone_coords not in old
+            ]
+            if log:
+                cursor.execute(MYSQL_LOCK_QUERY)
+                cursor.fetchall()
+                cursor.executemany(MYSQL_LOG_QUERY, log)
+
+    def add_zone(self, cell_lat: int, cell_long: int, _type: int,
+                 coords: str, date: str, time: str) -> None:
+        query = ("insert into zone_data (zone, celllat, celllong, type, coords, submitdate, submittime) "
+                 "values (%s, %s, %s, %s, %s, %s, %s);")
+
+        with self.__session() as cursor:
+            cursor.execute(query, (db.legacy_zone(cell_lat, cell_long), cell_lat, cell_long,
+                _type, coords, date, time))
+            cursor.execute(MYSQL_LOCK_QUERY)
+            cursor.fetchall()
+            cursor.execute(MYSQL_LOG_QUERY,
+                (cell_lat, cell_long, ZONE, ADDED, None, None, _type, coords, date, time))
+
+    def del_zone(self, cell_lat: int, cell_long: int, coords: str) -> None:
+        query = ("delete from zone_data where celllat = %s and celllong = %s and coords = %s;")
+
+        with self.__session() as cursor:
+            cursor.execute(query, (cell_lat, cell_long, coords))
+            if cursor.rowcount > 0:
+                cursor.execute(MYSQL_LOCK_QUERY)
+                cursor.fetchall()
+                cursor.execute(MYSQL_LOG_QUERY,
+                    (cell_lat, cell_long, ZONE, REMOVED, None, None, None, coords, None, None))
+
+    def changes(self, cells: list, since: int, limit: int) -> list:
+        clause, params = cell_filter(cells)
+        query = ("select seq, kind, op, exactlat, exactlong, type, coords, submitdate, submittime from change_log "
+                 f"where seq > %s and {clause} order by seq limit %s;")
+
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                cursor.execute(query, (since, ) + params + (limit, ))
+                return cursor.fetchall()
+
+    def change_range(self) -> tuple:
+        query = ("select coalesce(min(seq), 1), coalesce(max(seq), 0) from change_log;")
+
+        with self.__session() as cursor:
+            cursor.execute(query)
+            first, last = cursor.fetchone()
+            return int(first), int(last)
+
+    def prune_changes(self, keep: int) -> None:
+        query = ("delete from change_log where seq <= %s order by seq limit %s;")
+
+        last = self.change_range()[1]
+        # Small transactions, the writers wait for none of them
+        while True:
+            with self.__session() as cursor:
+                cursor.execute(query, (last - max(keep, 1), PRUNE_CHUNK))
+                deleted = cursor.rowcount
+            if deleted < PRUNE_CHUNK:
+                break
+
+    def cell_seq(self, cell_lat: int, cell_long: int) -> int:
+        with self.__session() as cursor:
+            cursor.execute(MYSQL_CELL_SEQ_QUERY, (cell_lat, cell_long))
+            return int(cursor.fetchone()[0])
+
+    def snapshot(self, cells: list, zone_type: int) -> tuple:
+        clause, params = cell_filter(cells)
+        markers_query = (f"select {MARKER_COLUMNS} from marker_data where {clause};")
+        zones_query = (f"select coords from zone_data where type = %s and {clause};")
+
+        # One transaction, InnoDB reads all of it from the same snapshot
+        with self.__session() as cursor:
+            cursor.execute("start transaction with consistent snapshot, read only;")
+            cursor.execute("select coalesce(max(seq), 0) from change_log;")
+            seq = int(cursor.fetchone()[0])
+            with metrics.STAGE_LATENCY.time("query"):
+                cursor.execute(markers_query, params)
+                rows = cursor.fetchall()
+            cursor.execute(zones_query, (zone_type, ) + params)
+            return seq, rows, [coords for (coords, ) in cursor.fetchall()]
+
+    def summary(self, zone_type: int) -> tuple:
+        counts_query = ("select celllat, celllong, type, count(*) from marker_data "
+                        "group by celllat, celllong, type;")
+        zones_query = ("select celllat, celllong, coords from zone_data where type = %s;")
+
+        with self.__session() as cursor:
+            cursor.execute("start transaction with consistent snapshot, read only;")
+            cursor.execute("select coalesce(max(seq), 0) from change_log;")
+            seq = int(cursor.fetchone()[0])
+            with metrics.STAGE_LATENCY.time("query"):
+                cursor.execute(counts_query)
+                counts = [(int(cell_lat), int(cell_long), _type, int(count))
+                          for (cell_lat, cell_long, _type, count) in cursor.fetchall()]
+            cursor.execute(zones_query, (zone_type, ))
+            zones = [(int(cell_lat), int(cell_long), coords) for (cell_lat, cell_long, coords) in cursor.fetchall()]
+            return seq, counts, zones
+
+    def stats(self) -> dict:
+        return self.__pool.stats()
+
+    def close(self) -> None:
+        self.__pool.close()
+
+# EOF
@@ -0,0 +1,295 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Embedded storage in a SQLite file (sqlite_path). The file is opened in WAL
+# mode so readers never wait for the writer, every statement is a constant
+# string so sqlite3 compiles it once per connection and reuses the prepared
+# statement, and the marker coords are indexed by an R*Tree for the bbox
+# queries. The R*Tree is kept in sync by triggers.
+
+__author__ = 'David Pescariu'
+
+import os
+import sqlite3
+from contextlib import contextmanager
+import utils.console_messages as msg
+from api.db_pool import ConnectionPool
+from api.storage import Storage, StorageError, MARKER, ZONE, ADDED, REMOVED, cell_filter, pool_size
+import api.metrics as metrics
+
+SCHEMA = (
+    "create table if not exists marker_data ("
+    "id integer primary key autoincrement, celllat integer not null, celllong integer not null, "
+    "exactlat real not null, exactlong real not null, type text, submitdate text, submittime text);",
+    "create index if not exists marker_cell_idx on marker_data (celllat, celllong);",
+    "create table if not exists zone_data ("
+    "id integer primary key, celllat integer not null, celllong integer not null, "
+    "type integer, coords text, submitdate text, submittime text);",
+    "create index if not exists zone_cell_idx on zone_data (celllat, celllong, type);",
+    # SQLite has one writer at a time, so seq already grows in commit order
+    "create table if not exists change_log ("
+    "seq integer primary key autoincrement, celllat integer not null, celllong integer not null, "
+    "kind text not null, op text not null, exactlat real, exactlong real, type text, coords text, "
+    "submitdate text, submittime text);",
+    "create index if not exists change_cell_idx on change_log (celllat, celllong, seq);",
+)
+
+RTREE_SCHEMA = (
+    "create virtual table if not exists marker_rtree using rtree(id, min_lat, max_lat, min_long, max_long);",
+    "create trigger if not exists marker_rtree_insert after insert on marker_data begin "
+    "insert into marker_rtree values (new.id, new.exactlat, new.exactlat, new.exactlong, new.exactlong); end;",
+    "create trigger if not exists marker_rtree_delete after delete on marker_data begin "
+    "delete from marker_rtree where id = old.id; end;",
+    # Markers stored before the R*Tree existed
+    "insert into marker_rtree select id, exactlat, exactlat, exactlong, exactlong from marker_data "
+    "where id not in (select id from marker_rtree);",
+)
+
+MARKERS_QUERY = ("select exactlat, exactlong, type, submitdate, submittime from marker_data "
+                 "where celllat = ? and celllong = ?;")
+CELLS_QUERY = ("select exactlat, exactlong, type, submitdate, submittime from marker_data "
+               "where celllat between ? and ? and celllong between ? and ?;")
+CELLS_BBOX_QUERY = ("select exactlat, exactlong, type, submitdate, submittime from marker_data "
+                    "where celllat between ? and ? and celllong between ? and ? "
+                    "and exactlat between ? and ? and exactlong between ? and ?;")
+# The R*Tree stores 32 bit floats rounded outwards, so it gives a superset
+# that the exact coords are checked against
+RTREE_BBOX_QUERY = ("select m.exactlat, m.exactlong, m.type, m.submitdate, m.submittime "
+                    "from marker_rtree r join marker_data m on m.id = r.id "
+                    "where r.max_lat >= ? and r.min_lat <= ? and r.max_long >= ? and r.min_long <= ? "
+                    "and m.exactlat between ? and ? and m.exactlong between ? and ?;")
+ADD_MARKER_QUERY = ("insert into marker_data (celllat, celllong, exactlat, exactlong, type, submitdate, submittime) "
+                    "values (?, ?, ?, ?, ?, ?, ?);")
+DEL_MARKERS_QUERY = ("delete from marker_data "
+                     "where celllat = ? and celllong = ? and exactlat = ? and exactlong = ?;")
+CELL_LIST_QUERY = ("select distinct celllat, celllong from marker_data;")
+ZONES_QUERY = ("select coords from zone_data where celllat = ? and celllong = ? and type = ?;")
+DEL_ZONES_QUERY = ("delete from zone_data where celllat = ? and celllong = ? and type = ?;")
+ADD_ZONE_QUERY = ("insert into zone_data (celllat, celllong, type, coords, submitdate, submittime) "
+                  "values (?, ?, ?, ?, ?, ?);")
+DEL_ZONE_QUERY = ("delete from zone_data where celllat = ? and celllong = ? and coords = ?;")
+LOG_QUERY = ("insert into change_log (celllat, celllong, kind, op, exactlat, exactlong, type, coords, submitdate, submittime) "
+             "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);")
+CHANGE_RANGE_QUERY = ("select coalesce(min(seq), 1), coalesce(max(seq), 0) from change_log;")
+PRUNE_QUERY = ("delete from change_log where seq <= ?;")
+CELL_SEQ_QUERY = ("select coalesce(max(seq), (select coalesce(min(seq), 1) - 1 from change_log)) "
+                  "from change_log where celllat = ? and celllong = ?;")
+COUNTS_QUERY = ("select celllat, celllong, type, count(*) from marker_data group by celllat, celllong, type;")
+ALL_ZONES_QUERY = ("select celllat, celllong, coords from zone_data where type = ?;")
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a SQLite file, through a pool of connections sized to the serving threads
+
+    Params:
+        config (models.Config): Config instance
+    """
+    def __init__(self, config) -> None:
+        self.path = config.SQLITE_PATH
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        cnx = self.__connect()
+        try:
+            for statement in SCHEMA:
+                cnx.execute(statement)
+            try:
+                for statement in RTREE_SCHEMA:
+                    cnx.execute(statement)
+                self.rtree = True
+            except sqlite3.OperationalError:
+                cnx.rollback()
+                msg.fail("SQLite was built without R*Tree, bbox queries use the cell index")
+                self.rtree = False
+            cnx.commit()
+        finally:
+            cnx.close()
+
+        # Nothing to health-check or recycle, the file doesn't go away
+        self.__pool = ConnectionPool(
+            self.__connect,
+            size=pool_size(config),
+            timeout=config.DB_POOL_TIMEOUT,
+            recycle=float("inf"),
+            ping_after=float("inf"))
+
+    def __connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the file
+
+        Returns:
+            sqlite3.Connection: The connection, pooled ones move between the serving threads
+        """
+        cnx = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=64)
+        cnx.execute("pragma journal_mode=wal;")
+        cnx.execute("pragma synchronous=normal;")
+        return cnx
+
+    @contextmanager
+    def __session(self):
+        """
+        Borrow a pooled connection for the duration of a with block, commit
+        after it or roll back if it raises
+
+        Raises:
+            StorageError: The statement was rejected (sqlite3.OperationalError / ProgrammingError)
+
+        Yields:
+            sqlite3.Cursor: The cursor
+        """
+        with metrics.STAGE_LATENCY.time("connect"):
+            cnx = self.__pool.acquire()
+        cursor = cnx.cursor()
+        failed = True
+        try:
+            yield cursor
+            cnx.commit()
+            failed = False
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            raise StorageError(str(e)) from e
+        finally:
+            discard = False
+            try:
+                if failed:
+                    cnx.rollback()
+                cursor.close()
+            except sqlite3.Error:
+                discard = True
+            self.__pool.release(cnx, discard=discard)
+
+    def markers(self, cell_lat: int, cell_long: int) -> list:
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                return cursor.execute(MARKERS_QUERY, (cell_lat, cell_long)).fetchall()
+
+    def iter_markers(self, cell_lat: int, cell_long: int, chunk_size: int):
+        with self.__session() as cursor:
+            cursor.execute(MARKERS_QUERY, (cell_lat, cell_long))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def markers_in_cells(self, min_cell: tuple, max_cell: tuple, bbox: tuple = None) -> list:
+        cells = (min_cell[0], max_cell[0], min_cell[1], max_cell[1])
+        if bbox is None:
+            query, params = CELLS_QUERY, cells
+        elif self.rtree:
+            # Every marker in the box is in one of its cells
+            box = (bbox[0], bbox[2], bbox[1], bbox[3])
+            query, params = RTREE_BBOX_QUERY, box + box
+        else:
+            query, params = CELLS_BBOX_QUERY, cells + (bbox[0], bbox[2], bbox[1], bbox[3])
+
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                return cursor.execute(query, params).fetchall()
+
+    def add_markers(self, rows: list) -> None:
+        with self.__session() as cursor:
+            cursor.executemany(ADD_MARKER_QUERY, rows)
+            cursor.executemany(LOG_QUERY, [
+                (cell_lat, cell_long, MARKER, ADDED, exact_lat, exact_long, _type, None, date, time)
+                for (cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in rows
+            ])
+
+    def del_markers(self, cell_lat: int, cell_long: int, exact_lat: float, exact_long: float) -> None:
+        with self.__session() as cursor:
+            cursor.execute(DEL_MARKERS_QUERY, (cell_lat, cell_long, exact_lat, exact_long))
+            if cursor.rowcount > 0:
+                cursor.execute(LOG_QUERY,
+                    (cell_lat, cell_long, MARKER, REMOVED, exact_lat, exact_long, None, None, None, None))
+
+    def cells(self) -> list:
+        with self.__session() as cursor:
+            return [(int(cell_lat), int(cell_long)) for (cell_lat, cell_long) in cursor.execute(CELL_LIST_QUERY)]
+
+    def zones(self, cell_lat: int, cell_long: int, _type: int) -> list:
+        with self.__session() as cursor:
+            return [coords for (coords, ) in cursor.execute(ZONES_QUERY, (cell_lat, cell_long, _type))]
+
+    def replace_zones(self, cell_lat: int, cell_long: int, _type: int,
+                      coords: list, date: str, time: str) -> None:
+        with self.__session() as cursor:
+            # Take the write lock before reading the old zones
+            cursor.execute("begin immediate;")
+            old = {zone_coords for (zone_coords, ) in cursor.execute(ZONES_QUERY, (cell_lat, cell_long, _type))}
+            cursor.execute(DEL_ZONES_QUERY, (cell_lat, cell_long, _type))
+            cursor.executemany(ADD_ZONE_QUERY, [
+                (cell_lat, cell_long, _type, zone_coords, date, time) for zone_coords in coords
+            ])
+            # Only what changed, most rebuilds give back the same zones
+            cursor.executemany(LOG_QUERY, [
+                (cell_lat, cell_long, ZONE, REMOVED, None, None, _type, zone_coords, None, None)
+                for zone_coords in old.difference(coords)
+            ] + [
+                (cell_lat, cell_long, ZONE, ADDED, None, None, _type, zone_coords, date, time)
+                for zone_coords in dict.fromkeys(coords) if zone_coords not in old
+            ])
+
+    def add_zone(self, cell_lat: int, cell_long: int, _type: int,
+                 coords: str, date: str, time: str) -> None:
+        with self.__session() as cursor:
+            cursor.execute(ADD_ZONE_QUERY, (cell_lat, cell_long, _type, coords, date, time))
+            cursor.execute(LOG_QUERY, (cell_lat, cell_long, ZONE, ADDED, None, None, _type, coords, date, time))
+
+    def del_zone(self, cell_lat: int, cell_long: int, coords: str) -> None:
+        with self.__session() as cursor:
+            cursor.execute(DEL_ZONE_QUERY, (cell_lat, cell_long, coords))
+            if cursor.rowcount > 0:
+                cursor.execute(LOG_QUERY, (cell_lat, cell_long, ZONE, REMOVED, None, None, None, coords, None, None))
+
+    def changes(self, cells: list, since: int, limit: int) -> list:
+        clause, params = cell_filter(cells, "?")
+        query = ("select seq, kind, op, exactlat, exactlong, type, coords, submitdate, submittime from change_log "
+                 f"where seq > ? and {clause} order by seq limit ?;")
+
+        with self.__session() as cursor:
+            with metrics.STAGE_LATENCY.time("query"):
+                return cursor.execute(query, (since, ) + params + (limit, )).fetchall()
+
+    def change_range(self) -> tuple:
+        with self.__session() as cursor:
+            first, last = cursor.execute(CHANGE_RANGE_QUERY).fetchone()
+            return int(first), int(last)
+
+    def prune_changes(self, keep: int) -> None:
+        with self.__session() as cursor:
+            last = cursor.execute(CHANGE_RANGE_QUERY).fetchone()[1]
+            cursor.execute(PRUNE_QUERY, (last - max(keep, 1), ))
+
+    def cell_seq(self, cell_lat: int, cell_long: int) -> int:
+        with self.__session() as cursor:
+            return int(cursor.execute(CELL_SEQ_QUERY, (cell_lat, cell_long)).fetchone()[0])
+
+    def snapshot(self, cells: list, zone_type: int) -> tuple:
+        clause, params = cell_filter(cells, "?")
+        markers_query = f"select exactlat, exactlong, type, submitdate, submittime from marker_data where {clause};"
+        zones_query = f"select coords from zone_data where type = ? and {clause};"
+
+        with self.__session() as cursor:
+            # In WAL mode a read transaction sees the file as of its first read
+            cursor.execute("begin;")
+            seq = int(cursor.execute(CHANGE_RANGE_QUERY).fetchone()[1])
+            with metrics.STAGE_LATENCY.time("query"):
+                rows = cursor.execute(markers_query, params).fetchall()
+            zones = [coords for (coords, ) in cursor.execute(zones_query, (zone_type, ) + params)]
+            return seq, rows, zones
+
+    def summary(self, zone_type: int) -> tuple:
+        with self.__session() as cursor:
+            cursor.execute("begin;")
+            seq = int(cursor.execute(CHANGE_RANGE_QUERY).fetchone()[1])
+            with metrics.STAGE_LATENCY.time("query"):
+                counts = cursor.execute(COUNTS_QUERY).fetchall()
+            zones = cursor.execute(ALL_ZONES_QUERY, (zone_type, )).fetchall()
+            return seq, counts, zones
+
+    def stats(self) -> dict:
+        return self.__pool.stats()
+
+    def close(self) -> None:
+        self.__pool.close()
+
+# EOF
@@ -0,0 +1,82 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# The change log seq every cell is at, kept in memory so a conditional
+# get_markers / get_zones request is answered without the database. An entry
+# is dropped by the write events of this process and the ones relayed from
+# the other workers of api/prefork.py, and expires after etag_resync_interval
+# seconds, so writes that send no event (ex: bulk.py) are seen after that.
+
+__author__ = 'David Pescariu'
+
+import threading
+import api.events as events
+from api.cache import CellCache
+
+# Bounds of the seqs kept, an entry is a handful of small objects
+MAX_CELLS = 65536
+MAX_BYTES = 16 << 20
+
+__seqs = None
+__seqs_lock = threading.Lock()
+
+def get_seqs(config) -> CellCache:
+    """
+    Get the cell seqs, creating them on first use
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        CellCache: The seqs, keyed ("seq", lat, long)
+    """
+    global __seqs
+
+    if __seqs is None:
+        with __seqs_lock:
+            if __seqs is None:
+                __seqs = CellCache(config.ETAG_RESYNC_INTERVAL, MAX_CELLS, MAX_BYTES)
+                events.subscribe(__seqs.on_write)
+    return __seqs
+
+def cell_seq(config, cell: tuple, loader) -> int:
+    """
+    Get the seq a cell is at, from memory or loaded from the change log. A
+    seq loaded while the cell was written to isn't kept, see CellCache.
+
+    Args:
+        config (models.Config): Config instance
+        cell (tuple): (lat, long) of the cell
+        loader (callable): Reads it from the change log, ex: db.return_cell_seq
+
+    Returns:
+        int: The seq
+    """
+    return get_seqs(config).get_or_load(("seq", ) + tuple(cell), loader)
+
+async def cell_seq_async(config, cell: tuple, loader) -> int:
+    """
+    Same as cell_seq, for the asyncio serving mode
+
+    Args:
+        config (models.Config): Config instance
+        cell (tuple): (lat, long) of the cell
+        loader (callable): Returns an awaitable that reads it from the change log
+
+    Returns:
+        int: The seq
+    """
+    return await get_seqs(config).get_or_load_async(("seq", ) + tuple(cell), loader)
+
+def stats() -> dict:
+    """
+    Get the cell seq metrics
+
+    Returns:
+        dict: See CellCache.stats(), empty if no conditional request was made yet
+    """
+    if __seqs is None:
+        return {}
+    return __seqs.stats()
+
+# EOF
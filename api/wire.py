@@ -0,0 +1,237 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Compact binary encoding of the get_markers / get_zones data
+#
+# Every payload is little-endian and starts with a 8 byte header:
+#   magic (4s) b"PSMK" for markers / b"PSZN" for zones
+#   version (B) 1
+#   flags (B) bit 0 set = float64 coordinates, clear = float32
+#   reserved (H) 0
+#
+# Markers, after the header:
+#   count (I), lats (count floats), longs (count floats),
+#   types (count B, index in models.types.TYPES, 255 = unknown),
+#   submitted (count I, unix time, from the server's local submitdate / submittime)
+#
+# Zones, after the header:
+#   zones (I), points (I), points of every zone (zones I),
+#   lats (points floats), longs (points floats)
+#
+# The "end" items of the JSON responses are left out, the counts replace them.
+
+__author__ = 'David Pescariu'
+
+import struct
+from time import mktime
+from typing import List, Tuple
+from models.types import TYPES
+
+MIME_TYPE = "application/x-prisma-wire"
+
+MARKERS_MAGIC = b"PSMK"
+ZONES_MAGIC = b"PSZN"
+VERSION = 1
+FLAG_FLOAT64 = 1
+UNKNOWN_TYPE = 255
+
+__header = struct.Struct("<4sBBH")
+__count = struct.Struct("<I")
+
+TYPE_IDS = {_type: index for index, _type in enumerate(TYPES)}
+TYPE_NAMES = list(TYPES)
+
+def negotiate(req) -> int or None:
+    """
+        Get the encoding a request asked for, either with format=bin / bin32 or
+    with an Accept header of MIME_TYPE, "; precision=32" for float32
+
+    Args:
+        req (werkzeug.local.LocalProxy): Flask request
+
+    Returns:
+        int or None: Coordinate bits (32 / 64), None for JSON
+    """
+    _format = req.args.get('format')
+    if _format is not None:
+        return {"bin": 64, "bin64": 64, "bin32": 32}.get(_format)
+
+    for accepted in req.headers.get('Accept', "").split(','):
+        params = [param.strip() for param in accepted.split(';')]
+        if params[0] == MIME_TYPE:
+            return 32 if "precision=32" in params[1:] else 64
+    return None
+
+def __pack_header(magic: bytes, bits: int) -> bytes:
+    """
+    Pack the header of a payload
+
+    Args:
+        magic (bytes): MARKERS_MAGIC / ZONES_MAGIC
+        bits (int): 32 / 64
+
+    Returns:
+        bytes: The header
+    """
+    return __header.pack(magic, VERSION, FLAG_FLOAT64 if bits == 64 else 0, 0)
+
+def __unpack_header(payload: bytes, magic: bytes) -> str:
+    """
+    Check the header of a payload
+
+    Args:
+        payload (bytes): The payload
+        magic (bytes): Expected magic
+
+    Raises:
+        ValueError: Not a payload of this kind / version
+
+    Returns:
+        str: struct format char of the coordinates, "f" / "d"
+    """
+    _magic, version, flags, _ = __header.unpack_from(payload, 0)
+    if _magic != magic or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} {magic} payload")
+    return "d" if flags & FLAG_FLOAT64 else "f"
+
+def __hour_start(date: str, hour: int) -> int:
+    """
+        Convert a submitdate and the hour of its submittime to unix time. They
+    are written in the server's local time (datetime.now()), DST changes on
+    the hour are handled, so callers can cache it per hour.
+
+    Args:
+        date (str): ex: 2020-08-17
+        hour (int): ex: 10
+
+    Returns:
+        int: Seconds since the epoch of the start of that hour
+    """
+    year, month, day = date.split('-')
+    return int(mktime((int(year), int(month), int(day), hour, 0, 0, 0, 0, -1)))
+
+def encode_markers(markers: list, bits: int = 64) -> bytes:
+    """
+    Encode get_markers data
+
+    Args:
+        markers (list): ex: [46.7874&23.6018&robbery&2020-08-17&10:32:55, end]
+        bits (int, optional): Coordinate size, 32 / 64. Defaults to 64.
+
+    Returns:
+        bytes: The payload
+    """
+    lats, longs, types, submitted = [], [], [], []
+    hours_start = {}  # Most markers of a cell share a few dates
+    for marker in markers:
+        if marker == "end":
+            break
+        lat, long, _type, date, time = marker.split('&')
+        lats.append(float(lat))
+        longs.append(float(long))
+        types.append(TYPE_IDS.get(_type, UNKNOWN_TYPE))
+
+        hours, minutes, seconds = time.split(':')
+        start = hours_start.get((date, hours))
+        if start is None:
+            start = hours_start[(date, hours)] = __hour_start(date, int(hours))
+        submitted.append(start + int(minutes) * 60 + int(seconds))
+
+    n = len(lats)
+    coord = "d" if bits == 64 else "f"
+    return b"".join((
+        __pack_header(MARKERS_MAGIC, bits),
+        __count.pack(n),
+        struct.pack(f"<{n}{coord}", *lats),
+        struct.pack(f"<{n}{coord}", *longs),
+        bytes(types),
+        struct.pack(f"<{n}I", *submitted)
+    ))
+
+def encode_zones(zones: list, bits: int = 64) -> bytes:
+    """
+    Encode get_zones data
+
+    Args:
+        zones (list): ex: [[(46.78, 23.60), (46.79, 23.61), ...], ..., end]
+        bits (int, optional): Coordinate size, 32 / 64. Defaults to 64.
+
+    Returns:
+        bytes: The payload
+    """
+    sizes, lats, longs = [], [], []
+    for zone in zones:
+        if zone == "end":
+            break
+        sizes.append(len(zone))
+        for (lat, long) in zone:
+            lats.append(lat)
+            longs.append(long)
+
+    n = len(lats)
+    coord = "d" if bits == 64 else "f"
+    return b"".join((
+        __pack_header(ZONES_MAGIC, bits),
+        struct.pack("<II", len(sizes), n),
+        struct.pack(f"<{len(sizes)}I", *sizes),
+        struct.pack(f"<{n}{coord}", *lats),
+        struct.pack(f"<{n}{coord}", *longs)
+    ))
+
+def decode_markers(payload: bytes) -> List[Tuple[float, float, str, int]]:
+    """
+    Reference decoder for encode_markers payloads
+
+    Args:
+        payload (bytes): The payload
+
+    Returns:
+        List[Tuple[float, float, str, int]]: (lat, long, type, unix time) of every marker,
+        type is None for types the decoder doesn't know
+    """
+    coord = __unpack_header(payload, MARKERS_MAGIC)
+    offset = __header.size
+    (n, ) = __count.unpack_from(payload, offset)
+    offset += __count.size
+
+    lats = struct.unpack_from(f"<{n}{coord}", payload, offset)
+    offset += struct.calcsize(f"<{n}{coord}")
+    longs = struct.unpack_from(f"<{n}{coord}", payload, offset)
+    offset += struct.calcsize(f"<{n}{coord}")
+    types = payload[offset:offset + n]
+    offset += n
+    submitted = struct.unpack_from(f"<{n}I", payload, offset)
+
+    return [
+        (lats[i], longs[i], TYPE_NAMES[types[i]] if types[i] < len(TYPE_NAMES) else None, submitted[i])
+        for i in range(n)
+    ]
+
+def decode_zones(payload: bytes) -> List[List[Tuple[float, float]]]:
+    """
+    Reference decoder for encode_zones payloads
+
+    Args:
+        payload (bytes): The payload
+
+    Returns:
+        List[List[Tuple[float, float]]]: The zones, like get_zones without the "end"
+    """
+    coord = __unpack_header(payload, ZONES_MAGIC)
+    offset = __header.size
+    zones, n = struct.unpack_from("<II", payload, offset)
+    offset += 8
+
+    sizes = struct.unpack_from(f"<{zones}I", payload, offset)
+    offset += 4 * zones
+    lats = struct.unpack_from(f"<{n}{coord}", payload, offset)
+    offset += struct.calcsize(f"<{n}{coord}")
+    longs = struct.unpack_from(f"<{n}{coord}", payload, offset)
+
+    _zones, start = [], 0
+    for size in sizes:
+        _zones.append(list(zip(lats[start:start + size], longs[start:start + size])))
+        start += size
+    return _zones
+
+# EOF
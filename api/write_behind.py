@@ -0,0 +1,355 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Write-behind queue for add_marker (write_behind_enabled). A marker is
+# acknowledged once it's validated and queued, a background thread commits the
+# queue in groups: every write_behind_flush_ms or as soon as
+# write_behind_batch_rows are waiting, in a single transaction.
+#
+# Queued markers are appended to a spill file before they're acknowledged,
+# followed by {"committed": n} once the oldest n are committed, so the ones
+# still queued when the process died are committed on the next start. The
+# file is emptied whenever the queue is. It's flushed to the OS, not fsync'ed:
+# it survives the process crashing, not the machine. Delivery is at least
+# once, a crash between a commit and its line commits the group again. A group
+# the database rejects is split until only the rejected markers are left, those
+# are dropped and counted, the others are committed.
+
+__author__ = 'David Pescariu'
+
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from time import monotonic
+import utils.console_messages as msg
+import api.db_connector as db
+import api.events as events
+from api.storage import StorageError
+
+# add_marker status code when the queue stayed full for write_behind_block_timeout
+QUEUE_FULL = 2
+
+# Seconds between retries of a group that couldn't be committed
+RETRY_DELAY = 1.0
+
+class WriteBehind(threading.Thread):
+    """
+    Queues markers and commits them in groups
+
+    Params:
+        config (models.Config): Config instance
+        path (str): Spill file
+    """
+    def __init__(self, config, path: str) -> None:
+        super().__init__(name="write-behind", daemon=True)
+        self.config = config
+        self.path = path
+        self.flush_interval = config.WRITE_BEHIND_FLUSH_MS / 1000
+        self.batch_rows = max(1, config.WRITE_BEHIND_BATCH_ROWS)
+        self.max_queued = max(1, config.WRITE_BEHIND_MAX_QUEUE)
+        self.block_timeout = config.WRITE_BEHIND_BLOCK_TIMEOUT
+
+        self.__rows = deque()      # (cell_lat, cell_long, exact_lat, exact_long, type, date, time)
+        self.__oldest = None       # When the oldest queued row was queued
+        self.__cond = threading.Condition(threading.Lock())
+        self.__stopped = False
+        self.__spilled = 0         # Lines in the spill file
+
+        self.__flushed = 0
+        self.__dropped = 0
+        self.__groups = 0
+        self.__rejected = 0
+        self.__failed_flushes = 0
+        self.__replayed = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__replay()
+        self.__spill = open(path, "a")
+
+    def submit(self, row: tuple, block: bool = True) -> bool:
+        """
+        Queue a marker, waiting up to write_behind_block_timeout while the queue is full
+
+        Args:
+            row (tuple): (cell_lat, cell_long, exact_lat, exact_long, type, date, time)
+            block (bool, optional): Wait for room, False to give up right away. Defaults to True.
+
+        Returns:
+            bool: True if it was queued, False if the queue is full or stopped
+        """
+        with self.__cond:
+            deadline = monotonic() + (self.block_timeout if block else 0)
+            while len(self.__rows) >= self.max_queued and not self.__stopped:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.__cond.wait(remaining)
+            if self.__stopped or len(self.__rows) >= self.max_queued:
+                self.__rejected += 1
+                return False
+
+            self.__spill.write(json.dumps(row) + "\n")
+            self.__spill.flush()
+            self.__spilled += 1
+            if not self.__rows:
+                self.__oldest = monotonic()
+            self.__rows.append(row)
+            # Wake the flusher for its first row (to start the timer) and a full group
+            if len(self.__rows) == 1 or len(self.__rows) >= self.batch_rows:
+                self.__cond.notify_all()
+        return True
+
+    def run(self) -> None:
+        """
+        Commit groups until stopped and the queue is empty
+        """
+        while True:
+            with self.__cond:
+                while not self.__rows and not self.__stopped:
+                    self.__cond.wait()
+                if not self.__rows:
+                    break
+                # Let the group fill up, unless it's full already or we're stopping
+                while len(self.__rows) < self.batch_rows and not self.__stopped:
+                    remaining = self.__oldest + self.flush_interval - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+                group = [self.__rows.popleft() for _ in range(min(self.batch_rows, len(self.__rows)))]
+                self.__oldest = monotonic()
+
+            done, dropped = self.__commit(group)
+            with self.__cond:
+                # Back in front, in order, they're still in the spill file
+                self.__rows.extendleft(reversed(group[done:]))
+                if done:
+                    self.__flushed += done - dropped
+                    self.__dropped += dropped
+                    self.__spill.write(json.dumps(dict(committed=done)) + "\n")
+                    self.__spill.flush()
+                    self.__spilled += 1
+                    self.__compact()
+                    self.__cond.notify_all()
+                if done == len(group):
+                    self.__groups += 1
+                    continue
+                stopping = self.__stopped
+
+            if stopping:
+                msg.fail(f"[WRITE_BEHIND] {len(self.__rows)} markers left in {self.path}, "
+                         "they're committed on the next start")
+                break
+            with self.__cond:
+                self.__cond.wait(RETRY_DELAY)
+
+    def stop(self) -> None:
+        """
+        Commit what's queued and stop, new markers are refused from now on
+        """
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        if self.is_alive():
+            self.join()
+        with self.__cond:
+            self.__spill.close()
+
+    def stats(self) -> dict:
+        """
+        Get the queue metrics
+
+        Returns:
+            dict: Queue size, rows committed / dropped, groups, rejected rows...
+        """
+        with self.__cond:
+            return dict(
+                queued=len(self.__rows),
+                max_queued=self.max_queued,
+                flushed=self.__flushed,
+                dropped=self.__dropped,
+                groups=self.__groups,
+                rejected=self.__rejected,
+                failed_flushes=self.__failed_flushes,
+                replayed=self.__replayed,
+                spilled=self.__spilled
+            )
+
+    def __commit(self, group: list) -> (int, int):
+        """
+            Add a group of markers in one transaction and publish their events.
+        If the database rejects it, it's split in halves, committed in order,
+        until only the rejected markers are left and those are dropped.
+
+        Args:
+            group (list): The rows
+
+        Returns:
+            (int, int): Rows done (committed or dropped) from the start of the group and how
+                many of them were dropped, the rest couldn't be committed and is retried
+        """
+        done = dropped = 0
+        pending = [group]
+        while pending:
+            rows = pending.pop()
+            try:
+                db.get_storage(self.config).add_markers(rows)
+            except StorageError as e:
+                if len(rows) > 1:
+                    half = len(rows) // 2
+                    pending += [rows[half:], rows[:half]]
+                    continue
+                # Retrying a statement the database rejects won't help
+                msg.fail(f"[WRITE_BEHIND] Dropped a marker, the database rejected it: {e}: {rows[0]}")
+                done += 1
+                dropped += 1
+                continue
+            except Exception as e:
+                with self.__cond:
+                    self.__failed_flushes += 1
+                msg.exception(e)
+                break
+
+            for (cell_lat, cell_long, exact_lat, exact_long, _type, date, time) in rows:
+                events.publish(events.MARKER_ADDED, (cell_lat, cell_long),
+                    lat=exact_lat, long=exact_long, type=_type, date=date, time=time)
+            done += len(rows)
+        return done, dropped
+
+    def __compact(self) -> None:
+        """
+        Empty the spill file once everything in it is committed, or rewrite it
+        with only the queued rows once it's a few queues long, so it can't
+        keep growing under a steady load. Hold the lock.
+        """
+        if not self.__rows:
+            self.__spill.seek(0)
+            self.__spill.truncate()
+            self.__spilled = 0
+        elif self.__spilled > 4 * self.max_queued:
+            self.__spill.close()
+            self.__write_spill(self.__rows)
+            self.__spill = open(self.path, "a")
+            self.__spilled = len(self.__rows)
+
+    def __write_spill(self, rows) -> None:
+        """
+        Replace the spill file with rows
+
+        Args:
+            rows (iterable): The rows
+        """
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as spill:
+            for row in rows:
+                spill.write(json.dumps(row) + "\n")
+        os.replace(temporary, self.path)
+
+    def __replay(self) -> None:
+        """
+        Queue the markers left in the spill file by the last run
+        """
+        if not os.path.exists(self.path):
+            return
+        committed = 0
+        with open(self.path) as spill:
+            for line in spill:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a crash can be cut short
+                    continue
+                if isinstance(entry, dict):
+                    committed += entry["committed"]
+                else:
+                    self.__rows.append(tuple(entry))
+        # Groups are committed oldest first
+        for _ in range(min(committed, len(self.__rows))):
+            self.__rows.popleft()
+        if self.__rows:
+            self.__oldest = monotonic()
+            self.__replayed = self.__spilled = len(self.__rows)
+            self.__write_spill(self.__rows)
+            msg.info(f"[WRITE_BEHIND] Queued {len(self.__rows)} markers left in {self.path}")
+
+__queue = None
+
+def start(config, worker: int = None) -> None:
+    """
+    Start the write-behind queue, if write_behind_enabled
+
+    Args:
+        config (models.Config): Config instance
+        worker (int, optional): Number of the worker process, each worker has its own spill file. Defaults to None.
+    """
+    global __queue
+
+    if not config.WRITE_BEHIND_ENABLED or __queue is not None:
+        return
+    path = config.WRITE_BEHIND_SPILL_FILE
+    if worker is not None:
+        base, dot, extension = path.rpartition('.')
+        path = f"{base}.worker{worker}.{extension}" if dot else f"{path}.worker{worker}"
+    __queue = WriteBehind(config, path)
+    __queue.start()
+    msg.info(f"Write-behind started, committing every {config.WRITE_BEHIND_FLUSH_MS}ms "
+             f"or {config.WRITE_BEHIND_BATCH_ROWS} markers")
+
+def stop() -> None:
+    """
+    Commit what's queued and stop the write-behind queue, if it was started
+    """
+    global __queue
+
+    if __queue is not None:
+        __queue.stop()
+        __queue = None
+
+def is_running() -> bool:
+    """
+    Check if markers are queued instead of added right away
+
+    Returns:
+        bool: True / False
+    """
+    return __queue is not None
+
+def add_marker(config, exact_lat: float, exact_long: float, _type: str, block: bool = True) -> int:
+    """
+    Queue a marker, or add it right away through db_connector if the queue isn't running
+
+    Args:
+        config (models.Config): Config instance
+        exact_lat (float): The exact lat of the marker
+        exact_long (float): The exact long of the marker
+        _type (str): The type of the marker
+        block (bool, optional): Wait for room in a full queue. Defaults to True.
+
+    Returns:
+        int: Status code -> same as db_connector.add_marker, 2=QUEUE_FULL
+    """
+    queue = __queue
+    if queue is None:
+        return db.add_marker(config, exact_lat, exact_long, _type)
+
+    cell_lat, cell_long = db.cell_of(exact_lat, exact_long)
+    date = datetime.today().strftime('%Y-%m-%d')
+    time = datetime.now().strftime("%H:%M:%S")
+    if queue.submit((cell_lat, cell_long, exact_lat, exact_long, _type, date, time), block):
+        return 0
+    return QUEUE_FULL
+
+def stats() -> dict:
+    """
+    Get the queue metrics
+
+    Returns:
+        dict: See WriteBehind.stats(), empty if it isn't running
+    """
+    queue = __queue
+    if queue is None:
+        return {}
+    return queue.stats()
+
+# EOF
@@ -4,7 +4,14 @@
 __author__ = 'Ioana Gabor'
 # Refactor: David Pescariu
 
+import math
+from functools import lru_cache
 from typing import List, Tuple
+from utils.console_messages import fail
+import api.metrics as metrics
+
+# Half of the 8 neighbouring grid cells, enough to visit every pair of cells once
+NEIGHBOUR_OFFSETS = ((1, -1), (1, 0), (1, 1), (0, 1))
 
 class ZoneBuilder:
     """
@@ -16,10 +23,13 @@ class ZoneBuilder:
     """
     def __init__(self, marker_data: list, threshold: float = 0.004) -> None:
         self.threshold = threshold
-        self.markers = self.__parse_input(marker_data)
+        with metrics.STAGE_LATENCY.time("parse"):
+            self.markers = self.__parse_input(marker_data)
         self.sets = {}
-        self.__disjoint_sets(self.markers, self.sets)
-        self.zones = self.__get_zones(self.sets)
+        with metrics.STAGE_LATENCY.time("cluster"):
+            self.__disjoint_sets(self.markers, self.sets)
+        with metrics.STAGE_LATENCY.time("hull"):
+            self.zones = self.__get_zones(self.sets)
 
     def get_zones(self) -> List[List[Tuple[float, float]]]:
         """
@@ -30,6 +40,18 @@ class ZoneBuilder:
         """
         return self.zones
 
+    def get_border(self, zone: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+        """
+        Get the border of a single zone, the same way get_zones builds them
+
+        Args:
+            zone (List[Tuple[float, float]]): The markers of the zone, in input order
+
+        Returns:
+            List[Tuple[float, float]]: The border, the zone itself if it has less than 4 markers
+        """
+        return self.__get_border(list(zone))
+
     def __parse_input(self, marker_data: list) -> List[Tuple[float, float]]:
         """
         Parse the marker data and return a list of tuples with coords
@@ -51,33 +73,86 @@ class ZoneBuilder:
 
     def __disjoint_sets(self, markers: list, sets: dict) -> None:
         """
-        Ask Ioana :)
+            Group the markers into sets of markers that are chained together by
+        being within the threshold of each other. Sets are in the order of
+        their first marker and keep the markers in input order.
 
         Args:
             markers (list): Parsed list of markers
-            sets (dict): Ask Ioana :)
+            sets (dict): Output, label -> list of markers in that set
         """
         n = len(markers)
-        _labels = []
-        for i in range(0, n):
-            _labels.append(i)
+        _labels = list(range(0, n))
+        _ranks = [0] * n
+
+        for i, j in self.__neighbour_pairs(markers):
+            self.__union(i, j, _labels, _ranks)
 
         for i in range(0, n):
-            for j in range(0, i):
-                if self.__proximal_zones(markers[i], markers[j], self.threshold):
-                    self.__normalize_label(i, _labels)
-                    self.__normalize_label(j, _labels)
-                    if(_labels[i] < _labels[j]):
-                        _labels[j] = _labels[i]
-                    elif(_labels[i] > _labels[j]):
-                        _labels[i] = _labels[j]
-        
-        for i in range(0, n):
-            self.__normalize_label(i, _labels)
-            if bool(sets.get(_labels[i])) == False:
-                sets[_labels[i]] = []
-            sets[_labels[i]].append(markers[i])
-        
+            label = self.__normalize_label(i, _labels)
+            if label not in sets:
+                sets[label] = []
+            sets[label].append(markers[i])
+
+    def __neighbour_pairs(self, markers: list):
+        """
+            Find the pairs of markers within the threshold of each other.
+        Markers are bucketed in a grid of threshold sized cells, so only
+        markers from the same or adjacent cells have to be compared.
+
+        Args:
+            markers (list): Parsed list of markers
+
+        Yields:
+            Tuple[int, int]: Indexes of two proximal markers
+        """
+        grid = {}
+        for index, marker in enumerate(markers):
+            cell = (
+                math.floor(marker[0] / self.threshold), 
+                math.floor(marker[1] / self.threshold)
+            )
+            if cell not in grid:
+                grid[cell] = []
+            grid[cell].append(index)
+
+        for (cell_x, cell_y), members in grid.items():
+            # Pairs inside the cell
+            for a in range(0, len(members)):
+                for b in range(0, a):
+                    if self.__proximal_zones(markers[members[a]], markers[members[b]], self.threshold):
+                        yield members[a], members[b]
+
+            # Pairs with half of the neighbours, the other half visits this cell
+            for offset_x, offset_y in NEIGHBOUR_OFFSETS:
+                neighbours = grid.get((cell_x + offset_x, cell_y + offset_y))
+                if neighbours is None:
+                    continue
+                for i in members:
+                    for j in neighbours:
+                        if self.__proximal_zones(markers[i], markers[j], self.threshold):
+                            yield i, j
+
+    def __union(self, i: int, j: int, labels: list, ranks: list) -> None:
+        """
+        Merge the sets of two markers, the shallower tree goes under the deeper one
+
+        Args:
+            i (int): Index of the first marker
+            j (int): Index of the second marker
+            labels (list): Parent of every marker, roots point to themselves
+            ranks (list): Upper bound of the height of every root's tree
+        """
+        root_i = self.__normalize_label(i, labels)
+        root_j = self.__normalize_label(j, labels)
+        if root_i == root_j:
+            return
+        if ranks[root_i] < ranks[root_j]:
+            root_i, root_j = root_j, root_i
+        labels[root_j] = root_i
+        if ranks[root_i] == ranks[root_j]:
+            ranks[root_i] += 1
+
     def __proximal_zones(self, zone1: Tuple, zone2: Tuple, threshold: float) -> bool:
         """
             Checks, using the Euclidean Distance Formula if two zones are within 
@@ -96,20 +171,24 @@ class ZoneBuilder:
             (zone1[1] - zone2[1]) **2 <= threshold ** 2
         )
 
-    def __normalize_label(self, index: int, labels: list) -> float:
+    def __normalize_label(self, index: int, labels: list) -> int:
         """
-        Doing some kind of normalizing, ask Ioana
+            Find the root label of a marker's set, pointing every marker on the
+        way directly at the root so later lookups are shorter
 
         Args:
-            index (int): ?
+            index (int): Index of the marker
             labels (list): Labels list from disjoint_sets
 
         Returns:
-            float: ?
+            int: The root label
         """
-        if(labels[index] != index):
-            labels[index] = self.__normalize_label(labels[index], labels)    
-        return labels[index]
+        root = index
+        while labels[root] != root:
+            root = labels[root]
+        while labels[index] != root:
+            labels[index], index = root, labels[index]
+        return root
 
     def __counterclockwise_order(self, point1: Tuple, point2: Tuple, point3: Tuple) -> bool:
         """
@@ -195,4 +274,23 @@ class ZoneBuilder:
             _zones.append(zone)
         return _zones
 
+@lru_cache(maxsize=None)
+def get_zone_builder(engine: str) -> type:
+    """
+    Get the zone builder for the configured engine
+
+    Args:
+        engine (str): "python" / "numpy", numpy falls back to python if NumPy is missing
+
+    Returns:
+        type: ZoneBuilder or NumpyZoneBuilder, both take (marker_data, threshold)
+    """
+    if engine == "numpy":
+        try:
+            from api.zone_builder_np import NumpyZoneBuilder
+            return NumpyZoneBuilder
+        except ImportError:
+            fail("NumPy not found, falling back to the python zone engine")
+    return ZoneBuilder
+
 # EOF
@@ -0,0 +1,254 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+from typing import List, Tuple
+import numpy as np
+import api.metrics as metrics
+
+try:
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    cKDTree = None
+
+# Max number of distances computed at once when searching without SciPy
+BLOCK_SIZE = 1 << 22
+
+class NumpyZoneBuilder:
+    """
+    Generates the zones, same sets as ZoneBuilder but the markers are kept in
+    float64 arrays and the distance checks / hulls are vectorized. Hulls are
+    always convex, ZoneBuilder only pops one point per step of its chain.
+
+    Params:
+        marker_data (list): The list of markers, ex: [46.7874&23.6018&robbery&2020-08-17&10:32:55, end]
+        threshold (float, optional): Threshold for the zone creation. Defaults to 0.004.
+    """
+    def __init__(self, marker_data: list, threshold: float = 0.004) -> None:
+        self.threshold = threshold
+        with metrics.STAGE_LATENCY.time("parse"):
+            self.lats, self.longs = self.__parse_input(marker_data)
+        with metrics.STAGE_LATENCY.time("cluster"):
+            self.labels = self.__disjoint_sets(self.lats, self.longs)
+        with metrics.STAGE_LATENCY.time("hull"):
+            self.zones = self.__get_zones(self.lats, self.longs, self.labels)
+
+    def get_zones(self) -> List[List[Tuple[float, float]]]:
+        """
+        Get zones
+
+        Returns:
+            List[List[Tuple[float, float]]]: List containing zones(lists), with their coords(tuples)
+        """
+        return self.zones
+
+    def __parse_input(self, marker_data: list) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Parse the marker data into coordinate arrays
+
+        Args:
+            marker_data (list): Raw data
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Contiguous float64 arrays of lats and longs
+        """
+        coords = []
+        for marker in marker_data:
+            if marker == "end":
+                break
+            parsed = marker.split('&', 2)
+            coords.append(float(parsed[0]))
+            coords.append(float(parsed[1]))
+
+        points = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        return np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1])
+
+    def __proximal_pairs(self, lats: np.ndarray, longs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Find every pair of markers within the threshold, with a KD-tree when
+        SciPy is available, otherwise with blocks of distances between markers
+        sorted by lat
+
+        Args:
+            lats (np.ndarray): Marker lats
+            longs (np.ndarray): Marker longs
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Indexes of the first and second marker of every pair
+        """
+        # Candidates are searched with a little slack, the exact check below
+        # is the same formula ZoneBuilder uses, so both engines agree on edges
+        slack = self.threshold * (1 + 1e-9)
+
+        if cKDTree is not None:
+            tree = cKDTree(np.column_stack((lats, longs)))
+            pairs = tree.query_pairs(slack, output_type='ndarray')
+            first, second = pairs[:, 0], pairs[:, 1]
+        else:
+            order = np.argsort(lats, kind='stable')
+            sorted_lats, sorted_longs = lats[order], longs[order]
+            n = len(order)
+            firsts, seconds = [], []
+
+            start = 0
+            while start < n:
+                rows = min(256, n - start)
+                end = int(np.searchsorted(sorted_lats, sorted_lats[start + rows - 1] + slack, side='right'))
+                if rows * (end - start) > BLOCK_SIZE:
+                    rows = max(1, BLOCK_SIZE // (end - start))
+                    end = int(np.searchsorted(sorted_lats, sorted_lats[start + rows - 1] + slack, side='right'))
+
+                close = (
+                    (sorted_lats[start:start + rows, None] - sorted_lats[None, start:end]) **2 +
+                    (sorted_longs[start:start + rows, None] - sorted_longs[None, start:end]) **2
+                    <= slack ** 2
+                )
+                # Only keep every pair once
+                close &= np.arange(start, start + rows)[:, None] < np.arange(start, end)[None, :]
+                row, col = np.nonzero(close)
+                firsts.append(order[row + start])
+                seconds.append(order[col + start])
+                start += rows
+
+            first = np.concatenate(firsts) if firsts else np.empty(0, dtype=np.intp)
+            second = np.concatenate(seconds) if seconds else np.empty(0, dtype=np.intp)
+
+        keep = (lats[first] - lats[second]) **2 + (longs[first] - longs[second]) **2 <= self.threshold ** 2
+        return first[keep], second[keep]
+
+    def __disjoint_sets(self, lats: np.ndarray, longs: np.ndarray) -> np.ndarray:
+        """
+        Label the markers so chained markers share the label of their first marker
+
+        Args:
+            lats (np.ndarray): Marker lats
+            longs (np.ndarray): Marker longs
+
+        Returns:
+            np.ndarray: Label of every marker, the lowest index in its set
+        """
+        n = len(lats)
+        first, second = self.__proximal_pairs(lats, longs)
+
+        if cKDTree is not None:
+            graph = coo_matrix((np.ones(len(first), dtype=np.int8), (first, second)), shape=(n, n))
+            _, components = connected_components(graph, directed=False)
+            lowest = np.full(components.max() + 1 if n else 0, n, dtype=np.intp)
+            np.minimum.at(lowest, components, np.arange(n))
+            return lowest[components]
+
+        # Hook every root onto the lowest neighbouring root, then flatten the
+        # trees by pointer jumping, until nothing changes
+        labels = np.arange(n)
+        while True:
+            lowest = np.minimum(labels[first], labels[second])
+            hooked = labels.copy()
+            np.minimum.at(hooked, labels[first], lowest)
+            np.minimum.at(hooked, labels[second], lowest)
+            while True:
+                jumped = hooked[hooked]
+                if np.array_equal(jumped, hooked):
+                    break
+                hooked = jumped
+            if np.array_equal(hooked, labels):
+                return labels
+            labels = hooked
+
+    def __counterclockwise_order(self, point1: Tuple, point2: Tuple, point3: Tuple) -> bool:
+        """
+            Checks if 3 given points are in a counter clockwise order. Unlike
+        ZoneBuilder, the cross product is taken relative to point1, the
+        expanded form loses most of its precision at lat/long magnitudes.
+
+        Args:
+            point1 (Tuple): Point 1
+            point2 (Tuple): Point 2
+            point3 (Tuple): Point 3
+
+        Returns:
+            bool: True / False
+        """
+        return (
+            (point2[0] - point1[0]) * (point3[1] - point1[1]) -
+            (point2[1] - point1[1]) * (point3[0] - point1[0]) > 0
+        )
+
+    def __convex_hull(self, lats: np.ndarray, longs: np.ndarray) -> list:
+        """
+            Get the hull of a zone, in the same order as ZoneBuilder: clockwise,
+        starting from the lowest point, without duplicates. The points strictly
+        inside the quadrilateral of the extreme points are dropped with
+        vectorized cross products first, so the monotone chain only walks the
+        remaining ones.
+
+        Args:
+            lats (np.ndarray): Lats of the zone's markers
+            longs (np.ndarray): Longs of the zone's markers
+
+        Returns:
+            list: The hull, as (lat, long) tuples
+        """
+        corners = np.array([np.argmin(lats), np.argmin(longs), np.argmax(lats), np.argmax(longs)])
+        start_lats, start_longs = lats[corners], longs[corners]
+        edge_lats = np.roll(start_lats, -1) - start_lats
+        edge_longs = np.roll(start_longs, -1) - start_longs
+
+        cross = (
+            edge_lats[:, None] * (longs[None, :] - start_longs[:, None]) -
+            edge_longs[:, None] * (lats[None, :] - start_lats[:, None])
+        )
+        extent = max(np.ptp(lats), np.ptp(longs)) ** 2
+        inside = np.all(cross > extent * 1e-9, axis=0)
+        lats, longs = lats[~inside], longs[~inside]
+
+        # Sorted by lat then long like ZoneBuilder, duplicates would stall the
+        # chain since collinear points are kept
+        zone = [tuple(point) for point in np.unique(np.column_stack((lats, longs)), axis=0).tolist()]
+
+        n = len(zone)
+        # Markers at the same coords, the chain would pop the only point left
+        if n < 3:
+            return zone
+        stack = []
+        for i in range(0, n):
+            while len(stack) > 1 and self.__counterclockwise_order(stack[-2], stack[-1], zone[i]):
+                stack.pop()
+            stack.append(zone[i])
+
+        lower = len(stack)
+        for i in range(n-2, -1, -1):
+            while len(stack) > lower and self.__counterclockwise_order(stack[-2], stack[-1], zone[i]):
+                stack.pop()
+            stack.append(zone[i])
+
+        stack.pop()
+        return stack
+
+    def __get_zones(self, lats: np.ndarray, longs: np.ndarray, labels: np.ndarray) -> List[List[Tuple[float, float]]]:
+        """
+        Build final zones, in the order of their first marker
+
+        Args:
+            lats (np.ndarray): Marker lats
+            longs (np.ndarray): Marker longs
+            labels (np.ndarray): Labels from disjoint_sets
+
+        Returns:
+            List[List[Tuple[float, float]]]: Explained in get_zones
+        """
+        order = np.argsort(labels, kind='stable')
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+
+        _zones = []
+        for members in np.split(order, bounds) if len(order) else []:
+            zone_lats, zone_longs = lats[members], longs[members]
+            if len(members) < 4:
+                _zones.append(list(zip(zone_lats.tolist(), zone_longs.tolist())))
+            else:
+                _zones.append(self.__convex_hull(zone_lats, zone_longs))
+        return _zones
+
+# EOF
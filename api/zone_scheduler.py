@@ -0,0 +1,207 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+import threading
+from time import monotonic
+import utils.console_messages as msg
+import api.db_connector as db
+import api.events as events
+from api.zone_state import CellZones
+
+class ZoneScheduler(threading.Thread):
+    """
+        Rebuilds the zones of the cells that got new / deleted markers and
+    stores them in zone_data, so get_zones doesn't have to build them. Every
+    cell is rebuilt once on start.
+
+        With incremental_zones, the zones of every cell are kept in a CellZones
+    that new / deleted markers are applied to as they are written, so a run
+    only has to store them. Every zone_verify_interval seconds the states are
+    checked against a full rebuild from the database and rebuilt on mismatch.
+
+    Params:
+        config (models.Config): Config instance
+    """
+    def __init__(self, config) -> None:
+        super().__init__(name="zone-scheduler", daemon=True)
+        self.config = config
+        self.interval = config.ZONE_REBUILD_INTERVAL
+        self.incremental = config.INCREMENTAL_ZONES
+        self.verify_interval = config.ZONE_VERIFY_INTERVAL
+        self.__dirty = set()
+        self.__dirty_lock = threading.Lock()
+        self.__states = {}    # cell -> CellZones
+        self.__building = {}  # cell -> True if it was written while being built
+        self.__states_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        events.subscribe(self.__on_write)
+
+    def mark_dirty(self, cell: tuple) -> None:
+        """
+        Queue a cell to be rebuilt on the next run
+
+        Args:
+            cell (tuple): (lat, long) of the cell
+        """
+        with self.__dirty_lock:
+            self.__dirty.add(cell)
+
+    def run(self) -> None:
+        """
+        Rebuild every cell, then the dirty ones every interval, until stopped
+        """
+        try:
+            for cell in db.return_cells(self.config):
+                self.mark_dirty(cell)
+        except Exception as e:
+            msg.exception(e, "zones")
+
+        last_verify = monotonic()
+        while not self.__stopped.is_set():
+            self.rebuild_dirty()
+            if self.incremental and self.verify_interval > 0 and monotonic() - last_verify > self.verify_interval:
+                self.verify_states()
+                last_verify = monotonic()
+            self.__stopped.wait(self.interval)
+
+    def rebuild_dirty(self) -> None:
+        """
+        Rebuild and store the zones of every dirty cell, one transaction per cell.
+        Cells that fail stay dirty for the next run.
+        """
+        with self.__dirty_lock:
+            dirty, self.__dirty = self.__dirty, set()
+
+        for cell in dirty:
+            if self.__stopped.is_set():
+                self.mark_dirty(cell)
+                continue
+            try:
+                zones = self.__cell_zones(cell)
+                response = db.store_zones(self.config, cell[0], cell[1], zones)
+                if response != 0:
+                    msg.fail(f"Recieved {response} from method store_zones for cell {cell}", "zones")
+                    self.mark_dirty(cell)
+            except Exception as e:
+                msg.exception(e, "zones")
+                self.mark_dirty(cell)
+
+    def verify_states(self) -> None:
+        """
+        Check every incremental state against a full rebuild from the database,
+        the ones that drifted get rebuilt on the next run
+        """
+        with self.__states_lock:
+            cells = list(self.__states)
+
+        for cell in cells:
+            if self.__stopped.is_set():
+                return
+            try:
+                markers = db.return_markers(self.config, cell[0], cell[1])
+                with self.__states_lock:
+                    state = self.__states.get(cell)
+                    if state is None or state.verify(markers):
+                        continue
+                    del self.__states[cell]
+                msg.fail(f"Incremental zones of cell {cell} drifted from the database, rebuilding", "zones")
+                self.mark_dirty(cell)
+            except Exception as e:
+                msg.exception(e, "zones")
+
+    def __cell_zones(self, cell: tuple) -> list:
+        """
+        Get the zones to store for a cell, from its incremental state if it has
+        one, otherwise by building them from the database
+
+        Args:
+            cell (tuple): (lat, long) of the cell
+
+        Returns:
+            list: The zones
+        """
+        if not self.incremental:
+            return db.build_zones(self.config, cell[0], cell[1])
+
+        with self.__states_lock:
+            state = self.__states.get(cell)
+            if state is not None:
+                return list(state.get_zones())
+            self.__building[cell] = False
+
+        try:
+            state = CellZones.from_marker_data(db.return_markers(self.config, cell[0], cell[1]))
+        finally:
+            with self.__states_lock:
+                written = self.__building.pop(cell)
+
+        # A write between reading the markers and now may or may not be in the
+        # state, so only keep it if there was none
+        with self.__states_lock:
+            if written:
+                self.mark_dirty(cell)
+            else:
+                self.__states[cell] = state
+        return list(state.get_zones())
+
+    def stop(self) -> None:
+        """
+        Stop after the cell being rebuilt, if any
+        """
+        self.__stopped.set()
+        events.unsubscribe(self.__on_write)
+
+    def __on_write(self, event: str, cell: tuple, data: dict) -> None:
+        """
+        Mark the cell of new / deleted markers as dirty and apply them to its
+        incremental state
+
+        Args:
+            event (str): Event name, see api.events
+            cell (tuple): (lat, long) of the cell
+            data (dict): Event details
+        """
+        if event not in (events.MARKER_ADDED, events.MARKERS_DELETED):
+            return
+
+        if self.incremental:
+            with self.__states_lock:
+                if cell in self.__building:
+                    self.__building[cell] = True
+                state = self.__states.get(cell)
+                if state is not None:
+                    if event == events.MARKER_ADDED:
+                        state.add(data["lat"], data["long"])
+                    else:
+                        state.remove(data["lat"], data["long"])
+        self.mark_dirty(cell)
+
+__scheduler = None
+
+def start(config) -> None:
+    """
+    Start the zone scheduler, if precompute_zones is enabled
+
+    Args:
+        config (models.Config): Config instance
+    """
+    global __scheduler
+
+    if config.PRECOMPUTE_ZONES and __scheduler is None:
+        __scheduler = ZoneScheduler(config)
+        __scheduler.start()
+        msg.info(f"Zone scheduler started, rebuilding every {config.ZONE_REBUILD_INTERVAL}s", "zones")
+
+def stop() -> None:
+    """
+    Stop the zone scheduler, if it was started
+    """
+    global __scheduler
+
+    if __scheduler is not None:
+        __scheduler.stop()
+        __scheduler = None
+
+# EOF
@@ -0,0 +1,306 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+__author__ = 'David Pescariu'
+
+import heapq
+import math
+from typing import List, Tuple
+from api.zone_builder import ZoneBuilder
+
+class CellZones:
+    """
+        Keeps the zones of a cell up to date as markers are added and deleted,
+    without re-clustering the whole cell. Adding a marker only looks at the
+    markers around it and rebuilds the border of the zone it joined, deleting
+    one only re-clusters the zone it was part of.
+
+        The zones are the same as ZoneBuilder's for the markers in the order
+    they were added, see verify().
+
+    Params:
+        markers (List[Tuple[float, float]]): Initial markers, as (lat, long)
+        threshold (float, optional): Threshold for the zone creation. Defaults to 0.004.
+    """
+    def __init__(self, markers: List[Tuple[float, float]], threshold: float = 0.004) -> None:
+        self.threshold = threshold
+        self.__builder = ZoneBuilder(["end"], threshold)
+        self.__next_id = 0
+        self.__points = {}   # id -> (lat, long)
+        self.__grid = {}     # grid cell -> set of ids
+        self.__labels = {}   # id -> parent id, roots point to themselves
+        self.__ranks = {}    # root -> rank
+        self.__members = {}  # root -> ids in the zone, ascending
+        self.__borders = {}  # root -> border of the zone
+        self.__zones = None  # get_zones() cache
+
+        for point in markers:
+            self.__insert(point)
+        self.__regroup(list(self.__points))
+
+    @classmethod
+    def from_marker_data(cls, marker_data: list, threshold: float = 0.004) -> 'CellZones':
+        """
+        Build the state from db_connector.return_markers data
+
+        Args:
+            marker_data (list): The list of markers, ex: [46.7874&23.6018&robbery&2020-08-17&10:32:55, end]
+            threshold (float, optional): Threshold for the zone creation. Defaults to 0.004.
+
+        Returns:
+            CellZones: The state
+        """
+        markers = []
+        for marker in marker_data:
+            if marker == "end":
+                break
+            parsed = marker.split('&', 2)
+            markers.append((float(parsed[0]), float(parsed[1])))
+        return cls(markers, threshold)
+
+    def __len__(self) -> int:
+        return len(self.__points)
+
+    def get_zones(self) -> List[List[Tuple[float, float]]]:
+        """
+        Get zones
+
+        Returns:
+            List[List[Tuple[float, float]]]: Same as ZoneBuilder.get_zones()
+        """
+        if self.__zones is None:
+            roots = sorted(self.__members, key=lambda root: self.__members[root][0])
+            self.__zones = [self.__borders[root] for root in roots]
+        return self.__zones
+
+    def add(self, lat: float, long: float) -> None:
+        """
+        Add a marker, merging the zones within the threshold of it
+
+        Args:
+            lat (float): The exact lat of the marker
+            long (float): The exact long of the marker
+        """
+        point = (lat, long)
+        roots = {self.__find(neighbour) for neighbour in self.__neighbours(point)}
+        members = list(heapq.merge(*(self.__members.pop(root) for root in roots)))
+        for root in roots:
+            del self.__borders[root]
+
+        index = self.__insert(point)
+        members.append(index)
+        root = self.__find(index)
+        self.__members[root] = members
+        self.__borders[root] = self.__border(root)
+        self.__zones = None
+
+    def remove(self, lat: float, long: float) -> int:
+        """
+        Delete every marker at the exact coords, splitting the zones they were part of
+
+        Args:
+            lat (float): The exact lat of the marker(s)
+            long (float): The exact long of the marker(s)
+
+        Returns:
+            int: How many markers were deleted
+        """
+        grid_cell = self.__grid_cell((lat, long))
+        removed = [
+            index for index in self.__grid.get(grid_cell, ())
+            if self.__points[index] == (lat, long)
+        ]
+        if not removed:
+            return 0
+
+        affected = {self.__find(index) for index in removed}
+        for index in removed:
+            del self.__points[index]
+            self.__grid[grid_cell].discard(index)
+        if not self.__grid[grid_cell]:
+            del self.__grid[grid_cell]
+
+        for index in removed:
+            del self.__labels[index]
+            self.__ranks.pop(index, None)
+        for root in affected:
+            members = [index for index in self.__members.pop(root) if index in self.__points]
+            del self.__borders[root]
+            self.__split(members)
+
+        self.__zones = None
+        return len(removed)
+
+    def verify(self, marker_data: list = None) -> bool:
+        """
+            Check the state against a full rebuild with ZoneBuilder, either of
+        the state's own markers (exact same zones) or of the given marker data,
+        ex: fresh from the database (same zones, in any order, to 6 decimals)
+
+        Args:
+            marker_data (list, optional): Markers to rebuild from. Defaults to the state's markers.
+
+        Returns:
+            bool: True if the zones match
+        """
+        if marker_data is None:
+            marker_data = [f"{lat}&{long}" for (lat, long) in self.__points.values()]
+            marker_data.append("end")
+            return ZoneBuilder(marker_data, self.threshold).get_zones() == self.get_zones()
+
+        # The database may keep less digits than the requests had
+        def normalized(zones: list) -> list:
+            return sorted(sorted((round(lat, 6), round(long, 6)) for (lat, long) in zone) for zone in zones)
+
+        rebuilt = ZoneBuilder(marker_data, self.threshold).get_zones()
+        return normalized(rebuilt) == normalized(self.get_zones())
+
+    def __insert(self, point: Tuple[float, float]) -> int:
+        """
+        Store a marker and union it with its neighbours, without updating the
+        member lists or borders
+
+        Args:
+            point (Tuple[float, float]): (lat, long)
+
+        Returns:
+            int: Id of the new marker
+        """
+        index = self.__next_id
+        self.__next_id += 1
+
+        self.__points[index] = point
+        self.__labels[index] = index
+        self.__ranks[index] = 0
+
+        for neighbour in self.__neighbours(point):
+            self.__union(index, neighbour)
+
+        grid_cell = self.__grid_cell(point)
+        if grid_cell not in self.__grid:
+            self.__grid[grid_cell] = set()
+        self.__grid[grid_cell].add(index)
+        return index
+
+    def __split(self, members: list) -> None:
+        """
+        Re-cluster the remaining markers of a zone that lost markers
+
+        Args:
+            members (list): Ids of the remaining markers, ascending
+        """
+        for index in members:
+            self.__labels[index] = index
+            self.__ranks[index] = 0
+
+        remaining = set(members)
+        for index in members:
+            for neighbour in self.__neighbours(self.__points[index]):
+                if neighbour in remaining:
+                    self.__union(index, neighbour)
+
+        self.__regroup(members)
+
+    def __regroup(self, members: list) -> None:
+        """
+        Rebuild the member lists and borders of the zones of some markers
+
+        Args:
+            members (list): Ids of every marker of those zones, ascending
+        """
+        roots = []
+        for index in members:
+            root = self.__find(index)
+            if root not in self.__members:
+                self.__members[root] = []
+                roots.append(root)
+            self.__members[root].append(index)
+
+        for root in roots:
+            self.__borders[root] = self.__border(root)
+
+    def __neighbours(self, point: Tuple[float, float]):
+        """
+        Find the stored markers within the threshold of a point
+
+        Args:
+            point (Tuple[float, float]): (lat, long)
+
+        Yields:
+            int: Ids of the proximal markers
+        """
+        cell_x, cell_y = self.__grid_cell(point)
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                for index in self.__grid.get((cell_x + offset_x, cell_y + offset_y), ()):
+                    other = self.__points[index]
+                    if (
+                        (point[0] - other[0]) **2 +
+                        (point[1] - other[1]) **2 <= self.threshold ** 2
+                    ):
+                        yield index
+
+    def __grid_cell(self, point: Tuple[float, float]) -> Tuple[int, int]:
+        """
+        Get the grid cell of a point, same grid as ZoneBuilder
+
+        Args:
+            point (Tuple[float, float]): (lat, long)
+
+        Returns:
+            Tuple[int, int]: The grid cell
+        """
+        return (
+            math.floor(point[0] / self.threshold),
+            math.floor(point[1] / self.threshold)
+        )
+
+    def __find(self, index: int) -> int:
+        """
+        Find the root of a marker's zone, with path compression
+
+        Args:
+            index (int): Id of the marker
+
+        Returns:
+            int: Id of the root
+        """
+        labels = self.__labels
+        root = index
+        while labels[root] != root:
+            root = labels[root]
+        while labels[index] != root:
+            labels[index], index = root, labels[index]
+        return root
+
+    def __union(self, i: int, j: int) -> None:
+        """
+        Merge the zones of two markers, the shallower tree goes under the deeper one
+
+        Args:
+            i (int): Id of the first marker
+            j (int): Id of the second marker
+        """
+        root_i, root_j = self.__find(i), self.__find(j)
+        if root_i == root_j:
+            return
+        if self.__ranks[root_i] < self.__ranks[root_j]:
+            root_i, root_j = root_j, root_i
+        self.__labels[root_j] = root_i
+        if self.__ranks[root_i] == self.__ranks[root_j]:
+            self.__ranks[root_i] += 1
+        del self.__ranks[root_j]
+
+    def __border(self, root: int) -> List[Tuple[float, float]]:
+        """
+        Build the border of a zone
+
+        Args:
+            root (int): Root of the zone
+
+        Returns:
+            List[Tuple[float, float]]: The border, like ZoneBuilder builds it
+        """
+        return self.__builder.get_border([self.__points[index] for index in self.__members[root]])
+
+# EOF
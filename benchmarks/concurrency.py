@@ -0,0 +1,185 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Latency / throughput of a running server under many concurrent clients, some
+# of them slow, to compare serve_mode "waitress" and "asgi". Start the server in
+# one mode, run this, restart it in the other mode and run it again:
+#   python3 benchmarks/concurrency.py --url http://127.0.0.1:8080 --key <key>
+#       [--path /get_markers?lat=46&long=23] [--clients 10,100,500]
+#       [--slow-clients 200] [--slow-delay 1] [--duration 10]
+
+__author__ = 'David Pescariu'
+
+import argparse
+import asyncio
+import json
+from time import perf_counter
+from urllib.parse import urlsplit
+
+async def request(host: str, port: int, target: str) -> int:
+    """
+    Send a GET and read the whole response
+
+    Args:
+        host (str): Server host
+        port (int): Server port
+        target (str): Path and query
+
+    Returns:
+        int: Status code
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+async def slow_client(host: str, port: int, target: str, delay: float, stop: asyncio.Event) -> None:
+    """
+    Keep sending the request one byte every `delay` seconds, holding a
+    connection the whole time, like a client on a bad mobile network
+
+    Args:
+        host (str): Server host
+        port (int): Server port
+        target (str): Path and query
+        delay (float): Seconds between bytes
+        stop (asyncio.Event): Set when the run is over
+    """
+    payload = f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(delay)
+            continue
+        try:
+            for i in range(len(payload)):
+                if stop.is_set():
+                    return
+                writer.write(payload[i:i + 1])
+                await writer.drain()
+                await asyncio.sleep(delay)
+            await reader.read()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+async def fast_client(host: str, port: int, target: str, stop: asyncio.Event,
+                      latencies: list, errors: list) -> None:
+    """
+    Send requests back to back until the run is over
+
+    Args:
+        host (str): Server host
+        port (int): Server port
+        target (str): Path and query
+        stop (asyncio.Event): Set when the run is over
+        latencies (list): Latencies of the successful requests are appended here
+        errors (list): Failed requests are appended here
+    """
+    while not stop.is_set():
+        start = perf_counter()
+        try:
+            status = await request(host, port, target)
+        except OSError as e:
+            errors.append(repr(e))
+            continue
+        if status == 200:
+            latencies.append(perf_counter() - start)
+        else:
+            errors.append(status)
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Get a percentile of sorted values
+
+    Args:
+        values (list): Sorted values
+        fraction (float): ex: 0.99
+
+    Returns:
+        float: The percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run(host: str, port: int, target: str, clients: int, slow_clients: int,
+              slow_delay: float, duration: float) -> dict:
+    """
+    Run the fast and slow clients for `duration` seconds
+
+    Args:
+        host (str): Server host
+        port (int): Server port
+        target (str): Path and query
+        clients (int): Number of fast clients
+        slow_clients (int): Number of slow clients
+        slow_delay (float): Seconds between the bytes of slow clients
+        duration (float): Seconds to run for
+
+    Returns:
+        dict: Results of the run
+    """
+    stop = asyncio.Event()
+    latencies, errors = [], []
+    tasks = [asyncio.ensure_future(slow_client(host, port, target, slow_delay, stop)) for _ in range(slow_clients)]
+    # Let the slow clients take their connections first
+    await asyncio.sleep(min(slow_delay, 1))
+    tasks += [asyncio.ensure_future(fast_client(host, port, target, stop, latencies, errors)) for _ in range(clients)]
+
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.wait(tasks, timeout=max(slow_delay, 5) * 2)
+    for task in tasks:
+        task.cancel()
+
+    latencies.sort()
+    return dict(
+        clients=clients,
+        slow_clients=slow_clients,
+        requests=len(latencies),
+        errors=len(errors),
+        rps=len(latencies) / duration,
+        p50_ms=percentile(latencies, 0.50) * 1000,
+        p95_ms=percentile(latencies, 0.95) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent clients against a running server")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--key", required=True, help="private key for the requests")
+    parser.add_argument("--path", default="/get_markers?lat=46&long=23")
+    parser.add_argument("--clients", default="10,100,500", help="comma separated, one run per value")
+    parser.add_argument("--slow-clients", type=int, default=200)
+    parser.add_argument("--slow-delay", type=float, default=1.0, help="seconds between the bytes of slow clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    separator = "&" if "?" in args.path else "?"
+    target = f"{args.path}{separator}key={args.key}"
+
+    results = []
+    for clients in (int(value) for value in args.clients.split(',')):
+        result = asyncio.run(run(url.hostname, url.port or 80, target, clients,
+            args.slow_clients, args.slow_delay, args.duration))
+        results.append(result)
+        if not args.json:
+            print(f"{clients:>5} clients + {args.slow_clients} slow: {result['rps']:8.1f} req/s, "
+                  f"p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, "
+                  f"p99 {result['p99_ms']:7.1f} ms, {result['errors']} errors")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# End-to-end benchmarks: every route of api/serve_api.py over HTTP, served by
+# waitress on a local port, with the "sqlite" storage backend (or "memory") so
+# nothing but this process is needed.
+
+__author__ = 'David Pescariu'
+
+import http.client
+import json
+import os
+import socket
+import threading
+from statistics import mean
+from time import perf_counter
+from waitress.server import create_server
+import models.config as config_module
+from models.config import Config
+from log.logger import initialize_logging
+import api.db_connector as db
+from benchmarks.synthetic import city_rows
+
+KEY = "benchmark-key"
+
+# Benchmarked cell, its neighbours only hold markers for the bbox routes and the writes
+CELL = (46, 23)
+NEIGHBOURS = ((46, 24), (47, 23))
+WRITE_CELL = (47, 24)
+
+def __free_port() -> int:
+    """
+    Get a free TCP port, for the serve_port of the config
+
+    Returns:
+        int: The port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def make_config(directory: str, overrides: dict) -> Config:
+    """
+        Load config/config.json through Config with overrides, the files are
+    written to the benchmark's directory. Rate limiting is off, logs only go
+    to a file there and so does the SQLite database.
+
+    Args:
+        directory (str): Temporary directory of the run
+        overrides (dict): config.json keys to change
+
+    Returns:
+        Config: The config
+    """
+    with open(config_module.CONFIG_FILE_PATH) as conf_file:
+        # The port is filled in on deploy
+        settings = json.loads(conf_file.read().replace("SERVE_PORT", str(__free_port())))
+    settings.update(
+        rate_limit_enabled=False,
+        log_console=False,
+        log_file=os.path.join(directory, "api_log.log"),
+        storage_backend="sqlite",
+        sqlite_path=os.path.join(directory, "data.sqlite"))
+    settings.update(overrides)
+
+    config_path = os.path.join(directory, "config.json")
+    key_path = os.path.join(directory, "keys.json")
+    with open(config_path, "w") as conf_file:
+        json.dump(settings, conf_file)
+    with open(key_path, "w") as key_file:
+        json.dump(dict(private_keys=[KEY], public_keys=[KEY], db_user="", db_pass=""), key_file)
+
+    paths = (config_module.CONFIG_FILE_PATH, config_module.KEY_FILE_PATH)
+    config_module.CONFIG_FILE_PATH, config_module.KEY_FILE_PATH = config_path, key_path
+    try:
+        config = Config()
+    finally:
+        config_module.CONFIG_FILE_PATH, config_module.KEY_FILE_PATH = paths
+    initialize_logging(config)
+    return config
+
+def routes() -> list:
+    """
+    Get the requests to benchmark, reads first so the writes don't invalidate them
+
+    Returns:
+        list: (name, method, target, body, headers)
+    """
+    lat, long = CELL
+    bbox = f"min_lat={lat}&min_long={long}&max_lat={lat + 1.5}&max_long={long + 1.5}"
+    write_lat, write_long = WRITE_CELL[0] + 0.5, WRITE_CELL[1] + 0.5
+    batch = json.dumps([
+        dict(lat=write_lat + i / 1e4, long=write_long, type="theft") for i in range(100)
+    ]).encode()
+    zone = f"{write_lat}@{write_long},{write_lat + 0.01}@{write_long},{write_lat}@{write_long + 0.01}"
+
+    return [
+        ("base", "GET", "/", None, {}),
+        ("public", "GET", f"/public?key={KEY}", None, {}),
+        ("get_markers", "GET", f"/get_markers?key={KEY}&lat={lat}&long={long}", None, {}),
+        ("get_markers.stream", "GET", f"/get_markers?key={KEY}&lat={lat}&long={long}&stream=1", None, {}),
+        ("get_markers.bin32", "GET", f"/get_markers?key={KEY}&lat={lat}&long={long}&format=bin32", None, {}),
+        ("get_markers.etag", "GET", f"/get_markers?key={KEY}&lat={lat}&long={long}", None, {"If-None-Match": "*"}),
+        ("get_markers_bbox", "GET", f"/get_markers_bbox?key={KEY}&{bbox}", None, {}),
+        ("get_zones", "GET", f"/get_zones?key={KEY}&lat={lat}&long={long}", None, {}),
+        ("get_zones.bin32", "GET", f"/get_zones?key={KEY}&lat={lat}&long={long}&format=bin32", None, {}),
+        ("get_zones_bbox", "GET", f"/get_zones_bbox?key={KEY}&{bbox}", None, {}),
+        ("metrics", "GET", f"/metrics?key={KEY}", None, {}),
+        ("add_marker", "GET", f"/add_marker?key={KEY}&type=theft&lat={write_lat}&long={write_long}", None, {}),
+        ("add_markers", "POST", f"/add_markers?key={KEY}", batch, {"Content-Type": "application/json"}),
+        ("del_markers", "GET", f"/del_markers?key={KEY}&lat={write_lat}&long={write_long}", None, {}),
+        ("add_zone", "GET", f"/add_zone?key={KEY}&type=1&coords={zone}", None, {}),
+        ("del_zone", "GET", f"/del_zone?key={KEY}&coords={zone}", None, {}),
+    ]
+
+def __client(port: int, method: str, target: str, body: bytes, headers: dict,
+             count: int, latencies: list, errors: list) -> None:
+    """
+    Send `count` requests on one keep-alive connection
+
+    Args:
+        port (int): Server port
+        method (str): HTTP method
+        target (str): Path and query
+        body (bytes): Request body, None for none
+        headers (dict): Request headers
+        count (int): Number of requests
+        latencies (list): Latencies of the successful requests are appended here
+        errors (list): Failed requests are appended here
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        for _ in range(count):
+            start = perf_counter()
+            connection.request(method, target, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            elapsed = perf_counter() - start
+            # Handlers answer failures with 200 and a FAIL key
+            if response.status >= 400 or data.startswith(b'{"FAIL"'):
+                errors.append((response.status, data[:100]))
+            else:
+                latencies.append(elapsed)
+    finally:
+        connection.close()
+
+def __percentile(values: list, fraction: float) -> float:
+    """
+    Get a percentile of sorted values
+
+    Args:
+        values (list): Sorted values
+        fraction (float): ex: 0.99
+
+    Returns:
+        float: The percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(port: int, route: tuple, requests: int, concurrency: int) -> dict:
+    """
+    Benchmark one route, after one request on its own (the cold one: empty cache,
+    zones not built yet)
+
+    Args:
+        port (int): Server port
+        route (tuple): (name, method, target, body, headers)
+        requests (int): Number of requests, split between the clients
+        concurrency (int): Number of concurrent clients
+
+    Returns:
+        dict: Latency percentiles (ms), requests per second and errors
+    """
+    _, method, target, body, headers = route
+    latencies, errors = [], []
+    __client(port, method, target, body, headers, 1, latencies, errors)
+    first_ms = latencies[0] * 1000 if latencies else None
+    latencies.clear()
+
+    per_client = max(1, requests // concurrency)
+    clients = [
+        threading.Thread(target=__client, args=(port, method, target, body, headers, per_client, latencies, errors))
+        for _ in range(concurrency)
+    ]
+    start = perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return dict(
+        requests=len(latencies),
+        errors=len(errors),
+        first_ms=first_ms,
+        mean_ms=mean(latencies) * 1000 if latencies else 0.0,
+        p50_ms=__percentile(latencies, 0.50) * 1000,
+        p95_ms=__percentile(latencies, 0.95) * 1000,
+        p99_ms=__percentile(latencies, 0.99) * 1000,
+        rps=len(latencies) / elapsed
+    )
+
+def run(directory: str, density: int, requests: int = 200, concurrency: int = 4,
+        overrides: dict = None, seed: int = 0) -> dict:
+    """
+    Serve a database of synthetic markers and benchmark every route
+
+    Args:
+        directory (str): Temporary directory of the run
+        density (int): Markers in the benchmarked cell (its neighbours get a tenth)
+        requests (int, optional): Requests per route. Defaults to 200.
+        concurrency (int, optional): Concurrent clients. Defaults to 4.
+        overrides (dict, optional): config.json keys to change, ex: {"storage_backend": "memory"}. Defaults to None.
+        seed (int, optional): Random seed of the markers. Defaults to 0.
+
+    Returns:
+        dict: "e2e.<density>.<route>" -> see measure()
+    """
+    config = make_config(directory, overrides or {})
+
+    cells = {CELL: city_rows(density, cell=CELL, seed=seed)}
+    for cell in NEIGHBOURS:
+        cells[cell] = city_rows(max(1, density // 10), cell=cell, seed=seed)
+    db.close_pool()
+    storage = db.get_storage(config)
+    for (cell_lat, cell_long), rows in cells.items():
+        storage.add_markers([(cell_lat, cell_long) + row for row in rows])
+
+    # Imported here, creating the app registers the routes on serve_api's Flask instance
+    import api.serve_api as serve_api
+    server = create_server(serve_api.create_app(config), host="127.0.0.1",
+        port=int(config.SERVE_PORT), threads=config.SERVE_THREADS)
+    threading.Thread(target=server.run, name="benchmark-server", daemon=True).start()
+
+    # waitress can't be stopped from another thread, the server thread ends with the process
+    results = {}
+    for route in routes():
+        results[f"e2e.{density}.{route[0]}"] = measure(server.effective_port, route, requests, concurrency)
+    return results
+
+# EOF
@@ -0,0 +1,267 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Load test of the /subscribe push hub: thousands of simulated subscribers
+# hold an SSE connection each to a local uvicorn server, then markers are
+# published and the time until every subscriber of the cell got them is
+# measured, along with the memory and CPU the idle connections cost.
+#   python3 benchmarks/push.py [--subscribers 1000,5000] [--cells 4]
+#       [--events 200] [--rate 50] [--idle 5]
+# The server only serves /subscribe (the full ASGI app needs MySQL for
+# aiomysql) and runs in this process next to the clients, so the memory per
+# subscriber counts both ends of the connection and the latencies include the
+# clients' share of the CPU.
+
+__author__ = 'David Pescariu'
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import socket
+import sys
+import tempfile
+import threading
+from time import perf_counter, process_time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.routing import Route
+import api.events as events
+import api.push as push
+import api.serve_asgi as serve_asgi
+from benchmarks.e2e import make_config, KEY
+
+# Marker type of the published events, carries their number
+EVENT_ID = re.compile(rb"&e(\d+)&")
+
+def memory_bytes() -> int:
+    """
+    Get the resident memory of the process
+
+    Returns:
+        int: Bytes, the peak instead where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def raise_file_limit(needed: int) -> None:
+    """
+    Raise the open files limit to what the connections need, up to the hard limit
+
+    Args:
+        needed (int): File descriptors needed
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        limit = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        if limit < needed:
+            print(f"Only {limit} files can be opened, some subscribers will fail")
+
+def serve(config) -> int:
+    """
+    Serve /subscribe on a free local port, in a background thread
+
+    Args:
+        config (models.Config): Config instance
+
+    Returns:
+        int: The port
+    """
+    app = Starlette(routes=[Route("/subscribe", serve_asgi.subscribe_endpoint(config))])
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = serve_asgi.Server(uvicorn.Config(app, log_level="warning", access_log=False,
+        backlog=4096, limit_concurrency=None))
+    threading.Thread(target=server.run, kwargs=dict(sockets=[sock]), name="benchmark-server", daemon=True).start()
+    while not server.started:
+        sleep(0.05)
+    return sock.getsockname()[1]
+
+async def subscriber(port: int, cell: tuple, ready: asyncio.Event, connected: list,
+                     arrivals: dict, stop: asyncio.Event) -> None:
+    """
+    Subscribe to a cell and record when each event arrives
+
+    Args:
+        port (int): Server port
+        cell (tuple): (lat, long) of the cell
+        ready (asyncio.Event): Set by the last subscriber to connect
+        connected (list): [subscribers connected, subscribers expected]
+        arrivals (dict): Event number -> arrival times, appended to
+        stop (asyncio.Event): Set when the run is over
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(f"GET /subscribe?key={KEY}&cells={cell[0]},{cell[1]} HTTP/1.1\r\n"
+                     "Host: 127.0.0.1\r\n\r\n".encode())
+        await writer.drain()
+        # Subscribed once the first frame is there
+        await reader.readuntil(b"retry: ")
+        connected[0] += 1
+        if connected[0] == connected[1]:
+            ready.set()
+
+        pending = b""
+        while not stop.is_set():
+            data = await reader.read(65536)
+            if not data:
+                break
+            arrived = perf_counter()
+            pending += data
+            # Frames can be split between reads, keep the unfinished one
+            complete, _, pending = pending.rpartition(b"\n\n")
+            for match in EVENT_ID.finditer(complete):
+                arrivals.setdefault(int(match.group(1)), []).append(arrived)
+    finally:
+        writer.close()
+
+def publish(cells: list, count: int, rate: float, published: dict) -> None:
+    """
+    Publish markers like db_connector does after a write, from a writer thread
+
+    Args:
+        cells (list): The cells to publish to, picked at random
+        count (int): Number of events
+        rate (float): Events per second
+        published (dict): Event number -> (cell, publish time), filled in
+    """
+    for number in range(count):
+        cell = random.choice(cells)
+        published[number] = (cell, perf_counter())
+        events.publish(events.MARKER_ADDED, cell,
+            lat=cell[0] + 0.5, long=cell[1] + 0.5, type=f"e{number}", date="2021-01-01", time="00:00:00")
+        sleep(1 / rate)
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Get a percentile of sorted values
+
+    Args:
+        values (list): Sorted values
+        fraction (float): ex: 0.99
+
+    Returns:
+        float: The percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run(port: int, subscribers: int, cells: list, count: int, rate: float, idle: float) -> dict:
+    """
+    Connect the subscribers, let them idle, then publish to them
+
+    Args:
+        port (int): Server port
+        subscribers (int): Number of subscribers, spread evenly over the cells
+        cells (list): The cells
+        count (int): Number of events
+        rate (float): Events per second
+        idle (float): Seconds to measure the idle connections for
+
+    Returns:
+        dict: Results of the run
+    """
+    ready, stop = asyncio.Event(), asyncio.Event()
+    connected = [0, subscribers]
+    arrivals, published = {}, {}
+    memory_before = memory_bytes()
+
+    start = perf_counter()
+    tasks = [
+        asyncio.ensure_future(subscriber(port, cells[i % len(cells)], ready, connected, arrivals, stop))
+        for i in range(subscribers)
+    ]
+    await asyncio.wait([asyncio.ensure_future(ready.wait())] + tasks,
+        timeout=60, return_when=asyncio.FIRST_COMPLETED)
+    connect_seconds = perf_counter() - start
+    failed = sum(1 for task in tasks if task.done() and task.exception() is not None)
+
+    cpu = process_time()
+    await asyncio.sleep(idle)
+    idle_cpu = process_time() - cpu
+    memory = memory_bytes() - memory_before
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, publish, cells, count, rate, published)
+    # Let the last events arrive
+    await asyncio.sleep(1)
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait(tasks, timeout=10)
+
+    per_cell = {cell: sum(1 for i in range(subscribers) if cells[i % len(cells)] == cell) for cell in cells}
+    latencies, expected = [], 0
+    for number, (cell, published_at) in published.items():
+        expected += per_cell[cell]
+        latencies += [arrived - published_at for arrived in arrivals.get(number, ())]
+    latencies.sort()
+    return dict(
+        subscribers=connected[0],
+        failed=failed,
+        connect_seconds=connect_seconds,
+        memory_per_subscriber_kb=memory / max(1, connected[0]) / 1024,
+        idle_cpu_percent=idle_cpu / idle * 100 if idle > 0 else 0.0,
+        events=count,
+        delivered=len(latencies),
+        expected=expected,
+        p50_ms=percentile(latencies, 0.50) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        max_ms=latencies[-1] * 1000 if latencies else 0.0
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated /subscribe clients against a local push hub")
+    parser.add_argument("--subscribers", default="1000,5000", help="comma separated, one run per value")
+    parser.add_argument("--cells", type=int, default=4, help="cells the subscribers are spread over")
+    parser.add_argument("--events", type=int, default=200, help="markers published per run")
+    parser.add_argument("--rate", type=float, default=50, help="markers published per second")
+    parser.add_argument("--idle", type=float, default=5, help="seconds the idle connections are measured for")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    counts = [int(value) for value in args.subscribers.split(',')]
+    raise_file_limit(2 * max(counts) + 256)
+    cells = [(46, 23 + i) for i in range(args.cells)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = make_config(directory, dict(
+            serve_mode="asgi",
+            push_enabled=True,
+            push_max_subscribers=max(counts),
+            push_max_queued=max(256, args.events)))
+        port = serve(config)
+
+        results = []
+        for subscribers in counts:
+            result = asyncio.run(run(port, subscribers, cells, args.events, args.rate, args.idle))
+            results.append(result)
+            # The server notices the closed connections on its own time
+            for _ in range(100):
+                if not push.stats().get("subscribers"):
+                    break
+                sleep(0.1)
+            if not args.json:
+                print(f"{result['subscribers']:>6} subscribers ({result['failed']} failed) connected in "
+                      f"{result['connect_seconds']:.1f}s, {result['memory_per_subscriber_kb']:.1f} KB each, "
+                      f"{result['idle_cpu_percent']:.1f}% CPU idle | {result['delivered']}/{result['expected']} "
+                      f"delivered, p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+                      f"max {result['max_ms']:.1f} ms")
+        push.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
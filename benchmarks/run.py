@@ -0,0 +1,120 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Runs the benchmark suites and writes the results as JSON, tagged with the
+# revision (REV in main.py), so runs of two revisions can be compared:
+#   python3 benchmarks/run.py [--suites zones,e2e] [--densities 1000,10000]
+#       [--engines python,numpy] [--repeat 5] [--e2e-density 10000]
+#       [--requests 200] [--concurrency 4] [--no-cache] [--zone-engine python]
+#       [--storage sqlite] [--read-store]
+#       [--out benchmarks/results/<REV>.json] [--compare <older results.json>]
+# With --compare the exit status is 1 if anything got slower than --threshold.
+
+__author__ = 'David Pescariu'
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import REV
+from benchmarks import e2e, zones
+from benchmarks.synthetic import DENSITIES
+
+# Value compared between two runs, per kind of result
+COMPARED = ("median_ms", "p50_ms")
+
+def compare(old: dict, new: dict, threshold: float) -> list:
+    """
+    Compare the results of two runs
+
+    Args:
+        old (dict): Results of the older run
+        new (dict): Results of this run
+        threshold (float): Slowdown that counts as a regression, ex: 0.1 for 10%
+
+    Returns:
+        list: (name, old ms, new ms, ratio, regressed) for every result in both runs
+    """
+    rows = []
+    for name in sorted(set(old) & set(new)):
+        for field in COMPARED:
+            if field in old[name] and field in new[name]:
+                before, after = old[name][field], new[name][field]
+                ratio = after / before if before else 1.0
+                rows.append((name, before, after, ratio, ratio > 1 + threshold))
+                break
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmarks and write the results as JSON")
+    parser.add_argument("--suites", default="zones,e2e", help="comma separated: zones, e2e")
+    parser.add_argument("--densities", default=",".join(str(n) for n in DENSITIES),
+        help="markers per cell for the zones suite, comma separated, up to 100000")
+    parser.add_argument("--engines", default="python,numpy", help="zone engines for the zones suite")
+    parser.add_argument("--repeat", type=int, default=5, help="builds per engine and density")
+    parser.add_argument("--e2e-density", type=int, default=10000, help="markers in the cell served by the e2e suite")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--no-cache", action="store_true", help="serve with cache_enabled false")
+    parser.add_argument("--zone-engine", default=None, help="zone_engine of the e2e server")
+    parser.add_argument("--storage", default="sqlite", choices=("sqlite", "memory"),
+        help="storage_backend of the e2e server")
+    parser.add_argument("--read-store", action="store_true", help="serve with read_store_enabled true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="defaults to benchmarks/results/<REV>.json")
+    parser.add_argument("--compare", default=None, help="results of an older run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    suites = args.suites.split(',')
+    results = {}
+    if "zones" in suites:
+        results.update(zones.run(
+            args.engines.split(','), [int(n) for n in args.densities.split(',')], args.repeat, args.seed))
+    if "e2e" in suites:
+        overrides = dict(storage_backend=args.storage, read_store_enabled=args.read_store)
+        if args.no_cache:
+            overrides["cache_enabled"] = False
+        if args.zone_engine:
+            overrides["zone_engine"] = args.zone_engine
+        with tempfile.TemporaryDirectory() as directory:
+            results.update(e2e.run(directory, args.e2e_density, args.requests, args.concurrency, overrides, args.seed))
+
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{REV}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as out_file:
+        json.dump(dict(
+            rev=REV,
+            date=datetime.now().isoformat(timespec="seconds"),
+            python=platform.python_version(),
+            machine=platform.platform(),
+            args=vars(args),
+            results=results
+        ), out_file, indent=2, sort_keys=True)
+
+    for name, result in sorted(results.items()):
+        if "median_ms" in result:
+            print(f"{name:<40} median {result['median_ms']:9.2f} ms   min {result['min_ms']:9.2f} ms")
+        else:
+            print(f"{name:<40} p50 {result['p50_ms']:8.2f} ms   p99 {result['p99_ms']:8.2f} ms   "
+                  f"{result['rps']:8.1f} req/s   {result['errors']} errors")
+    print(f"Results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            old = json.load(old_file)
+        rows = compare(old["results"], results, args.threshold)
+        print(f"\nCompared with {old['rev']} ({old['date']}):")
+        for name, before, after, ratio, regressed in rows:
+            print(f"{name:<40} {before:9.2f} -> {after:9.2f} ms  {ratio:5.2f}x{'  REGRESSION' if regressed else ''}")
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Seeded synthetic markers shaped like a city: most of them around a few
+# hotspots (normally distributed around their centre), the rest spread
+# uniformly over the cell. The same seed always gives the same markers.
+
+__author__ = 'David Pescariu'
+
+import random
+from models.types import TYPES
+
+# Markers per cell the benchmarks run at by default, up to 100000 can be asked
+# for (the "python" zone engine takes minutes to cluster 100000)
+DENSITIES = (1000, 10000)
+
+def city_rows(n: int, cell: tuple = (46, 23), hotspots: int = 8, noise: float = 0.2,
+              spread: float = 0.003, seed: int = 0) -> list:
+    """
+    Generate the markers of one cell
+
+    Args:
+        n (int): Number of markers
+        cell (tuple, optional): (lat, long) of the cell. Defaults to (46, 23).
+        hotspots (int, optional): Number of hotspots. Defaults to 8.
+        noise (float, optional): Fraction of the markers spread uniformly. Defaults to 0.2.
+        spread (float, optional): Standard deviation around a hotspot, in degrees. Defaults to 0.003.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: (lat, long, type, date, time) rows, inside the cell
+    """
+    rng = random.Random(f"{seed}:{cell[0]}:{cell[1]}")
+    types = sorted(TYPES)
+    # Keep the hotspots off the cell border, so their markers stay inside
+    centres = [(cell[0] + rng.uniform(0.1, 0.9), cell[1] + rng.uniform(0.1, 0.9)) for _ in range(hotspots)]
+
+    rows = []
+    for i in range(n):
+        if not centres or rng.random() < noise:
+            lat, long = cell[0] + rng.random(), cell[1] + rng.random()
+        else:
+            centre_lat, centre_long = rng.choice(centres)
+            lat = min(max(rng.gauss(centre_lat, spread), cell[0]), cell[0] + 0.999999)
+            long = min(max(rng.gauss(centre_long, spread), cell[1]), cell[1] + 0.999999)
+        rows.append((
+            round(lat, 6), round(long, 6), rng.choice(types),
+            f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+        ))
+    return rows
+
+def as_markers(rows: list) -> list:
+    """
+    Format rows like db_connector.return_markers does
+
+    Args:
+        rows (list): (lat, long, type, date, time) rows
+
+    Returns:
+        list: The markers, ending with "end"
+    """
+    markers = [f"{lat}&{long}&{type_}&{date}&{time}" for (lat, long, type_, date, time) in rows]
+    markers.append("end")
+    return markers
+
+# EOF
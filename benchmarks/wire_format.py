@@ -0,0 +1,121 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Payload size and encode time of the binary wire format against the JSON responses:
+#   python3 benchmarks/wire_format.py [--markers N] [--zones N] [--repeat N]
+
+__author__ = 'David Pescariu'
+
+import argparse
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api.wire as wire
+from models.types import TYPES
+
+def synthetic_markers(n: int, seed: int = 0) -> list:
+    """
+    Generate get_markers data for one cell
+
+    Args:
+        n (int): Number of markers
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: The markers, ending with "end"
+    """
+    rng = random.Random(seed)
+    types = list(TYPES)
+    markers = [
+        f"{46 + rng.random():.6f}&{23 + rng.random():.6f}&{rng.choice(types)}&"
+        f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}&"
+        f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+        for _ in range(n)
+    ]
+    markers.append("end")
+    return markers
+
+def synthetic_zones(n: int, seed: int = 0) -> list:
+    """
+    Generate get_zones data for one cell
+
+    Args:
+        n (int): Number of zones
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: The zones, ending with "end"
+    """
+    rng = random.Random(seed)
+    zones = []
+    for _ in range(n):
+        lat, long = 46 + rng.random(), 23 + rng.random()
+        zones.append([
+            (lat + rng.uniform(-0.01, 0.01), long + rng.uniform(-0.01, 0.01))
+            for _ in range(rng.randint(3, 12))
+        ])
+    zones.append("end")
+    return zones
+
+def timed(function, repeat: int) -> (bytes, float):
+    """
+    Run an encoder a few times
+
+    Args:
+        function (callable): Returns the payload
+        repeat (int): Number of runs
+
+    Returns:
+        (bytes, float): The payload, best time in ms
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        payload = function()
+        best = min(best, perf_counter() - start)
+    return payload, best * 1000
+
+def report(label: str, data: list, encode, repeat: int) -> None:
+    """
+    Print the size / time of every encoding of some data
+
+    Args:
+        label (str): ex: "markers"
+        data (list): The data
+        encode (callable): wire.encode_markers / wire.encode_zones
+        repeat (int): Number of runs
+    """
+    encodings = [
+        ("json", lambda: json.dumps(dict(data=data)).encode()),
+        ("bin64", lambda: encode(data, 64)),
+        ("bin32", lambda: encode(data, 32)),
+    ]
+    print(f"{label} ({len(data) - 1}):")
+    baseline = None
+    for name, function in encodings:
+        payload, elapsed = timed(function, repeat)
+        baseline = baseline or len(payload)
+        print(f"  {name:6} {len(payload):>10} bytes ({len(payload) / baseline:6.1%}) {elapsed:8.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Binary wire format vs JSON")
+    parser.add_argument("--markers", type=int, default=10000)
+    parser.add_argument("--zones", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    markers = synthetic_markers(args.markers)
+    zones = synthetic_zones(args.zones)
+    assert len(wire.decode_markers(wire.encode_markers(markers))) == args.markers
+    assert len(wire.decode_zones(wire.encode_zones(zones))) == args.zones
+
+    report("markers", markers, wire.encode_markers, args.repeat)
+    report("zones", zones, wire.encode_zones, args.repeat)
+
+if __name__ == "__main__":
+    main()
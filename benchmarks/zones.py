@@ -0,0 +1,68 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# ZoneBuilder microbenchmarks: time of the parse / cluster / hull stages per
+# zone engine and density, read from the api_stage_seconds histogram the
+# builders already record into.
+
+__author__ = 'David Pescariu'
+
+from statistics import median
+from time import perf_counter
+import api.metrics as metrics
+from api.zone_builder import ZoneBuilder as PythonZoneBuilder, get_zone_builder
+from benchmarks.synthetic import city_rows, as_markers
+
+STAGES = ("parse", "cluster", "hull")
+
+def __stage_seconds() -> dict:
+    """
+    Get the total seconds recorded per stage so far
+
+    Returns:
+        dict: stage -> seconds
+    """
+    return {labels[0]: values[-1] for labels, values in metrics.STAGE_LATENCY.collect()}
+
+def run(engines: list, densities: list, repeat: int = 5, seed: int = 0) -> dict:
+    """
+    Build the zones of a synthetic cell `repeat` times per engine and density
+
+    Args:
+        engines (list): Zone engines, ex: ["python", "numpy"]
+        densities (list): Markers per cell
+        repeat (int, optional): Builds per engine and density. Defaults to 5.
+        seed (int, optional): Random seed of the markers. Defaults to 0.
+
+    Returns:
+        dict: "zones.<engine>.<density>.<stage>" -> {"median_ms", "min_ms", "runs"}, stage "total" included
+    """
+    results = {}
+    for density in densities:
+        markers = as_markers(city_rows(density, seed=seed))
+        for engine in engines:
+            ZoneBuilder = get_zone_builder(engine)
+            # Fell back to the python engine, its dependencies are missing
+            if ZoneBuilder is PythonZoneBuilder and engine != "python":
+                continue
+
+            timings = {stage: [] for stage in STAGES + ("total", )}
+            for _ in range(repeat):
+                before = __stage_seconds()
+                start = perf_counter()
+                zones = ZoneBuilder(markers).get_zones()
+                timings["total"].append(perf_counter() - start)
+                after = __stage_seconds()
+                for stage in STAGES:
+                    timings[stage].append(after.get(stage, 0) - before.get(stage, 0))
+
+            for stage, values in timings.items():
+                results[f"zones.{engine}.{density}.{stage}"] = dict(
+                    median_ms=median(values) * 1000,
+                    min_ms=min(values) * 1000,
+                    runs=len(values),
+                    zones=len(zones)
+                )
+    return results
+
+# EOF
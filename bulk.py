@@ -0,0 +1,39 @@
+# Copyright (c) prisma.ai
+# License: GNU GPL v3
+
+# Bulk import / export of markers:
+#   python3 bulk.py import <file|-> [--format csv|ndjson] [--chunk-size N]
+#   python3 bulk.py export <file|-> [--format csv|ndjson] [--chunk-size N]
+
+__author__ = 'David Pescariu'
+
+import argparse
+import sys
+import api.bulk_io as bulk_io
+from models.config import Config
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import / export of markers")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("file", help="path, - for stdin / stdout")
+    parser.add_argument("--format", choices=("csv", "ndjson"), default=None,
+        help="defaults to the file extension, ndjson for -")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per insert / page")
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.file.endswith(".csv") else "ndjson"
+
+    config = Config()
+    if args.action == "import":
+        stream = sys.stdin if args.file == "-" else open(args.file, newline='')
+        with stream:
+            bulk_io.import_markers(config, stream, fmt, args.chunk_size)
+    else:
+        stream = sys.stdout if args.file == "-" else open(args.file, "w", newline='')
+        with stream:
+            bulk_io.export_markers(config, stream, fmt, args.chunk_size)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,274 @@
 # Copyright (c) prisma.ai 2021
 # All rights reserved
 
+# Logging pipeline: callers only put records on a bounded queue, a background
+# thread writes them to the rotating log file and, optionally, the console.
+# Every subsystem logs to its own "api.<subsystem>" logger, so levels can be
+# set per subsystem, and repeated messages are sampled before being queued.
+# Records of the libraries (waitress, uvicorn...) only go to the file.
+
 __author__ = 'David Pescariu'
 
+import atexit
 import logging
+import logging.handlers
+import queue
+import re
+import threading
+from time import monotonic, time
+
+DEFAULT_FILE = 'log/api_log.log'
+DEFAULT_FORMAT = "%(asctime)s - %(name)s [%(levelname)s] %(message)s"
+ROOT_LOGGER = "api"
+
+COLORS = {
+    'note' : '\033[94m',    # Blue
+    'ok'   : '\033[92m',    # Green
+    'fail' : '\033[91m',    # Red
+    'warn' : '\033[93m',    # Yellow
+
+    'end'  : '\033[0m'      # Clear
+}
+
+# Console tag -> color, records carry their tag in record.tag
+TAG_COLORS = {
+    "FATAL_FAIL" : COLORS['fail'],
+    "FAIL"       : COLORS['warn'],
+    "START"      : COLORS['ok'],
+    "OK"         : COLORS['ok'],
+    "DEBUG"      : COLORS['note'],
+    "STOP"       : COLORS['fail'],
+}
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when the queue is full instead of
+    blocking the caller, the number of dropped records is logged once there
+    is room again
+    """
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.__lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.__lock:
+                self.dropped += 1
+            return
+
+        if self.dropped:
+            with self.__lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                try:
+                    self.queue.put_nowait(logging.makeLogRecord(dict(
+                        name=ROOT_LOGGER, levelno=logging.WARNING, levelname="WARNING",
+                        msg=f"[LOG] Queue full, dropped {dropped} records", tag="FAIL")))
+                except queue.Full:
+                    with self.__lock:
+                        self.dropped += dropped
+
+class SamplingFilter(logging.Filter):
+    """
+        Lets at most `burst` similar records through per `window` seconds,
+    records are similar if they have the same logger, level and message up
+    to its first ":" with digits ignored, ex: every "Non-existant key: ..."
+    or "Requested from <ip>". The first record after a window says how many
+    were suppressed. Only WARNING (msg.fail) and ERROR records are sampled,
+    the INFO request lines would all share the key of their endpoint.
+
+    Params:
+        burst (int): Records let through per window and key
+        window (float): Seconds
+        max_keys (int, optional): Keys tracked at most. Defaults to 10000.
+        level (int, optional): Lowest level sampled. Defaults to logging.WARNING.
+    """
+    def __init__(self, burst: int, window: float, max_keys: int = 10000, level: int = logging.WARNING) -> None:
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        self.level = level
+        self.__lock = threading.Lock()
+        self.__keys = {}  # key -> [window start, records in window, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or not self.level <= record.levelno < logging.CRITICAL:
+            return True
+
+        message = str(record.msg)
+        key = (record.name, record.levelno, re.sub(r"\d+", "#", message.split(':', 1)[0]))
+        now = monotonic()
+        with self.__lock:
+            state = self.__keys.get(key)
+            if state is None:
+                if len(self.__keys) >= self.max_keys:
+                    self.__prune(now)
+                state = self.__keys[key] = [now, 0, 0]
+            elif now - state[0] > self.window:
+                if state[2]:
+                    suffix = f" (+{state[2]} similar suppressed)"
+                    record.msg = message + suffix
+                    if hasattr(record, "text"):
+                        record.text += suffix
+                state[0], state[1], state[2] = now, 0, 0
+
+            state[1] += 1
+            if state[1] > self.burst:
+                state[2] += 1
+                return False
+        return True
+
+    def __prune(self, now: float) -> None:
+        """
+        Forget the keys whose window is over, or every key if none is, the lock must be held
+
+        Args:
+            now (float): Current monotonic time
+        """
+        expired = [key for key, state in self.__keys.items() if now - state[0] > self.window]
+        for key in expired or list(self.__keys):
+            del self.__keys[key]
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates the log file when it grows over max_bytes or every interval
+    seconds, whichever comes first, keeping backup_count old files
+
+    Params:
+        filename (str): Path of the log file
+        max_bytes (int): Size to rotate at, 0 for no size limit
+        interval (float): Seconds between rotations, 0 for no time limit
+        backup_count (int): Old files to keep
+    """
+    def __init__(self, filename: str, max_bytes: int, interval: float, backup_count: int) -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.interval = interval
+        self.rollover_at = time() + interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.interval > 0 and time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = time() + self.interval
+
+class ConsoleFormatter(logging.Formatter):
+    """
+    Formats records like console_messages always printed them, ex: "[OK] message"
+    in green, record.text is shown instead of the message if it's set
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        tag = getattr(record, "tag", record.levelname)
+        text = getattr(record, "text", None) or record.getMessage()
+        color = TAG_COLORS.get(tag)
+        if color is None:
+            return f"[{tag}] {text}"
+        return f"{color}[{tag}] {text}{COLORS['end']}"
+
+class ConsoleFilter(logging.Filter):
+    """
+    Keeps the records of the libraries and the ones that were never shown on
+    the console, ex: exceptions, off the console
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name != ROOT_LOGGER and not record.name.startswith(ROOT_LOGGER + "."):
+            return False
+        return getattr(record, "console", True)
+
+__lock = threading.Lock()
+__listener = None
+__handler = None
+
+def initialize_logging(config=None, worker: int = None) -> None:
+    """
+    Set up (or set up again, ex: after loading the config or forking) the
+    logging pipeline. Without a config only defaults are used: INFO to
+    log/api_log.log and the console, no sampling.
+
+    Args:
+        config (models.Config, optional): Config instance. Defaults to None.
+        worker (int, optional): Number of the worker process, each worker writes its own file. Defaults to None.
+    """
+    global __listener, __handler
+
+    log_file = config.LOG_FILE if config is not None else DEFAULT_FILE
+    if worker is not None:
+        base, dot, extension = log_file.rpartition('.')
+        log_file = f"{base}.worker{worker}.{extension}" if dot else f"{log_file}.worker{worker}"
+
+    file_handler = RotatingFileHandler(
+        log_file,
+        max_bytes=config.LOG_MAX_BYTES if config is not None else 0,
+        interval=config.LOG_ROTATE_INTERVAL if config is not None else 0,
+        backup_count=config.LOG_BACKUP_COUNT if config is not None else 0)
+    file_handler.setFormatter(logging.Formatter(
+        config.LOGGING_FORMAT if config is not None else DEFAULT_FORMAT,
+        config.DATE_FORMAT if config is not None else None))
+    handlers = [file_handler]
+
+    if config is None or config.LOG_CONSOLE:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter())
+        console_handler.addFilter(ConsoleFilter())
+        handlers.append(console_handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE if config is not None else 10000))
+    if config is not None:
+        queue_handler.addFilter(SamplingFilter(config.LOG_SAMPLE_BURST, config.LOG_SAMPLE_WINDOW))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    levels = config.LOG_LEVELS if config is not None else {}
+    with __lock:
+        old_listener, old_handler = __listener, __handler
+        # "root" is the level of the libraries, "api" of every subsystem without its own level
+        root.setLevel(levels.get("root", "INFO"))
+        logging.getLogger(ROOT_LOGGER).setLevel(levels.get(ROOT_LOGGER, "INFO"))
+        for subsystem, level in levels.items():
+            if subsystem not in ("root", ROOT_LOGGER):
+                logging.getLogger(f"{ROOT_LOGGER}.{subsystem}").setLevel(level)
+
+        listener.start()
+        root.addHandler(queue_handler)
+        __listener, __handler = listener, queue_handler
+        if old_handler is not None:
+            root.removeHandler(old_handler)
+
+    # After a fork the old listener's thread doesn't exist in this process
+    if old_listener is not None and worker is None:
+        old_listener.stop()
+
+def stop_logging() -> None:
+    """
+    Write out the queued records and stop the writer thread
+    """
+    global __listener
+
+    with __lock:
+        listener, __listener = __listener, None
+    if listener is not None:
+        listener.stop()
+
+def get_logger(subsystem: str = None) -> logging.Logger:
+    """
+    Get the logger of a subsystem
+
+    Args:
+        subsystem (str, optional): ex: "auth", "db". Defaults to the root "api" logger.
+
+    Returns:
+        logging.Logger: The logger
+    """
+    if subsystem is None:
+        return logging.getLogger(ROOT_LOGGER)
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+atexit.register(stop_logging)
 
-def initialize_logging():
-    logging.basicConfig(
-        filename='log/api_log.log', 
-        level='INFO', 
-        format="%(asctime)s - %(name)s [%(levelname)s] %(message)s", 
-        )
+# EOF
@@ -11,6 +11,12 @@ import utils.console_messages as msg
 import utils.stop_exec as stop
 import api.serve_api as api
 import api.cleanup as cleanup
+import api.zone_scheduler as zone_scheduler
+import api.write_behind as write_behind
+import api.public_snapshot as public_snapshot
+import api.migrations as migrations
+import api.prefork as prefork
+import api.storage as storage
 from models.config import Config
 from log.logger import initialize_logging
 
@@ -22,10 +28,13 @@ def main():
     
     # Load configs
     config = Config()
-    initialize_logging()
+    initialize_logging(config)
     msg.info("Checking for missing modules")
     
-    if check_imports_.check_imports():
+    extra_modules = check_imports_.ASGI_MODULES if config.SERVE_MODE == "asgi" else []
+    if config.STORAGE_BACKEND == "mysql":
+        extra_modules = [*extra_modules, *check_imports_.MYSQL_MODULES]
+    if check_imports_.check_imports(extra_modules):
         # Fatal -> One or more modules not found
         msg.fatal_fail("One or more modules not found")
         logging.critical("One or more modules not found -> exiting")
@@ -33,9 +42,45 @@ def main():
     else:
         msg.ok("All modules found")
     
+    if config.STORAGE_BACKEND not in storage.BACKENDS:
+        msg.fatal_fail(f"Unknown storage_backend {config.STORAGE_BACKEND}, use one of {', '.join(storage.BACKENDS)}")
+        stop.stop()
+    # The async handlers query MySQL directly and every process has its own memory backend
+    if config.SERVE_MODE == "asgi" and config.STORAGE_BACKEND != "mysql":
+        msg.fatal_fail("serve_mode asgi needs storage_backend mysql")
+        stop.stop()
+    # Its get_markers / add_marker / del_markers would bypass the read store, which never sees those writes
+    if config.SERVE_MODE == "asgi" and config.READ_STORE_ENABLED:
+        msg.fatal_fail("serve_mode asgi can't be used with read_store_enabled, set read_store_enabled to false")
+        stop.stop()
+    if config.STORAGE_BACKEND == "memory" and prefork.worker_count(config) > 1:
+        msg.fatal_fail("storage_backend memory can't be shared between workers, set serve_workers to 1")
+        stop.stop()
+
+    if config.STORAGE_BACKEND == "mysql":
+        # The sqlite / memory backends create their tables themselves
+        try:
+            schema_version = migrations.current_version(config)
+            if schema_version < migrations.LATEST_VERSION:
+                msg.fail(f"Database schema is at version {schema_version}, run python3 migrate.py")
+        except Exception as e:
+            msg.fail("Couldn't check the database schema version")
+            msg.exception(e)
+
     msg.ok("Successfully initialized, start serving:")
     msg.info("Ctrl-C to Stop Serving")
-    api.start_serving(config)
+    if prefork.worker_count(config) > 1:
+        # The zone scheduler runs in the first worker
+        prefork.serve(config)
+    else:
+        zone_scheduler.start(config)
+        write_behind.start(config)
+        public_snapshot.start(config)
+        if config.SERVE_MODE == "asgi":
+            import api.serve_asgi as asgi
+            asgi.start_serving(config)
+        else:
+            api.start_serving(config)
     
     cleanup.cleanup()
 
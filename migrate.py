@@ -0,0 +1,29 @@
+# Copyright (c) prisma.ai
+# License: GNU GPL v3
+
+# Migrate the database schema: python3 migrate.py [--status] [--chunk-size N] [--pause S]
+
+__author__ = 'David Pescariu'
+
+import argparse
+import utils.console_messages as msg
+import api.migrations as migrations
+from models.config import Config
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the database schema")
+    parser.add_argument("--status", action="store_true", help="only show the schema version")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows backfilled per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between chunks")
+    args = parser.parse_args()
+
+    config = Config()
+    version = migrations.current_version(config)
+    msg.info(f"Schema is at version {version}, latest is {migrations.LATEST_VERSION}")
+    if args.status or version >= migrations.LATEST_VERSION:
+        return
+
+    migrations.migrate(config, chunk_size=args.chunk_size, pause=args.pause)
+
+if __name__ == "__main__":
+    main()
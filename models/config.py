@@ -17,15 +17,69 @@ class Config:
     """
     LOGGING_FORMAT      = None
     DATE_FORMAT         = None
+    LOG_FILE            = None
+    LOG_CONSOLE         = None
+    LOG_LEVELS          = None
+    LOG_MAX_BYTES       = None
+    LOG_ROTATE_INTERVAL = None
+    LOG_BACKUP_COUNT    = None
+    LOG_QUEUE_SIZE      = None
+    LOG_SAMPLE_BURST    = None
+    LOG_SAMPLE_WINDOW   = None
     SERVE_PORT          = None
+    SERVE_THREADS       = None
     ALLOW_PUBLIC        = None
     PUBLIC_UPDATE_DELAY = None
+    PUBLIC_MIN_MARKERS  = None
+    BANNED_IPS          = None
+    RATE_LIMIT_ENABLED  = None
+    RATE_LIMITS         = None
+    RATE_LIMIT_MAX_BUCKETS = None
+    ZONE_ENGINE         = None
+    PRECOMPUTE_ZONES    = None
+    ZONE_REBUILD_INTERVAL = None
+    INCREMENTAL_ZONES   = None
+    ZONE_VERIFY_INTERVAL = None
+    CACHE_ENABLED       = None
+    CACHE_TTL           = None
+    CACHE_MAX_ENTRIES   = None
+    CACHE_MAX_BYTES     = None
+    BBOX_MAX_CELLS      = None
+    BATCH_MAX_MARKERS   = None
+    STREAM_CHUNK_SIZE   = None
+    ETAGS_ENABLED       = None
+    ETAG_RESYNC_INTERVAL = None
+    SERVE_MODE          = None
+    ASYNC_POOL_SIZE     = None
+    SERVE_WORKERS       = None
+    DRAIN_TIMEOUT       = None
+    METRICS_ENABLED     = None
+    STORAGE_BACKEND     = None
+    SQLITE_PATH         = None
+    READ_STORE_ENABLED  = None
+    READ_STORE_RECONCILE_INTERVAL = None
+    WRITE_BEHIND_ENABLED = None
+    WRITE_BEHIND_FLUSH_MS = None
+    WRITE_BEHIND_BATCH_ROWS = None
+    WRITE_BEHIND_MAX_QUEUE = None
+    WRITE_BEHIND_BLOCK_TIMEOUT = None
+    WRITE_BEHIND_SPILL_FILE = None
+    SYNC_MAX_CHANGES    = None
+    SYNC_LOG_MAX_CHANGES = None
+    PUSH_ENABLED        = None
+    PUSH_MAX_SUBSCRIBERS = None
+    PUSH_MAX_QUEUED     = None
+    PUSH_HEARTBEAT      = None
 
     PRIVATE_KEYS        = {}
     PUBLIC_KEYS         = {}
 
     DB_LOGIN_USER       = None
     DB_LOGIN_PASS       = None
+    DB_POOL_SIZE        = None
+    DB_POOL_TIMEOUT     = None
+    DB_POOL_RECYCLE     = None
+    DB_POOL_PING_AFTER  = None
 
     def __do_config_files_exist(self) -> bool:
         """
@@ -51,9 +105,63 @@ class Config:
             json_ = json.load(conf_file)
             self.LOGGING_FORMAT = json_["logging_format"]
             self.DATE_FORMAT = json_["date_format"]
+            self.LOG_FILE = json_["log_file"]
+            self.LOG_CONSOLE = json_["log_console"]
+            self.LOG_LEVELS = json_["log_levels"]
+            self.LOG_MAX_BYTES = int(json_["log_max_bytes"])
+            self.LOG_ROTATE_INTERVAL = float(json_["log_rotate_interval"])
+            self.LOG_BACKUP_COUNT = int(json_["log_backup_count"])
+            self.LOG_QUEUE_SIZE = int(json_["log_queue_size"])
+            self.LOG_SAMPLE_BURST = int(json_["log_sample_burst"])
+            self.LOG_SAMPLE_WINDOW = float(json_["log_sample_window"])
             self.SERVE_PORT = json_["serve_port"]
+            self.SERVE_THREADS = int(json_["serve_threads"])
             self.ALLOW_PUBLIC = json_["allow_public"]
-            self.PUBLIC_UPDATE_DELAY = json_["public_update_delay"]
+            self.PUBLIC_UPDATE_DELAY = float(json_["public_update_delay"])
+            self.PUBLIC_MIN_MARKERS = int(json_["public_min_markers"])
+            self.BANNED_IPS = json_["banned_ips"]
+            self.RATE_LIMIT_ENABLED = json_["rate_limit_enabled"]
+            self.RATE_LIMITS = json_["rate_limits"]
+            self.RATE_LIMIT_MAX_BUCKETS = int(json_["rate_limit_max_buckets"])
+            self.ZONE_ENGINE = json_["zone_engine"]
+            self.PRECOMPUTE_ZONES = json_["precompute_zones"]
+            self.ZONE_REBUILD_INTERVAL = float(json_["zone_rebuild_interval"])
+            self.INCREMENTAL_ZONES = json_["incremental_zones"]
+            self.ZONE_VERIFY_INTERVAL = float(json_["zone_verify_interval"])
+            self.CACHE_ENABLED = json_["cache_enabled"]
+            self.CACHE_TTL = float(json_["cache_ttl"])
+            self.CACHE_MAX_ENTRIES = int(json_["cache_max_entries"])
+            self.CACHE_MAX_BYTES = int(json_["cache_max_bytes"])
+            self.BBOX_MAX_CELLS = int(json_["bbox_max_cells"])
+            self.BATCH_MAX_MARKERS = int(json_["batch_max_markers"])
+            self.STREAM_CHUNK_SIZE = int(json_["stream_chunk_size"])
+            self.ETAGS_ENABLED = json_["etags_enabled"]
+            self.ETAG_RESYNC_INTERVAL = float(json_["etag_resync_interval"])
+            self.SERVE_MODE = json_["serve_mode"]
+            self.ASYNC_POOL_SIZE = int(json_["async_pool_size"])
+            self.SERVE_WORKERS = int(json_["serve_workers"])
+            self.DRAIN_TIMEOUT = float(json_["drain_timeout"])
+            self.METRICS_ENABLED = json_["metrics_enabled"]
+            self.STORAGE_BACKEND = json_["storage_backend"]
+            self.SQLITE_PATH = json_["sqlite_path"]
+            self.READ_STORE_ENABLED = json_["read_store_enabled"]
+            self.READ_STORE_RECONCILE_INTERVAL = float(json_["read_store_reconcile_interval"])
+            self.WRITE_BEHIND_ENABLED = json_["write_behind_enabled"]
+            self.WRITE_BEHIND_FLUSH_MS = float(json_["write_behind_flush_ms"])
+            self.WRITE_BEHIND_BATCH_ROWS = int(json_["write_behind_batch_rows"])
+            self.WRITE_BEHIND_MAX_QUEUE = int(json_["write_behind_max_queue"])
+            self.WRITE_BEHIND_BLOCK_TIMEOUT = float(json_["write_behind_block_timeout"])
+            self.WRITE_BEHIND_SPILL_FILE = json_["write_behind_spill_file"]
+            self.SYNC_MAX_CHANGES = int(json_["sync_max_changes"])
+            self.SYNC_LOG_MAX_CHANGES = int(json_["sync_log_max_changes"])
+            self.PUSH_ENABLED = json_["push_enabled"]
+            self.PUSH_MAX_SUBSCRIBERS = int(json_["push_max_subscribers"])
+            self.PUSH_MAX_QUEUED = int(json_["push_max_queued"])
+            self.PUSH_HEARTBEAT = float(json_["push_heartbeat"])
+            self.DB_POOL_SIZE = int(json_["db_pool_size"])
+            self.DB_POOL_TIMEOUT = float(json_["db_pool_timeout"])
+            self.DB_POOL_RECYCLE = float(json_["db_pool_recycle"])
+            self.DB_POOL_PING_AFTER = float(json_["db_pool_ping_after"])
         info("Configs loaded")
         # Load keys
         with open(KEY_FILE_PATH) as key_file:
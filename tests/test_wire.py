@@ -0,0 +1,63 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Wire format tests. Run from the repo root:
+#   python3 -m unittest discover tests
+
+__author__ = 'David Pescariu'
+
+import os
+import time
+import unittest
+from datetime import datetime, timezone
+import api.wire as wire
+
+# POSIX rules, no tz database needed: UTC+2, UTC+3 from the last Sunday of
+# March 03:00 to the last Sunday of October 04:00
+BUCHAREST = "EET-2EEST,M3.5.0/3,M10.5.0/4"
+
+def utc(*args) -> int:
+    """
+    Unix time of a UTC date and time, ex: utc(2021, 7, 1, 9)
+    """
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+@unittest.skipUnless(hasattr(time, "tzset"), "Can't set the timezone on this platform")
+class SubmittedTimeTest(unittest.TestCase):
+    """
+    submitdate / submittime are written in the server's local time
+    """
+    def setUp(self):
+        self.tz = os.environ.get("TZ")
+
+    def tearDown(self):
+        if self.tz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = self.tz
+        time.tzset()
+
+    def submitted(self, tz: str, markers: list) -> list:
+        os.environ["TZ"] = tz
+        time.tzset()
+        payload = wire.encode_markers([f"46.1&23.2&theft&{date}&{clock}" for (date, clock) in markers] + ["end"])
+        return [marker[3] for marker in wire.decode_markers(payload)]
+
+    def test_utc(self):
+        self.assertEqual(self.submitted("UTC0", [("2021-07-01", "12:30:15")]), [utc(2021, 7, 1, 12, 30, 15)])
+
+    def test_local_zone(self):
+        self.assertEqual(
+            self.submitted(BUCHAREST, [("2021-01-15", "12:00:00"), ("2021-07-01", "12:00:00"), ("2021-07-01", "00:00:05")]),
+            [utc(2021, 1, 15, 10), utc(2021, 7, 1, 9), utc(2021, 6, 30, 21, 0, 5)])
+
+    def test_dst_change(self):
+        # The clocks go from 03:00 to 04:00 on 2021-03-28, both sides share a date
+        self.assertEqual(
+            self.submitted(BUCHAREST, [("2021-03-28", "02:59:59"), ("2021-03-28", "04:00:00"), ("2021-03-28", "23:00:00")]),
+            [utc(2021, 3, 28, 0, 59, 59), utc(2021, 3, 28, 1), utc(2021, 3, 28, 20)])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
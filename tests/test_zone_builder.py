@@ -0,0 +1,222 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Zone builder tests, both engines. Run from the repo root:
+#   python3 -m unittest discover tests
+
+__author__ = 'David Pescariu'
+
+import random
+import unittest
+from api.zone_builder import ZoneBuilder
+
+try:
+    from api.zone_builder_np import NumpyZoneBuilder
+except ImportError:
+    NumpyZoneBuilder = None
+
+ENGINES = [ZoneBuilder] + ([NumpyZoneBuilder] if NumpyZoneBuilder is not None else [])
+
+def marker_data(points: list) -> list:
+    """
+    Format points like db_connector.return_markers does
+
+    Args:
+        points (list): (lat, long) of the markers
+
+    Returns:
+        list: The markers, with the "end" marker
+    """
+    return [f"{lat}&{long}&theft&2021-01-01&10:00:00" for (lat, long) in points] + ["end"]
+
+def random_points(rng: random.Random) -> list:
+    """
+    Markers spread over a random part of a cell, rounded like the database
+
+    Args:
+        rng (random.Random): Seeded generator
+
+    Returns:
+        list: (lat, long) of the markers
+    """
+    spread = rng.choice([0.005, 0.02, 0.05])
+    return [
+        (round(46 + rng.random() * spread, 4), round(23 + rng.random() * spread, 4))
+        for _ in range(rng.randint(0, 150))
+    ]
+
+def proximal(point1: tuple, point2: tuple, threshold: float = 0.004) -> bool:
+    """
+    Same check as ZoneBuilder, with its default threshold
+    """
+    return (point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2 <= threshold ** 2
+
+def reference_sets(points: list) -> list:
+    """
+    Brute force connected components of the markers within the threshold
+
+    Args:
+        points (list): (lat, long) of the markers
+
+    Returns:
+        list: The sets, in the order of their first marker, markers in input order
+    """
+    labels = list(range(len(points)))
+
+    def root(index):
+        while labels[index] != index:
+            index = labels[index]
+        return index
+
+    for i in range(len(points)):
+        for j in range(i):
+            if proximal(points[i], points[j]):
+                labels[max(root(i), root(j))] = min(root(i), root(j))
+
+    sets = {}
+    for i in range(len(points)):
+        sets.setdefault(root(i), []).append(points[i])
+    return list(sets.values())
+
+def legacy_sets(points: list) -> list:
+    """
+    The labelling of ZoneBuilder before the grid / union-find, it can leave
+    part of a chain in its own set
+
+    Args:
+        points (list): (lat, long) of the markers
+
+    Returns:
+        list: The sets, in the order of their first marker, markers in input order
+    """
+    labels = list(range(len(points)))
+
+    def normalize(index):
+        if labels[index] != index:
+            labels[index] = normalize(labels[index])
+        return labels[index]
+
+    for i in range(len(points)):
+        for j in range(i):
+            if proximal(points[i], points[j]):
+                normalize(i)
+                normalize(j)
+                if labels[i] < labels[j]:
+                    labels[j] = labels[i]
+                elif labels[i] > labels[j]:
+                    labels[i] = labels[j]
+
+    sets = {}
+    for i in range(len(points)):
+        sets.setdefault(normalize(i), []).append(points[i])
+    return list(sets.values())
+
+def canonical(sets: list) -> list:
+    """
+    Sets compared regardless of their order and of the order of their markers
+    """
+    return sorted(sorted(markers) for markers in sets)
+
+class RegressionTest(unittest.TestCase):
+    """
+    Seeded random cells against the old builder, where its sets were right,
+    and against a brute force reference otherwise
+    """
+    SEED = 2021
+    CELLS = 200
+
+    def test_python_engine(self):
+        rng = random.Random(self.SEED)
+        for cell in range(self.CELLS):
+            points = random_points(rng)
+            with self.subTest(cell=cell, markers=len(points)):
+                builder = ZoneBuilder(marker_data(points))
+                reference = reference_sets(points)
+                self.assertEqual(canonical(builder.sets.values()), canonical(reference))
+
+                old = legacy_sets(points)
+                if canonical(old) == canonical(reference):
+                    # Same sets in the same order, so the same hulls as before
+                    self.assertEqual(builder.get_zones(), [builder.get_border(markers) for markers in old])
+                else:
+                    self.assertEqual(builder.get_zones(), [builder.get_border(markers) for markers in reference])
+
+    @unittest.skipIf(NumpyZoneBuilder is None, "NumPy isn't installed")
+    def test_numpy_engine(self):
+        rng = random.Random(self.SEED)
+        for cell in range(self.CELLS):
+            points = random_points(rng)
+            with self.subTest(cell=cell, markers=len(points)):
+                zones = NumpyZoneBuilder(marker_data(points)).get_zones()
+                reference = reference_sets(points)
+                self.assertEqual(len(zones), len(reference))
+                for zone, markers in zip(zones, reference):
+                    self.assertTrue(zone)
+                    self.assertTrue(set(zone) <= set(markers))
+                    if len(markers) >= 4:
+                        # The extreme markers are always corners of a convex hull
+                        for extreme in (min(markers), max(markers),
+                                        min(markers, key=lambda point: (point[1], point[0])),
+                                        max(markers, key=lambda point: (point[1], point[0]))):
+                            self.assertIn(extreme, zone)
+                    else:
+                        self.assertEqual(zone, markers)
+
+    def test_chain_left_behind(self):
+        # Pairs 1-2, 0-3 and 2-3, the old labelling gave two zones
+        points = [(46.0, 23.0), (46.009, 23.0), (46.006, 23.0), (46.003, 23.0)]
+        self.assertEqual(len(legacy_sets(points)), 2)
+        for engine in ENGINES:
+            with self.subTest(engine=engine.__name__):
+                self.assertEqual(len(engine(marker_data(points)).get_zones()), 1)
+
+class DegenerateZonesTest(unittest.TestCase):
+    """
+    Markers at the same coords (del_markers deletes all of them) or on a line
+    """
+    def assertZonesValid(self, zones: list, points: list) -> None:
+        for zone in zones:
+            self.assertTrue(zone, "empty zone, stored as an empty coords string")
+            for point in zone:
+                self.assertIn(point, points)
+
+    def test_same_coords(self):
+        for count in (1, 3, 4, 5, 20):
+            points = [(46.7874, 23.6018)] * count
+            for engine in ENGINES:
+                with self.subTest(engine=engine.__name__, count=count):
+                    zones = engine(marker_data(points)).get_zones()
+                    self.assertEqual(len(zones), 1)
+                    self.assertZonesValid(zones, points)
+
+    def test_two_stacks(self):
+        points = [(46.7874, 23.6018)] * 4 + [(46.7879, 23.6018)] * 3
+        for engine in ENGINES:
+            with self.subTest(engine=engine.__name__):
+                zones = engine(marker_data(points)).get_zones()
+                self.assertEqual(len(zones), 1)
+                self.assertZonesValid(zones, points)
+                self.assertEqual(set(zones[0]), set(points))
+
+    def test_collinear(self):
+        lines = [
+            [(46.78 + i * 0.001, 23.6) for i in range(6)],
+            [(46.78, 23.6 + i * 0.001) for i in range(6)],
+            [(46.78 + i * 0.001, 23.6 + i * 0.001) for i in range(6)],
+            [(46.78 + i * 0.001, 23.6) for i in range(6)] * 2,
+        ]
+        for points in lines:
+            for engine in ENGINES:
+                with self.subTest(engine=engine.__name__, points=points[:2]):
+                    zones = engine(marker_data(points)).get_zones()
+                    self.assertEqual(len(zones), 1)
+                    self.assertZonesValid(zones, points)
+                    if engine is NumpyZoneBuilder:
+                        # Its hulls are convex, both ends of the line are corners
+                        self.assertIn(min(points), zones[0])
+                        self.assertIn(max(points), zones[0])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,100 @@
+# Copyright (c) prisma.ai 2021
+# All rights reserved
+
+# Incremental zone state tests, against full rebuilds. Run from the repo root:
+#   python3 -m unittest discover tests
+
+__author__ = 'David Pescariu'
+
+import random
+import unittest
+from api.zone_builder import ZoneBuilder
+from api.zone_state import CellZones
+
+def marker_data(points: list) -> list:
+    """
+    Format points like db_connector.return_markers does
+
+    Args:
+        points (list): (lat, long) of the markers
+
+    Returns:
+        list: The markers, with the "end" marker
+    """
+    return [f"{lat}&{long}&theft&2021-01-01&10:00:00" for (lat, long) in points] + ["end"]
+
+class CellZonesTest(unittest.TestCase):
+    """
+    Every step is checked with verify() and against a fresh ZoneBuilder of
+    the markers left, in the order they were added
+    """
+    SEED = 2021
+    CELLS = 40
+    STEPS = 60
+
+    def assertRebuilt(self, state: CellZones, points: list) -> None:
+        self.assertEqual(len(state), len(points))
+        self.assertTrue(state.verify())
+        self.assertEqual(state.get_zones(), ZoneBuilder(marker_data(points)).get_zones())
+
+    def add(self, state: CellZones, points: list, point: tuple) -> None:
+        state.add(*point)
+        points.append(point)
+        self.assertRebuilt(state, points)
+
+    def remove(self, state: CellZones, points: list, point: tuple) -> None:
+        self.assertEqual(state.remove(*point), points.count(point))
+        points[:] = [other for other in points if other != point]
+        self.assertRebuilt(state, points)
+
+    def test_random_steps(self):
+        rng = random.Random(self.SEED)
+        for cell in range(self.CELLS):
+            spread = rng.choice([0.005, 0.02, 0.05])
+            points = [
+                (round(46 + rng.random() * spread, 4), round(23 + rng.random() * spread, 4))
+                for _ in range(rng.randint(0, 40))
+            ]
+            state = CellZones(points)
+            points = list(points)
+            with self.subTest(cell=cell):
+                self.assertRebuilt(state, points)
+                for _ in range(self.STEPS):
+                    roll = rng.random()
+                    if points and roll < 0.35:
+                        self.remove(state, points, rng.choice(points))
+                    elif points and roll < 0.5:
+                        # Same coords as a marker already there
+                        self.add(state, points, rng.choice(points))
+                    else:
+                        self.add(state, points,
+                            (round(46 + rng.random() * spread, 4), round(23 + rng.random() * spread, 4)))
+
+    def test_split(self):
+        # A chain, the middle marker holds both ends in the same zone
+        points = [(46.0, 23.0), (46.003, 23.0), (46.006, 23.0), (46.009, 23.0), (46.012, 23.0)]
+        state = CellZones(points)
+        points = list(points)
+        self.assertEqual(len(state.get_zones()), 1)
+        self.remove(state, points, (46.006, 23.0))
+        self.assertEqual(len(state.get_zones()), 2)
+        self.add(state, points, (46.006, 23.0))
+        self.assertEqual(len(state.get_zones()), 1)
+
+    def test_duplicates(self):
+        state = CellZones([])
+        points = []
+        for _ in range(5):
+            self.add(state, points, (46.5, 23.5))
+        self.add(state, points, (46.502, 23.5))
+        # Removes every marker at the coords at once
+        self.remove(state, points, (46.5, 23.5))
+        self.assertEqual(state.get_zones(), [[(46.502, 23.5)]])
+        self.assertEqual(state.remove(46.5, 23.5), 0)
+        self.remove(state, points, (46.502, 23.5))
+        self.assertEqual(state.get_zones(), [])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -14,22 +14,36 @@ REQUIRED_MODULES = [
     "enum",
     "json",
     "flask",
-    "waitress",
+    "waitress"
+]
+
+# Only needed with storage_backend "mysql"
+MYSQL_MODULES = [
     "mysql.connector"
 ]
 
+# Only needed with serve_mode "asgi"
+ASGI_MODULES = [
+    "starlette",
+    "uvicorn",
+    "aiomysql"
+]
 
-def check_imports() -> bool:
+
+def check_imports(extra_modules: list = ()) -> bool:
     """
     Checks to see if all modules can be imported.
     Prints any module that wasn't found.
 
+    Args:
+        extra_modules (list, optional): Modules needed by the configured features, ex: ASGI_MODULES
+
     Returns:
         Boolean: True if a module(or more) wasn't found, False if all found
     """    
     anyNotFound = False
 
-    for module in REQUIRED_MODULES:
+    for module in [*REQUIRED_MODULES, *extra_modules]:
         spec = importlib.util.find_spec(module)
         wasFound = spec is not None
         if not wasFound:
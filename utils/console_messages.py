@@ -1,52 +1,40 @@
 # Copyright (c) prisma.ai 2021
 # All rights reserved
 
-# This module logs both to the logfile and the console
+# This module logs both to the logfile and the console, through the logging
+# pipeline of log/logger.py, the console output can be turned off with log_console
 
 __author__ = 'David Pescariu'
 
 from datetime import datetime
-import logging
-from log.logger import initialize_logging
+from log.logger import initialize_logging, get_logger
 
+# Defaults until main.py loads the config and sets it up again
 initialize_logging()
 
-colors = {
-    'note' : '\033[94m',    # Blue
-    'ok'   : '\033[92m',    # Green
-    'fail' : '\033[91m',    # Red
-    'warn' : '\033[93m',    # Yellow
-
-    'end'  : '\033[0m'      # Clear
-}
-
-def fatal_fail(message: str or None) -> None:
+def fatal_fail(message: str or None, subsystem: str = None) -> None:
     """
     Show the fatal fail prompt
 
     Args:
         message (str or None): Custom message, None for blank
+        subsystem (str, optional): Subsystem logging it, ex: "auth". Defaults to None.
     """
     if message == None:
-        print(f"{colors['fail']}[FATAL_FAIL] Unable to continue, exiting!{colors['end']}")
-        logging.critical("[FATAL] Unable to continue, exiting!")
-    else:
-        print(f"{colors['fail']}[FATAL_FAIL] {message}{colors['end']}")
-        logging.critical(f"[FATAL] {message}")
+        message = "Unable to continue, exiting!"
+    get_logger(subsystem).critical(f"[FATAL] {message}", extra=dict(tag="FATAL_FAIL", text=message))
 
-def fail(message: str or None) -> None:
+def fail(message: str or None, subsystem: str = None) -> None:
     """
     Show the fail prompt
 
     Args:
         message (str or None): Custom message, None for blank
+        subsystem (str, optional): Subsystem logging it, ex: "auth". Defaults to None.
     """
     if message == None:
-        print(f"{colors['warn']}[FAIL] Unknown fail{colors['end']}")
-        logging.warning("Unknown fail")
-    else:
-        print(f"{colors['warn']}[FAIL] {message}{colors['end']}")
-        logging.warning(f"{message}")
+        message = "Unknown fail"
+    get_logger(subsystem).warning(message, extra=dict(tag="FAIL"))
 
 def start(rev: str) -> None:
     """
@@ -55,51 +43,52 @@ def start(rev: str) -> None:
     Args:
         rev (str): Current revision of the API
     """
-    print(f"{colors['ok']}[START] API V3 - {rev} at {datetime.now()}{colors['end']}")
-    logging.info(f"[START] API V3 - {rev} at {datetime.now()}")
+    message = f"API V3 - {rev} at {datetime.now()}"
+    get_logger().info(f"[START] {message}", extra=dict(tag="START", text=message))
 
-def info(message: str) -> None:
+def info(message: str, subsystem: str = None) -> None:
     """
     Show the info message
 
     Args:
         message (str): The message
+        subsystem (str, optional): Subsystem logging it, ex: "request". Defaults to None.
     """
-    print(f"[INFO] {message}")
-    logging.info(f"{message}")
+    get_logger(subsystem).info(message, extra=dict(tag="INFO"))
 
-def ok(message: str) -> None:
+def ok(message: str, subsystem: str = None) -> None:
     """
     Show the ok message
 
     Args:
         message (str): The message
+        subsystem (str, optional): Subsystem logging it, ex: "zones". Defaults to None.
     """
-    print(f"{colors['ok']}[OK] {message}{colors['end']}")
-    logging.info(f"{message}")
+    get_logger(subsystem).info(message, extra=dict(tag="OK"))
 
-def debug(message: str) -> None:
+def debug(message: str, subsystem: str = None) -> None:
     """
     Show a debug message
 
     Args:
         message (str): The message
+        subsystem (str, optional): Subsystem logging it. Defaults to None.
     """
-    print(f"{colors['note']}[DEBUG] {message}{colors['end']}")
-    logging.info(f"[RUNTIME_DEBUG] {message}")
+    get_logger(subsystem).info(f"[RUNTIME_DEBUG] {message}", extra=dict(tag="DEBUG", text=message))
 
 def stop() -> None:
     """
     Show the stop message
     """
-    print(f"{colors['fail']}[STOP] Stopped at {datetime.now()}{colors['end']}\n")
-    logging.warning(f"[STOP] Stopped at {datetime.now()}")
+    message = f"Stopped at {datetime.now()}"
+    get_logger().warning(f"[STOP] {message}", extra=dict(tag="STOP", text=message))
 
-def exception(exception: Exception) -> None:
+def exception(exception: Exception, subsystem: str = None) -> None:
     """
-    Log an exception
+    Log an exception, only to the logfile
 
     Args:
         exception (Exception): Exception
+        subsystem (str, optional): Subsystem logging it. Defaults to None.
     """
-    logging.exception(exception)
+    get_logger(subsystem).exception(exception, extra=dict(console=False))